@@ -0,0 +1,128 @@
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+import types
+
+#benchmark of the graph build and of the lookup paths on synthetic corpora (see synthetic_data.py). Every phase is measured with
+#instrumentation.BuildReport (wall time, rows, SQL queries, memory); the results are written as JSON so that runs can be compared.
+
+SIZES = (10000, 100000, 1000000)
+
+def configure_sqlite(database):
+    """
+    Configures Django with a single SQLite database and registers model.py as the 'model' app, for running outside of a Django project.
+    Must be called before any module importing model.py.
+    """
+    import django
+    from django.apps import apps, AppConfig
+    from django.conf import settings
+    settings.configure(DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': database}},
+                       INSTALLED_APPS = [], USE_TZ = False, DEFAULT_AUTO_FIELD = 'django.db.models.AutoField')
+    django.setup()
+    #model.py is a plain module and not an application package, its app config is registered by hand before the models are defined
+    module = types.ModuleType('model')
+    module.__file__ = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model.py')
+    config = AppConfig('model', module)
+    config.apps = apps
+    config.models = apps.all_models['model']
+    apps.app_configs['model'] = config
+    apps.clear_cache()
+
+def create_tables():
+    from django.apps import apps
+    from django.db import connection
+    import model
+    with connection.schema_editor() as editor:
+        for model_class in apps.get_app_config('model').get_models():
+            editor.create_model(model_class)
+
+def benchmark_build(report, directory):
+    """
+    Builds the graph with create_graph, which records its phases (load, entities, genes, drugs, topics, trials, ratings, save) in report.
+    """
+    from graph_creation import create_graph
+    ontology = create_graph(output = os.path.join(directory, 'graph.owl'), report = report)
+    ontology.world.close()
+
+def benchmark_queries(report, directory, samples = 100):
+    """
+    Times the lookup paths: building and querying the BM25 index, the CSR export and the knowledge graph scorer, the eligibility filter
+    and fetching the links of sampled trials.
+    """
+    import bm25
+    import csr_export
+    import eligibility
+    import kg_scoring
+    from model import ClinicalTrial, Topic, trial_links
+    topics = list(Topic.objects.all())
+    with report.phase('bm25_build'):
+        index = bm25.build_index(os.path.join(directory, 'bm25'), documents = bm25.iter_trial_texts())
+    with report.phase('eligibility_build'):
+        eligible = eligibility.build_eligibility(os.path.join(directory, 'eligibility'))
+    with report.phase('bm25_search'):
+        for topic in topics:
+            index.search_topic(topic, eligibility = eligible)
+    with report.phase('csr_export'):
+        csr_export.export_csr(os.path.join(directory, 'csr'))
+    scorer = kg_scoring.KGScorer(csr_export.CSRGraph(os.path.join(directory, 'csr')))
+    with report.phase('kg_top_k'):
+        scorer.top_k(topics, 1000)
+    nctids = list(ClinicalTrial.objects.values_list('nctid', flat = True))
+    sample = random.Random(0).sample(nctids, min(samples, len(nctids)))
+    with report.phase('trial_links'):
+        for nctid in sample:
+            list(trial_links([nctid]))
+
+def run(trials, directory, seed = 0, trace_memory = False, queries = True):
+    """
+    Generates a corpus of trials in a new SQLite database in directory and benchmarks it. configure_sqlite must have been called
+    with directory/benchmark.sqlite3. Returns the result of the run.
+    """
+    from django.db import connection
+    from instrumentation import BuildReport
+    from synthetic_data import generate_corpus
+    report = BuildReport(progress = False, trace_memory = trace_memory)
+    create_tables()
+    with report.phase('generate'):
+        counts = generate_corpus(trials, seed, progress = False)
+    benchmark_build(report, directory)
+    if queries:
+        benchmark_queries(report, directory)
+    connection.close()
+    return {'trials': trials, 'seed': seed, 'rows': counts, 'database_mb': os.path.getsize(os.path.join(directory, 'benchmark.sqlite3')) / 2 ** 20, 'phases': report.phases, 'anomalies': dict(report.anomalies)}
+
+def environment():
+    import django
+    import owlready2
+    import numpy
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'django': django.get_version(), 'owlready2': getattr(owlready2, 'VERSION', None),
+            'numpy': numpy.__version__, 'cpus': os.cpu_count()}
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmarks the graph build and the lookups on synthetic corpora.')
+    parser.add_argument('--trials', type = int, default = SIZES[0], help = 'number of synthetic trials')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', default = 'benchmark.json', help = 'JSON file the results are written to')
+    parser.add_argument('--directory', default = None, help = 'directory of the database and of the built files, a temporary one by default')
+    parser.add_argument('--trace-memory', action = 'store_true', help = 'trace Python allocations per phase (slow)')
+    parser.add_argument('--no-queries', action = 'store_true', help = 'only benchmark the graph build')
+    args = parser.parse_args(argv)
+    #one corpus size per process: Django is configured once and SQLite files are not shared between sizes
+    with tempfile.TemporaryDirectory() as temporary:
+        directory = args.directory or temporary
+        os.makedirs(directory, exist_ok = True)
+        database = os.path.join(directory, 'benchmark.sqlite3')
+        if os.path.exists(database):
+            os.remove(database)
+        configure_sqlite(database)
+        result = run(args.trials, directory, args.seed, args.trace_memory, not args.no_queries)
+    result['environment'] = environment()
+    with open(args.output, 'w', encoding = 'utf-8') as f:
+        json.dump(result, f, indent = 2)
+    return result
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+from model import ClinicalTrial, Condition, Intervention, Keywords, MeshCondition, MeshIntervention
+from graph_data import group_by
+from array import array
+from collections import Counter
+import json
+import math
+import os
+import re
+import numpy as np
+from tqdm import tqdm
+
+#in-process, field weighted BM25 (BM25F) retrieval over the clinical trials. The index is a set of flat NumPy arrays:
+#postings are stored term after term (document ids and precomputed field weighted term frequencies) and located
+#through an offsets array, so that a search only touches the postings of the query terms and the files can be memory mapped.
+
+TRIAL_TEXT_FIELDS = ('brief_title', 'official_title', 'summary', 'description', 'criteria')
+#fields stored in related tables: (model, text column)
+RELATED_TEXT_FIELDS = {
+    'conditions': (Condition, 'text'),
+    'interventions': (Intervention, 'name'),
+    'keywords': (Keywords, 'text'),
+    'mesh_conditions': (MeshCondition, 'term'),
+    'mesh_interventions': (MeshIntervention, 'term'),
+}
+DEFAULT_FIELD_WEIGHTS = {
+    'brief_title': 2.0,
+    'official_title': 2.0,
+    'summary': 1.0,
+    'description': 1.0,
+    'criteria': 0.5,
+    'conditions': 2.0,
+    'interventions': 1.5,
+    'keywords': 1.5,
+    'mesh_conditions': 1.5,
+    'mesh_interventions': 1.5,
+}
+TOKEN = re.compile(r'[a-z0-9]+')
+
+def tokenize(text):
+    return TOKEN.findall(text.lower()) if text else []
+
+def iter_trial_texts(chunk_size = 1000):
+    """
+    Generator of (nctid, {field: text}) pairs over every trial in NCTID order. Trials are fetched with keyset pagination and the
+    texts of the related tables are loaded for one page at a time.
+    """
+    last_nctid = None
+    while True:
+        trials = ClinicalTrial.objects.order_by('nctid')
+        if last_nctid is not None:
+            trials = trials.filter(nctid__gt = last_nctid)
+        trials = list(trials.values('nctid', *TRIAL_TEXT_FIELDS)[:chunk_size])
+        if not trials:
+            return
+        last_nctid = trials[-1]['nctid']
+        nctids = [trial['nctid'] for trial in trials]
+        related = {field: group_by(model.objects.filter(document_id__in = nctids).values('document_id', column), 'document_id')
+                   for field, (model, column) in RELATED_TEXT_FIELDS.items()}
+        for trial in trials:
+            texts = {field: trial[field] for field in TRIAL_TEXT_FIELDS}
+            for field, (model, column) in RELATED_TEXT_FIELDS.items():
+                texts[field] = ' '.join(row[column] for row in related[field].get(trial['nctid'], []))
+            yield trial['nctid'], texts
+
+def build_index(directory = 'bm25_index', field_weights = DEFAULT_FIELD_WEIGHTS, b = 0.75, k1 = 1.2, documents = None):
+    """
+    Builds the index and writes it to directory. documents is an iterable of (nctid, {field: text}) pairs, by default every trial
+    read by iter_trial_texts. Field lengths are normalized with b at build time; k1 is stored as the default of BM25Index.
+    """
+    if documents is None:
+        documents = iter_trial_texts()
+    fields = list(field_weights)
+    terms = {}
+    nctids = []
+    #raw postings, one entry per (term, document, field)
+    p_terms, p_docs, p_fields, p_tfs = array('i'), array('i'), array('b'), array('i')
+    lengths = [array('f') for field in fields]
+    for doc_id, (nctid, texts) in enumerate(tqdm(documents)):
+        nctids.append(nctid)
+        for field_id, field in enumerate(fields):
+            tokens = tokenize(texts.get(field, ''))
+            lengths[field_id].append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                p_terms.append(terms.setdefault(term, len(terms)))
+                p_docs.append(doc_id)
+                p_fields.append(field_id)
+                p_tfs.append(tf)
+    p_terms = np.frombuffer(p_terms, dtype = np.int32)
+    p_docs = np.frombuffer(p_docs, dtype = np.int32)
+    p_fields = np.frombuffer(p_fields, dtype = np.int8)
+    lengths = np.array([np.frombuffer(field_lengths, dtype = np.float32) for field_lengths in lengths]).reshape(len(fields), len(nctids))
+    average = np.maximum(lengths.mean(axis = 1), 1e-9) if len(nctids) else np.ones(len(fields), dtype = np.float32)
+    weights = np.array([field_weights[field] for field in fields], dtype = np.float32)
+    #BM25F pseudo term frequency: sum over fields of weight * tf / length normalization
+    norm = 1 - b + b * lengths[p_fields, p_docs] / average[p_fields]
+    contributions = weights[p_fields] * np.frombuffer(p_tfs, dtype = np.int32) / norm
+
+    order = np.lexsort((p_docs, p_terms))
+    p_terms, p_docs, contributions = p_terms[order], p_docs[order], contributions[order]
+    boundaries = np.flatnonzero((np.diff(p_terms) != 0) | (np.diff(p_docs) != 0)) + 1
+    starts = np.concatenate(([0], boundaries)) if len(p_terms) else np.zeros(0, dtype = np.int64)
+    postings_terms = p_terms[starts]
+    postings_docs = p_docs[starts].astype(np.int32)
+    postings_weights = np.add.reduceat(contributions, starts).astype(np.float32) if len(starts) else np.zeros(0, dtype = np.float32)
+    offsets = np.zeros(len(terms) + 1, dtype = np.int64)
+    np.cumsum(np.bincount(postings_terms, minlength = len(terms)), out = offsets[1:])
+
+    os.makedirs(directory, exist_ok = True)
+    np.save(os.path.join(directory, 'docs.npy'), postings_docs)
+    np.save(os.path.join(directory, 'weights.npy'), postings_weights)
+    np.save(os.path.join(directory, 'offsets.npy'), offsets)
+    np.save(os.path.join(directory, 'nctids.npy'), np.array(nctids, dtype = str))
+    with open(os.path.join(directory, 'terms.json'), 'w', encoding = 'utf-8') as f:
+        json.dump(terms, f)
+    with open(os.path.join(directory, 'meta.json'), 'w', encoding = 'utf-8') as f:
+        json.dump({'k1': k1, 'b': b, 'field_weights': field_weights, 'documents': len(nctids)}, f)
+    return BM25Index(directory)
+
+def topic_query(topic):
+    """
+    Query text of a TREC topic: its disease and gene description.
+    """
+    return f'{topic.disease} {topic.genes}'
+
+class BM25Index:
+    """
+    Read-only BM25 index written by build_index. The postings arrays are memory mapped.
+    """
+    def __init__(self, directory = 'bm25_index', k1 = None, mmap_mode = 'r'):
+        with open(os.path.join(directory, 'meta.json'), encoding = 'utf-8') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(directory, 'terms.json'), encoding = 'utf-8') as f:
+            self.terms = json.load(f)
+        self.k1 = k1 if k1 is not None else self.meta['k1']
+        self.docs = np.load(os.path.join(directory, 'docs.npy'), mmap_mode = mmap_mode)
+        self.weights = np.load(os.path.join(directory, 'weights.npy'), mmap_mode = mmap_mode)
+        self.offsets = np.load(os.path.join(directory, 'offsets.npy'))
+        self.nctids = np.load(os.path.join(directory, 'nctids.npy'))
+        self.document_count = len(self.nctids)
+
+    def idf(self, term_id):
+        df = self.offsets[term_id + 1] - self.offsets[term_id]
+        return math.log(1 + (self.document_count - df + 0.5) / (df + 0.5))
+
+    def scores(self, query):
+        """
+        Returns the BM25 score of every document for a query, given as text or as {term: weight}.
+        """
+        if isinstance(query, str):
+            query = Counter(tokenize(query))
+        scores = np.zeros(self.document_count, dtype = np.float32)
+        for term, query_weight in query.items():
+            term_id = self.terms.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            tf = self.weights[start:end]
+            #every document occurs once in the postings of a term, so fancy indexing accumulates correctly
+            scores[self.docs[start:end]] += query_weight * self.idf(term_id) * tf * (self.k1 + 1) / (self.k1 + tf)
+        return scores
+
+    def search(self, query, k = 1000, mask = None):
+        """
+        Returns the k best (nctid, score) pairs for a query, best first. Documents without any query term, and documents
+        outside mask (a boolean array over self.nctids, see eligibility.EligibilityIndex.mask_for), are not returned.
+        The mask is applied to the scores: scoring only reads the postings of the query terms, and filtering every posting by the mask costs more.
+        """
+        scores = self.scores(query)
+        if mask is not None:
+            scores[~mask] = 0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind = 'stable')]
+        return [(str(self.nctids[i]), float(scores[i])) for i in candidates]
+
+    def search_topic(self, topic, k = 1000, eligibility = None):
+        """
+        Searches with the query of a topic. With an eligibility.EligibilityIndex, trials the patient is not eligible for are not returned.
+        """
+        mask = eligibility.mask_for(topic, self.nctids) if eligibility is not None else None
+        return self.search(topic_query(topic), k, mask)
@@ -0,0 +1,143 @@
+from graph_data import DjangoDataSource
+from naming import BASE_IRI, entity_name, gene_name, drug_name, topic_name
+import json
+import os
+import numpy as np
+from scipy import sparse
+
+#compact export of the trial - entity - gene - drug graph as typed CSR adjacency matrices. Every node type gets dense integer ids
+#(in the order of the iris arrays) and every relation is stored as three .npy files (indptr, indices, data) that can be memory mapped.
+
+NODE_TYPES = ('trial', 'entity', 'gene', 'drug', 'topic')
+#relation: (source node type, target node type, meaning of data)
+RELATIONS = {
+    'trial_entity': ('trial', 'entity', 'number of EntityLinks of the trial and its conditions'),
+    'trial_gene': ('trial', 'gene', 'number of GeneLinks of the trial and its conditions'),
+    'trial_drug': ('trial', 'drug', 'number of DrugLinks of the trial and its conditions'),
+    'drug_gene': ('drug', 'gene', 'DrugGeneLinkDetails.impact'),
+    'gene_family': ('gene', 'gene', '1 for the family of a gene'),
+    'topic_gene': ('topic', 'gene', '1 for every gene of the topic'),
+    'topic_entity': ('topic', 'entity', '1 for the disease of the topic'),
+    'topic_trial': ('topic', 'trial', 'Rating.relevance_score'),
+}
+
+def csr_arrays(rows, cols, data, shape):
+    """
+    Builds CSR arrays from coordinate lists; repeated (row, col) pairs are summed.
+    """
+    rows = np.asarray(rows, dtype = np.int64)
+    cols = np.asarray(cols, dtype = np.int64)
+    data = np.asarray(data, dtype = np.float32)
+    order = np.lexsort((cols, rows))
+    rows, cols, data = rows[order], cols[order], data[order]
+    if len(rows):
+        starts = np.concatenate(([0], np.flatnonzero((np.diff(rows) != 0) | (np.diff(cols) != 0)) + 1))
+        rows, cols, data = rows[starts], cols[starts], np.add.reduceat(data, starts)
+    indptr = np.zeros(shape[0] + 1, dtype = np.int64)
+    np.cumsum(np.bincount(rows, minlength = shape[0]), out = indptr[1:])
+    return indptr, cols.astype(np.int32), data.astype(np.float32)
+
+class Edges:
+    def __init__(self):
+        self.rows, self.cols, self.data = [], [], []
+
+    def add(self, row, col, value = 1.0):
+        if row is not None and col is not None:
+            self.rows.append(row)
+            self.cols.append(col)
+            self.data.append(value)
+
+def export_csr(directory = 'kg_csr', data = None, source = None):
+    """
+    Exports the graph to directory: <type>.iris.npy with the IRI of every node, <relation>.{indptr,indices,data}.npy for every relation
+    of RELATIONS, and meta.json with the node counts and the shape of every relation. The data is read from source, by default the database.
+    """
+    if source is None:
+        source = DjangoDataSource()
+    if data is None:
+        #trial tables are streamed page by page below
+        data = source.load_shared_data()
+        chunks = source.iter_trial_chunks(data, fields = ('nctid',))
+    else:
+        chunks = [None]
+    nctids = source.trial_ids()
+    iris = {
+        'trial': [BASE_IRI + nctid for nctid in nctids],
+        'entity': [BASE_IRI + entity_name(entity['url']) for entity in data.entities],
+        'gene': [BASE_IRI + gene_name(gene['main_label']) for gene in data.genes],
+        'drug': [BASE_IRI + drug_name(data.drug_labels[drug]) for drug in data.drugs],
+        'topic': [BASE_IRI + topic_name(topic['year'], topic['topic_no']) for topic in data.topics],
+    }
+    trial_ids = {nctid: i for i, nctid in enumerate(nctids)}
+    entity_ids = {}
+    for i, entity in enumerate(data.entities):
+        entity_ids.setdefault(entity['url'], i)
+    gene_ids = {gene['main_label']: i for i, gene in enumerate(data.genes)}
+    drug_ids = {drug: i for i, drug in enumerate(data.drugs)}
+    topic_ids = {topic['pk']: i for i, topic in enumerate(data.topics)}
+
+    edges = {relation: Edges() for relation in RELATIONS}
+    for chunk in chunks:
+        condition_trials = {condition['pk']: nctid for nctid, conditions in data.conditions.items() for condition in conditions}
+        for relation, links, target, target_ids in (('trial_entity', data.entity_links, 'entity__url', entity_ids),
+                                                    ('trial_gene', data.gene_links, 'gene_id', gene_ids),
+                                                    ('trial_drug', data.drug_links, 'drug_id', drug_ids)):
+            for nctid, rows in links['document'].items():
+                for link in rows:
+                    edges[relation].add(trial_ids.get(nctid), target_ids.get(link[target]))
+            for condition, rows in links['condition'].items():
+                for link in rows:
+                    edges[relation].add(trial_ids.get(condition_trials.get(condition)), target_ids.get(link[target]))
+        for rating in data.ratings:
+            edges['topic_trial'].add(topic_ids.get(rating['topic_id']), trial_ids.get(rating['document_id']), rating['relevance_score'])
+    for drug, rows in data.drug_targets.items():
+        for row in rows:
+            edges['drug_gene'].add(drug_ids.get(drug), gene_ids.get(row['gene_id']), row['impact'])
+    for gene in data.genes:
+        if gene['family_id']:
+            edges['gene_family'].add(gene_ids[gene['main_label']], gene_ids.get(gene['family_id']))
+    for topic in data.topics:
+        for row in data.topic_genes.get(topic['pk'], []):
+            edges['topic_gene'].add(topic_ids[topic['pk']], gene_ids.get(row['gene_id']))
+        if topic['disease_fl__url'] is not None:
+            edges['topic_entity'].add(topic_ids[topic['pk']], entity_ids.get(topic['disease_fl__url']))
+
+    os.makedirs(directory, exist_ok = True)
+    counts = {node_type: len(iris[node_type]) for node_type in NODE_TYPES}
+    for node_type in NODE_TYPES:
+        np.save(os.path.join(directory, f'{node_type}.iris.npy'), np.array(iris[node_type], dtype = str))
+    shapes = {}
+    for relation, (source_type, target_type, meaning) in RELATIONS.items():
+        shapes[relation] = (counts[source_type], counts[target_type])
+        indptr, indices, values = csr_arrays(edges[relation].rows, edges[relation].cols, edges[relation].data, shapes[relation])
+        np.save(os.path.join(directory, f'{relation}.indptr.npy'), indptr)
+        np.save(os.path.join(directory, f'{relation}.indices.npy'), indices)
+        np.save(os.path.join(directory, f'{relation}.data.npy'), values)
+    with open(os.path.join(directory, 'meta.json'), 'w', encoding = 'utf-8') as f:
+        json.dump({'nodes': counts, 'relations': {relation: {'source': source_type, 'target': target_type, 'data': meaning, 'shape': shapes[relation]}
+                                                  for relation, (source_type, target_type, meaning) in RELATIONS.items()}}, f, indent = 1)
+    return directory
+
+class CSRGraph:
+    """
+    Graph exported by export_csr. relations holds a scipy.sparse.csr_matrix per relation and iris an array of IRIs per node type,
+    all backed by memory mapped files when mmap_mode is set.
+    """
+    def __init__(self, directory = 'kg_csr', mmap_mode = 'r'):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'), encoding = 'utf-8') as f:
+            self.meta = json.load(f)
+        self.iris = {node_type: np.load(os.path.join(directory, f'{node_type}.iris.npy'), mmap_mode = mmap_mode) for node_type in NODE_TYPES}
+        self.relations = {}
+        for relation, description in self.meta['relations'].items():
+            arrays = [np.load(os.path.join(directory, f'{relation}.{part}.npy'), mmap_mode = mmap_mode) for part in ('data', 'indices', 'indptr')]
+            self.relations[relation] = sparse.csr_matrix(tuple(arrays), shape = tuple(description['shape']), copy = False)
+        self.ids = {}
+
+    def node_id(self, node_type, iri):
+        """
+        Dense id of a node given its IRI; the reverse mapping of a node type is built on first use.
+        """
+        if node_type not in self.ids:
+            self.ids[node_type] = {str(node_iri): i for i, node_iri in enumerate(self.iris[node_type])}
+        return self.ids[node_type].get(iri)
@@ -0,0 +1,110 @@
+from model import ClinicalTrial, Topic
+import os
+import re
+import numpy as np
+
+#structured eligibility filter: the free-text age limits and gender of the trials are parsed once into numeric columns
+#(ages in years, gender codes) stored as NumPy arrays, and a topic's demographics are checked against all trials with vectorized comparisons.
+
+ALL, MALE, FEMALE = 0, 1, 2
+UNIT_YEARS = {'year': 1.0, 'yr': 1.0, 'y': 1.0, 'month': 1 / 12, 'mo': 1 / 12, 'week': 7 / 365.25, 'wk': 7 / 365.25, 'day': 1 / 365.25,
+              'hour': 1 / 8766, 'minute': 1 / 525960}
+AGE = re.compile(r'(\d+(?:\.\d+)?)\s*(years?|yrs?|months?|mos?|weeks?|wks?|days?|hours?|minutes?|y)\b', re.IGNORECASE)
+TOPIC_AGE = re.compile(r'(\d+(?:\.\d+)?)\s*-?\s*(years?|yrs?|months?|mos?|weeks?|wks?|days?|y)(?:[\s-]*old|\b)|(\d+(?:\.\d+)?)\s*yo\b', re.IGNORECASE)
+FEMALE_WORDS = re.compile(r'\b(female|woman|women|girl|lady|she)\b', re.IGNORECASE)
+MALE_WORDS = re.compile(r'\b(male|man|men|boy|gentleman|he)\b', re.IGNORECASE)
+
+def unit_in_years(unit):
+    unit = unit.lower().rstrip('s') if len(unit) > 1 else unit.lower()
+    return UNIT_YEARS[unit]
+
+def parse_age(text, default):
+    """
+    Parses an age limit such as '18 Years' or '6 Months' into years. Empty values and 'N/A' give default.
+    """
+    match = AGE.search(text or '')
+    if match is None:
+        return default
+    return float(match.group(1)) * unit_in_years(match.group(2))
+
+def parse_gender(text):
+    text = (text or '').strip().lower()
+    if text == 'male':
+        return MALE
+    if text == 'female':
+        return FEMALE
+    return ALL
+
+def parse_demographics(demo):
+    """
+    Parses Topic.demo, e.g. '64-year-old female', into (age in years or None, gender code or None).
+    """
+    age = None
+    match = TOPIC_AGE.search(demo or '')
+    if match is not None:
+        if match.group(3) is not None:
+            age = float(match.group(3))
+        else:
+            age = float(match.group(1)) * unit_in_years(match.group(2))
+    gender = None
+    if FEMALE_WORDS.search(demo or ''):
+        gender = FEMALE
+    elif MALE_WORDS.search(demo or ''):
+        gender = MALE
+    return age, gender
+
+def build_eligibility(directory = 'eligibility', chunk_size = 10000):
+    """
+    Parses the age limits and gender of every trial and saves them as columns (nctids, min_age, max_age, gender) in directory.
+    """
+    nctids, min_ages, max_ages, genders = [], [], [], []
+    rows = ClinicalTrial.objects.order_by('nctid').values_list('nctid', 'min_age', 'max_age', 'gender').iterator(chunk_size = chunk_size)
+    for nctid, min_age, max_age, gender in rows:
+        nctids.append(nctid)
+        min_ages.append(parse_age(min_age, 0.0))
+        max_ages.append(parse_age(max_age, np.inf))
+        genders.append(parse_gender(gender))
+    os.makedirs(directory, exist_ok = True)
+    np.save(os.path.join(directory, 'nctids.npy'), np.array(nctids, dtype = str))
+    np.save(os.path.join(directory, 'min_age.npy'), np.array(min_ages, dtype = np.float64))
+    np.save(os.path.join(directory, 'max_age.npy'), np.array(max_ages, dtype = np.float64))
+    np.save(os.path.join(directory, 'gender.npy'), np.array(genders, dtype = np.int8))
+    return EligibilityIndex(directory)
+
+class EligibilityIndex:
+    """
+    Columns written by build_eligibility, sorted by NCTID.
+    """
+    def __init__(self, directory = 'eligibility', mmap_mode = 'r'):
+        self.nctids = np.load(os.path.join(directory, 'nctids.npy'))
+        self.min_age = np.load(os.path.join(directory, 'min_age.npy'), mmap_mode = mmap_mode)
+        self.max_age = np.load(os.path.join(directory, 'max_age.npy'), mmap_mode = mmap_mode)
+        self.gender = np.load(os.path.join(directory, 'gender.npy'), mmap_mode = mmap_mode)
+
+    def mask(self, topic):
+        """
+        Boolean array over self.nctids, True for trials a patient described by topic (a Topic or a Topic.demo string) is eligible for.
+        Parts of the demographics that cannot be parsed do not filter.
+        """
+        age, gender = parse_demographics(topic.demo if isinstance(topic, Topic) else topic)
+        mask = np.ones(len(self.nctids), dtype = bool)
+        if age is not None:
+            #rounded like the columns (float32 in older indexes), so that an age equal to a limit, e.g. 1 month, is inside it
+            age = self.min_age.dtype.type(age)
+            mask &= (self.min_age <= age) & (age <= self.max_age)
+        if gender is not None:
+            mask &= (self.gender == ALL) | (self.gender == gender)
+        return mask
+
+    def mask_for(self, topic, nctids):
+        """
+        Same as mask, aligned with another array of NCTIDs (e.g. the documents of a BM25 index). Unknown trials are kept.
+        """
+        mask = self.mask(topic)
+        nctids = np.asarray(nctids, dtype = str)
+        positions = np.searchsorted(self.nctids, nctids)
+        known = positions < len(self.nctids)
+        known[known] = self.nctids[positions[known]] == nctids[known]
+        aligned = np.ones(len(nctids), dtype = bool)
+        aligned[known] = mask[positions[known]]
+        return aligned
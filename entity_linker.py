@@ -0,0 +1,241 @@
+from model import (ClinicalTrial, Condition, Intervention, Keywords, MeshCondition, MeshIntervention, Entity, GeneLabel, Gene, DrugName, PMVocab,
+                   EntityLink, GeneLink, DrugLink, PMVocabLink)
+from graph_data import group_by
+from concurrent.futures import ProcessPoolExecutor
+from django.db import transaction
+from django.db.models import Q
+import hashlib
+import multiprocessing
+import os
+import pickle
+from tqdm import tqdm
+
+#dictionary entity linker: the labels of entities, genes, drugs and PM vocabulary words are compiled into one Aho-Corasick automaton,
+#cached on disk, and the text of every trial that has not been processed yet is scanned in a pool of forked processes.
+#The matches become EntityLink, GeneLink, DrugLink and PMVocabLink rows, and the flags of the trials are set in the same transaction.
+
+#kind: (flag of ClinicalTrial, link model, foreign key of the target)
+LINK_KINDS = {
+    'entity': ('linked', EntityLink, 'entity_id'),
+    'gene': ('genes_extracted', GeneLink, 'gene_id'),
+    'drug': ('drugs_extracted', DrugLink, 'drug_id'),
+    'pmvocab': ('pmvocab_extracted', PMVocabLink, 'word_id'),
+}
+TRIAL_TEXT_FIELDS = ('brief_title', 'official_title', 'summary', 'description', 'criteria')
+#linked parts of a trial: (link foreign key, model, text column)
+PART_TEXT_FIELDS = (
+    ('condition', Condition, 'text'),
+    ('intervention', Intervention, 'name'),
+    ('keyword', Keywords, 'text'),
+    ('mesh_condition', MeshCondition, 'term'),
+    ('mesh_intervention', MeshIntervention, 'term'),
+)
+
+def load_dictionary():
+    """
+    Returns the dictionary as a sorted list of (lower case label, kind, target primary key) triples.
+    """
+    entries = set()
+    for pk, label in Entity.objects.values_list('pk', 'label'):
+        entries.add((label, 'entity', pk))
+    for main_label in Gene.objects.values_list('main_label', flat = True):
+        entries.add((main_label, 'gene', main_label))
+    for gene_id, text in GeneLabel.objects.values_list('gene_id', 'text'):
+        entries.add((text, 'gene', gene_id))
+    for drug_id, name in DrugName.objects.values_list('drug_id', 'name'):
+        entries.add((name, 'drug', drug_id))
+    for pk, word in PMVocab.objects.values_list('pk', 'word'):
+        entries.add((word, 'pmvocab', pk))
+    return sorted((label.strip().lower(), kind, target) for label, kind, target in entries if label and label.strip())
+
+class Automaton:
+    """
+    Aho-Corasick automaton over the characters of the labels. Every label has a list of (kind, target) payloads, since
+    the same text can name several entities, genes or drugs.
+    """
+    def __init__(self, entries, min_length = 3):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        self.lengths = []
+        self.payloads = []
+        labels = {}
+        for label, kind, target in entries:
+            if len(label) < min_length:
+                continue
+            if label not in labels:
+                labels[label] = len(self.lengths)
+                self.lengths.append(len(label))
+                self.payloads.append([])
+                self.add(label, labels[label])
+            self.payloads[labels[label]].append((kind, target))
+        self.build_failure_links()
+
+    def add(self, label, label_id):
+        state = 0
+        for char in label:
+            following = self.goto[state].get(char)
+            if following is None:
+                following = self.goto[state][char] = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            state = following
+        self.out[state].append(label_id)
+
+    def build_failure_links(self):
+        #breadth first, so that the failure state of a node is complete before its children are visited
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, following in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[following] = self.goto[fallback].get(char, 0) if self.goto[fallback].get(char, 0) != following else 0
+                self.out[following] = self.out[following] + self.out[self.fail[following]]
+                queue.append(following)
+
+    def matches(self, text):
+        """
+        Returns the matches of labels as whole words in text as (start, end, label id), sorted by start and longest first.
+        """
+        text = text.lower()
+        goto, fail, out, lengths = self.goto, self.fail, self.out, self.lengths
+        found = []
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for label_id in out[state]:
+                start = i + 1 - lengths[label_id]
+                #labels must start and end at word boundaries
+                if (start == 0 or not text[start - 1].isalnum()) and (i + 1 == len(text) or not text[i + 1].isalnum()):
+                    found.append((start, i + 1, label_id))
+        found.sort(key = lambda match: (match[0], match[0] - match[1]))
+        return found
+
+def longest_matches(matches):
+    """
+    Leftmost longest non-overlapping subset of matches sorted as returned by Automaton.matches, e.g. 'BRAF V600E' and not 'BRAF' inside it.
+    """
+    selected = []
+    end = 0
+    for match in matches:
+        if match[0] >= end:
+            selected.append(match)
+            end = match[1]
+    return selected
+
+def dictionary_hash(entries):
+    return hashlib.sha1(repr(entries).encode('utf-8')).hexdigest()
+
+def compile_automaton(path = 'linker_automaton.pickle', min_length = 3):
+    """
+    Returns the automaton of the current dictionary, read from the cache file path when the dictionary has not changed since it was compiled.
+    """
+    entries = load_dictionary()
+    key = (dictionary_hash(entries), min_length)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            cached_key, automaton = pickle.load(f)
+        if cached_key == key:
+            return automaton
+    automaton = Automaton(entries, min_length)
+    with open(path, 'wb') as f:
+        pickle.dump((key, automaton), f, protocol = pickle.HIGHEST_PROTOCOL)
+    return automaton
+
+###scanning
+#the automaton is inherited by the forked workers; they only match text and return plain tuples, all database work happens in the parent
+_automaton = None
+
+def link_document(document):
+    """
+    Links one trial given as (nctid, pending kinds, [(part, part primary key, field, text)]).
+    Returns (kind, nctid, part, part primary key, field, target) tuples, one per distinct target of every text.
+    """
+    nctid, kinds, texts = document
+    payloads = _automaton.payloads
+    links = []
+    for part, part_id, field, text in texts:
+        matches = _automaton.matches(text or '')
+        if not matches:
+            continue
+        #overlaps are resolved per kind, so that e.g. a gene name inside a longer disease label is still linked as a gene
+        for kind in kinds:
+            seen = set()
+            for start, end, label_id in longest_matches([match for match in matches if any(payload[0] == kind for payload in payloads[match[2]])]):
+                for payload_kind, target in payloads[label_id]:
+                    if payload_kind == kind and target not in seen:
+                        seen.add(target)
+                        links.append((kind, nctid, part, part_id, field, target))
+    return links
+
+def load_documents(trials):
+    """
+    Returns the documents to link for trials, rows with the nctid, the flags and the text fields of ClinicalTrial.
+    """
+    nctids = [trial['nctid'] for trial in trials]
+    parts = {part: group_by(model.objects.filter(document_id__in = nctids).values('pk', 'document_id', column).order_by('pk'), 'document_id')
+             for part, model, column in PART_TEXT_FIELDS}
+    documents = []
+    for trial in trials:
+        kinds = {kind for kind, (flag, model, target) in LINK_KINDS.items() if not trial[flag]}
+        texts = [('document', trial['nctid'], field, trial[field]) for field in TRIAL_TEXT_FIELDS]
+        for part, model, column in PART_TEXT_FIELDS:
+            texts.extend((part, row['pk'], None, row[column]) for row in parts[part].get(trial['nctid'], []))
+        documents.append((trial['nctid'], kinds, texts))
+    return documents
+
+def save_links(documents, links):
+    """
+    Inserts the links of a batch of documents and sets the flags of the linked kinds, in one transaction.
+    """
+    rows = {kind: [] for kind in LINK_KINDS}
+    for kind, nctid, part, part_id, field, target in links:
+        model, target_field = LINK_KINDS[kind][1], LINK_KINDS[kind][2]
+        rows[kind].append(model(**{part + '_id': part_id, 'field': field, target_field: target}))
+    with transaction.atomic():
+        for kind, (flag, model, target_field) in LINK_KINDS.items():
+            model.objects.bulk_create(rows[kind], batch_size = 1000)
+            ClinicalTrial.objects.filter(nctid__in = [nctid for nctid, kinds, texts in documents if kind in kinds]).update(**{flag: True})
+
+def link_trials(batch_size = 500, processes = None, automaton_path = 'linker_automaton.pickle', min_length = 3):
+    """
+    Links every trial that has at least one of the flags of LINK_KINDS unset, for the kinds whose flag is unset, and sets the flags.
+    Trials are read batch_size at a time with keyset pagination and matched in a process pool (in this process when processes is 1).
+    Returns the number of links created per kind.
+    """
+    global _automaton
+    from django.db import connections
+    _automaton = compile_automaton(automaton_path, min_length)
+    pending = ClinicalTrial.objects.filter(Q(linked = False) | Q(genes_extracted = False) | Q(drugs_extracted = False) | Q(pmvocab_extracted = False)).order_by('nctid')
+    columns = ['nctid'] + [flag for flag, model, target in LINK_KINDS.values()] + list(TRIAL_TEXT_FIELDS)
+    counts = {kind: 0 for kind in LINK_KINDS}
+    pool = ProcessPoolExecutor(processes, mp_context = multiprocessing.get_context('fork')) if processes != 1 else None
+    try:
+        with tqdm(total = pending.count()) as progress:
+            last_nctid = None
+            while True:
+                page = pending.filter(nctid__gt = last_nctid) if last_nctid is not None else pending
+                trials = list(page.values(*columns)[:batch_size])
+                if not trials:
+                    break
+                last_nctid = trials[-1]['nctid']
+                documents = load_documents(trials)
+                if pool is not None:
+                    #workers are forked on demand: they must not inherit an open database connection
+                    connections.close_all()
+                    results = pool.map(link_document, documents, chunksize = max(1, len(documents) // (4 * (processes or os.cpu_count() or 1))))
+                else:
+                    results = map(link_document, documents)
+                links = [link for document_links in results for link in document_links]
+                save_links(documents, links)
+                for link in links:
+                    counts[link[0]] += 1
+                progress.update(len(trials))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return counts
@@ -0,0 +1,121 @@
+from model import Rating, Topic
+from naming import topic_name
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+from tqdm import tqdm
+
+#TREC style evaluation of rankings against the judgments stored in Rating. The qrels are read with one query, the topics are ranked
+#in a process pool and the measures are computed with NumPy on the gains of each ranked list.
+
+MEASURES = ('P@10', 'nDCG', 'infNDCG', 'R-prec', 'MAP')
+
+def load_qrels(grade_field = 'relevance_score', years = None):
+    """
+    Returns {topic name: {nctid: grade}} read from Rating, with grade_field ('relevance_score' or 'total_score') as the grade.
+    """
+    ratings = Rating.objects.all()
+    if years is not None:
+        ratings = ratings.filter(topic__year__in = years)
+    qrels = defaultdict(dict)
+    for year, topic_no, nctid, grade in ratings.values_list('topic__year', 'topic__topic_no', 'document_id', grade_field).iterator():
+        qrels[topic_name(year, topic_no)][nctid] = grade
+    return qrels
+
+def load_topics(years = None):
+    topics = Topic.objects.order_by('year', 'topic_no')
+    if years is not None:
+        topics = topics.filter(year__in = years)
+    return list(topics)
+
+def gains(ranking, judgments):
+    """
+    Grades of a ranked list of nctids, NaN for unjudged documents.
+    """
+    return np.array([judgments.get(nctid, np.nan) for nctid in ranking], dtype = np.float64)
+
+def dcg(gains):
+    return float(np.sum(gains / np.log2(np.arange(2, len(gains) + 2)))) if len(gains) else 0.0
+
+def ndcg(gains, judgments, cutoff = None):
+    """
+    nDCG of a ranked list, normalized like trec_eval by the ideal ranking of all judged documents: a short list that misses relevant
+    documents scores below 1. With a cutoff, both the list and the ideal ranking are cut to its first cutoff documents.
+    """
+    ideal = np.sort(np.maximum(np.fromiter(judgments.values(), dtype = np.float64, count = len(judgments)), 0))[::-1]
+    if cutoff is not None:
+        gains, ideal = gains[:cutoff], ideal[:cutoff]
+    best = dcg(ideal)
+    return dcg(np.maximum(np.nan_to_num(gains), 0)) / best if best > 0 else 0.0
+
+def topic_measures(ranking, judgments, min_relevant = 1):
+    """
+    Measures of one ranked list of nctids. Unjudged documents count as non-relevant, except for infNDCG which, lacking the sampling
+    information needed for the real estimator, is computed as nDCG on the condensed list where unjudged documents are removed.
+    """
+    g = gains(ranking, judgments)
+    relevant = np.nan_to_num(g, nan = -np.inf) >= min_relevant
+    total_relevant = sum(1 for grade in judgments.values() if grade >= min_relevant)
+    if total_relevant:
+        precision_at_hits = np.cumsum(relevant)[relevant] / (np.flatnonzero(relevant) + 1)
+        average_precision = float(precision_at_hits.sum()) / total_relevant
+        r_precision = float(relevant[:total_relevant].sum()) / total_relevant
+    else:
+        average_precision = r_precision = 0.0
+    return {
+        'P@10': float(relevant[:10].sum()) / 10,
+        'nDCG': ndcg(g, judgments),
+        'infNDCG': ndcg(g[~np.isnan(g)], judgments),
+        'R-prec': r_precision,
+        'MAP': average_precision,
+    }
+
+###process pool
+#the ranking function is inherited by the forked workers instead of being pickled, so closures and loaded indexes can be used
+_rank_fn = None
+
+def _rank(topic, k):
+    ranking = _rank_fn(topic)[:k]
+    #rank functions may return nctids or (nctid, score) pairs
+    return [item[0] if isinstance(item, tuple) else item for item in ranking]
+
+def run_topics(rank_fn, topics, k = 1000, processes = None):
+    """
+    Returns {topic name: ranked nctids} with rank_fn(topic) applied to every Topic in a pool of forked processes (in this process when processes is 1).
+    """
+    global _rank_fn
+    _rank_fn = rank_fn
+    names = [topic_name(topic.year, topic.topic_no) for topic in topics]
+    if processes == 1:
+        return {name: _rank(topic, k) for name, topic in zip(names, tqdm(topics))}
+    from django.db import connections
+    #forked workers must open their own database connections
+    connections.close_all()
+    with ProcessPoolExecutor(processes, mp_context = multiprocessing.get_context('fork')) as pool:
+        rankings = list(tqdm(pool.map(_rank, topics, [k] * len(topics)), total = len(topics)))
+    return dict(zip(names, rankings))
+
+def evaluate(rank_fn, years = None, k = 1000, grade_field = 'relevance_score', min_relevant = 1, processes = None, qrels = None, topics = None):
+    """
+    Ranks every topic of years (all years by default) with rank_fn and scores the rankings against the Rating judgments.
+    Returns {'topics': {topic name: {measure: value}}, 'mean': {measure: value}}; topics without judgments are skipped.
+    qrels and topics can be passed to evaluate several ranking functions without reading them again.
+    """
+    if qrels is None:
+        qrels = load_qrels(grade_field, years)
+    if topics is None:
+        topics = load_topics(years)
+    topics = [topic for topic in topics if topic_name(topic.year, topic.topic_no) in qrels]
+    rankings = run_topics(rank_fn, topics, k, processes)
+    per_topic = {name: topic_measures(ranking, qrels[name], min_relevant) for name, ranking in rankings.items()}
+    mean = {measure: float(np.mean([values[measure] for values in per_topic.values()])) if per_topic else 0.0 for measure in MEASURES}
+    return {'topics': per_topic, 'mean': mean}
+
+def compare(rank_fns, years = None, k = 1000, grade_field = 'relevance_score', min_relevant = 1, processes = None):
+    """
+    Evaluates several ranking functions, given as {name: rank_fn}, on the same judgments. Returns {name: mean measures}.
+    """
+    qrels = load_qrels(grade_field, years)
+    topics = load_topics(years)
+    return {name: evaluate(rank_fn, years, k, grade_field, min_relevant, processes, qrels, topics)['mean'] for name, rank_fn in rank_fns.items()}
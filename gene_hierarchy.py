@@ -0,0 +1,118 @@
+import json
+
+#precomputed transitive closure of the Gene.family hierarchy. Genes are numbered in depth-first preorder, so the descendants
+#of a gene occupy the interval (pre, end] of that numbering: descendant checks are two comparisons and a subtree is a slice.
+
+class GeneHierarchy:
+    """
+    Interval labelling of the gene family forest.
+
+    Fields:
+    -----------
+        order - gene main labels in depth-first preorder
+
+        pre - position of every gene in order
+
+        end - position of the last descendant of every gene, indexed like order
+
+        parent - family of every gene after cycles were broken, None for roots
+
+        cycles - (gene, family) edges that closed a cycle in Gene.family and were ignored
+    """
+    def __init__(self, parent):
+        """
+        parent - {gene main label: family main label or None}
+        """
+        self.parent = dict(parent)
+        self.cycles = []
+        self.break_cycles()
+        children = {gene: [] for gene in self.parent}
+        roots = []
+        for gene, family in self.parent.items():
+            if family is None or family not in children:
+                self.parent[gene] = None
+                roots.append(gene)
+            else:
+                children[family].append(gene)
+        self.order = []
+        self.pre = {}
+        self.end = []
+        for root in sorted(roots):
+            stack = [(root, False)]
+            while stack:
+                gene, leaving = stack.pop()
+                if leaving:
+                    self.end[self.pre[gene]] = len(self.order) - 1
+                    continue
+                self.pre[gene] = len(self.order)
+                self.order.append(gene)
+                self.end.append(None)
+                stack.append((gene, True))
+                for child in sorted(children[gene], reverse = True):
+                    stack.append((child, False))
+
+    def break_cycles(self):
+        #walks up from every gene; meeting a gene of the current walk means a cycle, which is broken at the edge that closes it
+        state = {}
+        for start in self.parent:
+            path = []
+            gene = start
+            while gene is not None and gene in self.parent and gene not in state:
+                state[gene] = start
+                path.append(gene)
+                gene = self.parent[gene]
+            if gene is not None and state.get(gene) == start:
+                self.cycles.append((path[-1], gene))
+                self.parent[path[-1]] = None
+
+    @classmethod
+    def from_database(cls):
+        from model import Gene
+        return cls(dict(Gene.objects.values_list('main_label', 'family_id')))
+
+    def is_descendant(self, gene, ancestor):
+        """
+        True when gene is a (transitive, strict) descendant of ancestor.
+        """
+        i, j = self.pre.get(gene), self.pre.get(ancestor)
+        if i is None or j is None:
+            return False
+        return j < i <= self.end[j]
+
+    def is_ancestor(self, gene, descendant):
+        return self.is_descendant(descendant, gene)
+
+    def descendants(self, gene):
+        i = self.pre[gene]
+        return self.order[i + 1:self.end[i] + 1]
+
+    def subtree(self, gene):
+        """
+        The gene followed by all of its descendants.
+        """
+        i = self.pre[gene]
+        return self.order[i:self.end[i] + 1]
+
+    def ancestors(self, gene):
+        ancestors = []
+        gene = self.parent.get(gene)
+        while gene is not None:
+            ancestors.append(gene)
+            gene = self.parent[gene]
+        return ancestors
+
+    def save(self, path = 'gene_hierarchy.json'):
+        with open(path, 'w', encoding = 'utf-8') as f:
+            json.dump({'parent': self.parent, 'cycles': self.cycles, 'order': self.order, 'end': self.end}, f)
+
+    @classmethod
+    def load(cls, path = 'gene_hierarchy.json'):
+        with open(path, encoding = 'utf-8') as f:
+            stored = json.load(f)
+        hierarchy = cls.__new__(cls)
+        hierarchy.parent = stored['parent']
+        hierarchy.cycles = [tuple(edge) for edge in stored['cycles']]
+        hierarchy.order = stored['order']
+        hierarchy.end = stored['end']
+        hierarchy.pre = {gene: i for i, gene in enumerate(hierarchy.order)}
+        return hierarchy
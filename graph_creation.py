@@ -1,13 +1,32 @@
-from model import ClinicalTrial, Condition, Topic as DjangoTopic, Rating as DjangoRating, ConditionAnnotation, Gene as DjangoGene, GeneLabel, GeneAnnotation, GeneLink as GeneLinkDjango, Intervention, EntityLink as EntityLinkDjango, Entity, DrugLink as DrugLinkDjango, Drug as DjangoDrug, DrugName, DrugGeneLinkDetails
+from graph_data import DjangoDataSource
+from gene_hierarchy import GeneHierarchy
+from instrumentation import BuildReport
+from naming import ONTOLOGY_IRI, BASE_IRI, entity_name, gene_name, drug_name, topic_name, rating_name
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import tempfile
 import owlready2 as owl
-from tqdm import tqdm
 
 #the url for ontology eventually will be normalized with the purl IRI
 
-def create_empty_ontology() -> owl.Ontology:
-    return owl.get_ontology("http://temporary.org/IRclinicaltrials.owl")
-def create_graph():
-    ontology = create_empty_ontology()
+def create_empty_ontology(world = owl.default_world) -> owl.Ontology:
+    return world.get_ontology(ONTOLOGY_IRI)
+
+def resolve(index, key, report, kind):
+    """
+    Looks up a graph object in one of the IRI indexes built by GraphBuilder. Keys that are not in the index are recorded as anomalies of kind in report and None is returned.
+    """
+    found = index.get(key)
+    if found is None:
+        report.anomaly(kind, key)
+    return found
+
+def declare_schema(ontology):
+    """
+    Declares the static part of the T-Box in the ontology and creates the singleton intervention and study type individuals.
+    Returns two dictionaries: intervention types keyed by Intervention.type and study types keyed by ClinicalTrial.study_type.
+    """
     with ontology:
         ### entities
         class ClinicalTrialDocument(owl.Thing):
@@ -139,200 +158,10 @@ def create_graph():
             pass
         class ScientificName(owl.AnnotationProperty):
             pass
+        class hasExactSynonym(owl.AnnotationProperty):
+            pass
 
 
-        ### synthetic punning with singleton instances
-        #intervention types
-        procedure_it = Procedure()
-        drug_it = DrugIntervention()
-        biological_it = Biological()
-        other_it = Other()
-        behavioral_it = Behavioral()
-        radiation_it = Radiation()
-        genetic_it = Genetic()
-        device_it = Device()
-        diet_it = DietarySupplement()
-        comb_it = CombinationProduct()
-        test_it = DiagnosticTest()
-
-        #study types
-        informational_st = Informational()
-        observational_st = Observational()
-        ea_st = ExpandedAccess()
-        patient_st = PatientRegistry()
-
-        #relational objects
-        drugs = DjangoDrug.objects.all()
-        topics = DjangoTopic.objects.all()
-        genes = DjangoGene.objects.all()
-        ratings = DjangoRating.objects.all()
-        all_trials = ClinicalTrial.objects.all()
-        entities = Entity.objects.all()
-        #dynamically created A-Box (entities have to be loaded first)
-        #cross references (diseases) 
-        for i, entity in tqdm(enumerate(entities)):
-            url = entity.url.replace('#','')
-            cross_entity = CrossReferenceEntity(url)
-            cross_entity.label = entity.label
-            cross_entity.crossReferenceURI = [url]
-            cross_entity.hasText = [entity.label]
-        #dynamically created T-Box
-        #genes
-        for i,gene in enumerate(genes):
-            label = 'gene_' + gene.main_label.replace(' ','')
-            gene_class = owl.types.new_class(label, (Gene, ))
-            gene_class.label = gene.main_label
-            gene_class.hasExactSynonym = [synonym.text for synonym in GeneLabel.objects.filter(gene = gene)]
-        for gene in genes:
-            label = 'gene_' + gene.main_label.replace(' ','')
-            gene_class = ontology[label]
-            if gene.family:
-                superlabel = 'gene_' + gene.family.main_label.replace(' ','')
-                superclass = ontology[superlabel]
-                gene_class.is_a = [superclass]
-        #drugs
-        for i,drug in enumerate(drugs):
-            trade_names = []
-            generic_names = []
-            chemical_names = []
-            scientific_names = []
-            for drugName in DrugName.objects.filter(drug = drug):
-                
-                if drugName.type == 'T':
-                    trade_names.append(drugName.name)
-                if drugName.type == 'G':
-                    generic_names.append(drugName.name)
-                if drugName.type == 'C':
-                    chemical_names.append(drugName.name)
-                if drugName.type == 'S':
-                    scientific_names.append(drugName.name)
-            label = 'drug_' + str(drug).replace(' ','')
-            drug_class = owl.types.new_class(label, (Drug, ))
-            drug_class.GenericName = generic_names
-            drug_class.TradeName = trade_names
-            drug_class.ChemicalName = chemical_names
-            drug_class.ScientificName = scientific_names
-            drug_class.label = str(drug)
-
-            drug_class.targetsGene = [ontology['gene_'+gene_link.gene.main_label.replace(' ','')] for gene_link in DrugGeneLinkDetails.objects.filter(drug = drug)]
-            # print([ontology['gene_'+gene.main_label.replace(' ','')] for gene in drug.genes.all()])
-        ### dynamically created A-Box
-        #topics
-        for i, topic in tqdm(enumerate(topics)):
-            iri = str(topic.year) + '_' + str(topic.topic_no)
-            topic_entity = Topic(iri)
-            topic_entity.TopicDemography = [topic.demo]
-            topic_entity.TopicNumber = [topic.topic_no]
-            topic_entity.TopicYear = [topic.year]
-            topic_entity.TopicDisease = [topic.disease]
-            genes = DjangoGene.objects.filter(pk__in = topic.genes_mtm.all())
-            topic_entity.TopicGene = [ontology['gene_'+gene.main_label.replace(' ','')] for gene in genes]
-            url = topic.disease_fl.url.replace('#','')
-            topic_entity.EntityLink = ontology.search(iri = f'http://temporary.org/IRclinicaltrials.owl#{url}')
-
- 
-        #clinical trials
-        found_single_drug_link = False
-        found_single_gene_link = False
-        for i, trial in tqdm(enumerate(all_trials)):
-            #data properties
-            document = ClinicalTrialDocument(trial.nctid)
-            document.label = trial.nctid
-            document.BriefTitle = [trial.brief_title]
-            document.OfficialTitle = [trial.official_title]
-            document.Summary = [trial.summary]
-            document.Description = [trial.description]
-            document.Criteria = [trial.criteria]
-            document.minimumAge = [trial.min_age]
-            document.maximumAge = [trial.max_age]
-            document.gender = [trial.gender]
-            #object properties
-            #study type
-            if trial.study_type == 'Informational':
-                document.hasStudyTypeAssignment = [informational_st]
-            elif trial.study_type == 'Observational':
-                document.hasStudyTypeAssignment = [observational_st]
-            elif trial.study_type == 'Expanded Access':
-                document.hasStudyTypeAssignment = [ea_st]
-            elif trial.study_type == 'Observational [Patient Registry]':
-                document.hasStudyTypeAssignment = [patient_st]
-            else:
-                document.hasStudyTypeAssignment = [informational_st]
-
-            #interventions
-            interventions = Intervention.objects.filter(document = trial)
-            intervention_list = []
-            for j,intervention in enumerate(interventions) :
-                intervention_entity = InterventionTreatment()
-                if intervention.type == 'Procedure':
-                    intervention_entity.hasType = [procedure_it]
-                elif intervention.type == 'Drug':
-                    intervention_entity.hasType = [drug_it]
-                elif intervention.type == 'Biological':
-                    intervention_entity.hasType = [biological_it]
-                elif intervention.type == 'Other':
-                    intervention_entity.hasType = [other_it]
-                elif intervention.type == 'Behavioral':
-                    intervention_entity.hasType = [behavioral_it]
-                elif intervention.type == 'Radiation':
-                    intervention_entity.hasType = [radiation_it]
-                elif intervention.type == 'Genetic':
-                    intervention_entity.hasType = [genetic_it]
-                elif intervention.type == 'Device':
-                    intervention_entity.hasType = [device_it]
-                elif intervention.type == 'Dietary Supplement':
-                    intervention_entity.hasType = [diet_it]
-                elif intervention.type == 'Diagnostic Test':
-                    intervention_entity.hasType = [test_it]
-                elif intervention.type == 'Combination Product':
-                    intervention_entity.hasType = [comb_it]
-                else:
-                    print(intervention.type)
-                intervention_entity.hasText = [intervention.name]
-                intervention_entity.label = trial.nctid + 'INT' + str(j)
-                intervention_list.append(intervention_entity)
-            #diseases
-            conditions = Condition.objects.filter(document = trial)
-            condition_list = []
-            for j,condition in enumerate(conditions):
-                condition_entity = ConditionDisease()
-                condition_entity.label = trial.nctid + 'COND' + str(j)
-                condition_entity.hasText = [condition.text]
-                condition_list.append(condition_entity)
-                entity_links = EntityLinkDjango.objects.filter(condition=condition)
-                gene_links = GeneLinkDjango.objects.filter(condition=condition)
-                drug_links = DrugLinkDjango.objects.filter(condition=condition)
-                for link in entity_links:
-                    url = link.entity.url.replace('#','')
-                    entity = ontology.search(iri = f'http://temporary.org/IRclinicaltrials.owl#{url}')[0]
-                    condition_entity.EntityLink.append(entity)
-                for link in gene_links:
-                    gene = ontology['gene_' + link.gene.main_label.replace(' ','')]
-                    condition_entity.GeneLink.append(gene)
-                for link in drug_links:
-                    drug = ontology['drug_' + str(link.drug).replace(' ','')]
-                    condition_entity.GeneLink.append(drug)
-            #direct entity links
-            entity_links = EntityLinkDjango.objects.filter(document=trial)
-            gene_links = GeneLinkDjango.objects.filter(document=trial)
-            drug_links = DrugLinkDjango.objects.filter(document=trial)
-            for link in entity_links:
-                url = link.entity.url.replace('#','')
-                entity = ontology.search(iri = f'http://temporary.org/IRclinicaltrials.owl#{url}')[0]
-                document.EntityLink.append(entity)
-            for link in gene_links:
-                found_single_gene_link = True
-                gene = ontology['gene_' + link.gene.main_label.replace(' ','')]
-
-                document.GeneLink.append(gene)
-            for link in drug_links:
-                found_single_drug_link = True
-                drug = ontology['drug_' + str(link.drug).replace(' ','')]
-
-                document.DrugLink.append(drug)
-            document.hasPart = intervention_list + condition_list
-            # if found_single_gene_link and found_single_drug_link:
-            #     break
         class DiseaseScore(owl.DataProperty): pass
         class GeneScore(owl.DataProperty): pass
         class TreatmentScore(owl.DataProperty): pass
@@ -343,25 +172,390 @@ def create_graph():
         class TRECPMAnnotation(owl.DataProperty): pass
         class TopicConnection(owl.ObjectProperty): pass
         class DocumentConnection(owl.ObjectProperty): pass
-        for i, rating in tqdm(enumerate(ratings)):
-            rating_entity = Rating('RAT_'+str(rating.topic.year)+'_'+str(rating.topic.topic_no)+'_'+rating.document.nctid)
 
-            topic_iri = str(rating.topic.year) + '_' + str(rating.topic.topic_no)
-            document_iri = rating.document.nctid
-            rating_entity.TopicConnection = [ontology[topic_iri]]
-            rating_entity.DocumentConnection = [ontology[document_iri]]
+        ### synthetic punning with singleton instances
+        #the singletons carry the names owlready2 would generate, so declaring the schema again on a loaded graph reuses them
+        #intervention types
+        intervention_types = {
+            'Procedure': Procedure('procedure1'),
+            'Drug': DrugIntervention('drugintervention1'),
+            'Biological': Biological('biological1'),
+            'Other': Other('other1'),
+            'Behavioral': Behavioral('behavioral1'),
+            'Radiation': Radiation('radiation1'),
+            'Genetic': Genetic('genetic1'),
+            'Device': Device('device1'),
+            'Dietary Supplement': DietarySupplement('dietarysupplement1'),
+            'Combination Product': CombinationProduct('combinationproduct1'),
+            'Diagnostic Test': DiagnosticTest('diagnostictest1'),
+        }
+        #study types
+        study_types = {
+            'Informational': Informational('informational1'),
+            'Observational': Observational('observational1'),
+            'Expanded Access': ExpandedAccess('expandedaccess1'),
+            'Observational [Patient Registry]': PatientRegistry('patientregistry1'),
+        }
+    return intervention_types, study_types
+
+class GraphBuilder:
+    """
+    Builds the knowledge graph from the relational data loaded by graph_data: load_graph_data, or load_shared_data with the trial tables
+    replaced page by page while the trials are streamed (stream_trials).
+
+    The shared part of the graph (schema, cross reference entities, gene and drug classes, topics) always goes to the T-Box ontology.
+    Trials and ratings go to namespace, which is the T-Box ontology itself in a serial build and a separate shard ontology
+    (with the same base IRI) in a parallel one, so both kinds of build produce the same IRIs.
+    Phases, progress and data anomalies are recorded in report, an instrumentation.BuildReport.
+    """
+    def __init__(self, ontology, data, namespace = None, report = None):
+        self.ontology = ontology
+        self.data = data
+        self.namespace = namespace if namespace is not None else ontology
+        self.intervention_types, self.study_types = declare_schema(ontology)
+        #IRI indexes, keyed by the normalized entity url, the gene main label and the drug primary key
+        self.entity_index = {}
+        self.gene_index = {}
+        self.drug_index = {}
+        self.report = report if report is not None else BuildReport()
+
+    def build_shared(self, progress = True):
+        self.build_entities(progress)
+        self.build_genes(progress)
+        self.build_drugs(progress)
+        self.build_topics(progress)
+
+    def build_entities(self, progress = True):
+        ontology = self.ontology
+        #dynamically created A-Box (entities have to be loaded first)
+        #cross references (diseases) 
+        with self.report.phase('entities', len(self.data.entities), progress) as phase, ontology:
+            for i, entity in enumerate(self.data.entities):
+                url = entity_name(entity['url'])
+                cross_entity = ontology.CrossReferenceEntity(url)
+                cross_entity.label = entity['label']
+                cross_entity.crossReferenceURI = [url]
+                cross_entity.hasText = [entity['label']]
+                self.entity_index[url] = cross_entity
+                phase.update()
+
+    def build_genes(self, progress = True):
+        #dynamically created T-Box
+        #genes
+        with self.report.phase('genes', len(self.data.genes), progress) as phase, self.ontology:
+            for i,gene in enumerate(self.data.genes):
+                label = gene_name(gene['main_label'])
+                gene_class = owl.types.new_class(label, (self.ontology.Gene, ))
+                gene_class.label = gene['main_label']
+                gene_class.hasExactSynonym = [synonym['text'] for synonym in self.data.gene_labels.get(gene['main_label'], [])]
+                self.gene_index[gene['main_label']] = gene_class
+                phase.update()
+            #free-form family data may contain cycles, which would make the class hierarchy cyclic
+            hierarchy = GeneHierarchy({gene['main_label']: gene['family_id'] for gene in self.data.genes})
+            for edge in hierarchy.cycles:
+                self.report.anomaly('broken_gene_family_cycle', edge)
+            for gene in self.data.genes:
+                gene_class = self.gene_index[gene['main_label']]
+                if gene['family_id'] and (gene['main_label'], gene['family_id']) not in hierarchy.cycles:
+                    superclass = resolve(self.gene_index, gene['family_id'], self.report, 'unresolved_gene')
+                    if superclass is not None:
+                        gene_class.is_a = [superclass]
+
+    def build_drugs(self, progress = True):
+        data = self.data
+        with self.report.phase('drugs', len(data.drugs), progress) as phase, self.ontology:
+            for i,drug in enumerate(data.drugs):
+                trade_names = []
+                generic_names = []
+                chemical_names = []
+                scientific_names = []
+                for drugName in data.drug_names.get(drug, []):
+                    
+                    if drugName['type'] == 'T':
+                        trade_names.append(drugName['name'])
+                    if drugName['type'] == 'G':
+                        generic_names.append(drugName['name'])
+                    if drugName['type'] == 'C':
+                        chemical_names.append(drugName['name'])
+                    if drugName['type'] == 'S':
+                        scientific_names.append(drugName['name'])
+                label = drug_name(data.drug_labels[drug])
+                drug_class = owl.types.new_class(label, (self.ontology.Drug, ))
+                drug_class.GenericName = generic_names
+                drug_class.TradeName = trade_names
+                drug_class.ChemicalName = chemical_names
+                drug_class.ScientificName = scientific_names
+                drug_class.label = data.drug_labels[drug]
+
+                drug_class.targetsGene = [gene for gene in (resolve(self.gene_index, gene_link['gene_id'], self.report, 'unresolved_gene') for gene_link in data.drug_targets.get(drug, [])) if gene is not None]
+                self.drug_index[drug] = drug_class
+                phase.update()
+
+    def build_topics(self, progress = True):
+        ### dynamically created A-Box
+        #topics
+        with self.report.phase('topics', len(self.data.topics), progress) as phase, self.ontology:
+            for i, topic in enumerate(self.data.topics):
+                self.build_topic(topic)
+                phase.update()
+
+    def build_topic(self, topic):
+        iri = topic_name(topic['year'], topic['topic_no'])
+        topic_entity = self.ontology.Topic(iri)
+        topic_entity.TopicDemography = [topic['demo']]
+        topic_entity.TopicNumber = [topic['topic_no']]
+        topic_entity.TopicYear = [topic['year']]
+        topic_entity.TopicDisease = [topic['disease']]
+        topic_entity.TopicGene = [gene for gene in (resolve(self.gene_index, gene['gene_id'], self.report, 'unresolved_gene') for gene in self.data.topic_genes.get(topic['pk'], [])) if gene is not None]
+        if topic['disease_fl__url'] is not None:
+            disease = resolve(self.entity_index, entity_name(topic['disease_fl__url']), self.report, 'unresolved_entity')
+            topic_entity.EntityLink = [disease] if disease is not None else []
+        return topic_entity
+
+    def build_trials(self, trials, progress = True, total = None):
+        """
+        Builds trials, an iterable of ClinicalTrial objects. The length of the progress bar is total, by default len(trials) or trials.count() for a queryset.
+        """
+        if total is None:
+            total = trials.count() if hasattr(trials, 'count') and not isinstance(trials, list) else len(trials)
+        with self.report.phase('trials', total, progress) as phase, self.namespace:
+            for i, trial in enumerate(trials):
+                self.build_trial(trial)
+                phase.update()
+
+    def build_trial(self, trial):
+        ontology = self.ontology
+        data = self.data
+        #data properties
+        document = ontology.ClinicalTrialDocument(trial.nctid)
+        document.label = trial.nctid
+        document.BriefTitle = [trial.brief_title]
+        document.OfficialTitle = [trial.official_title]
+        document.Summary = [trial.summary]
+        document.Description = [trial.description]
+        document.Criteria = [trial.criteria]
+        document.minimumAge = [trial.min_age]
+        document.maximumAge = [trial.max_age]
+        document.gender = [trial.gender]
+        #object properties
+        #study type
+        document.hasStudyTypeAssignment = [self.study_types.get(trial.study_type, self.study_types['Informational'])]
+
+        #interventions
+        intervention_list = []
+        for j,intervention in enumerate(data.interventions.get(trial.nctid, [])):
+            #parts are named after the trial, so that every shard of a parallel build names them the same way
+            intervention_entity = ontology.InterventionTreatment(trial.nctid + 'INT' + str(j))
+            if intervention['type'] in self.intervention_types:
+                intervention_entity.hasType = [self.intervention_types[intervention['type']]]
+            else:
+                self.report.anomaly('unknown_intervention_type', intervention['type'])
+            intervention_entity.hasText = [intervention['name']]
+            intervention_entity.label = trial.nctid + 'INT' + str(j)
+            intervention_list.append(intervention_entity)
+        #diseases
+        condition_list = []
+        for j,condition in enumerate(data.conditions.get(trial.nctid, [])):
+            condition_entity = ontology.ConditionDisease(trial.nctid + 'COND' + str(j))
+            condition_entity.label = trial.nctid + 'COND' + str(j)
+            condition_entity.hasText = [condition['text']]
+            condition_list.append(condition_entity)
+            self.add_links(condition_entity, condition_entity.GeneLink, 'condition', condition['pk'])
+        #direct entity links
+        self.add_links(document, document.DrugLink, 'document', trial.nctid)
+        document.hasPart = intervention_list + condition_list
+
+    def add_links(self, subject, drug_links, grouping, key):
+        #drug links of conditions have always been stored under GeneLink, hence the explicit target list
+        for link in self.data.entity_links[grouping].get(key, []):
+            entity = resolve(self.entity_index, entity_name(link['entity__url']), self.report, 'unresolved_entity')
+            if entity is not None:
+                subject.EntityLink.append(entity)
+        for link in self.data.gene_links[grouping].get(key, []):
+            gene = resolve(self.gene_index, link['gene_id'], self.report, 'unresolved_gene')
+            if gene is not None:
+                subject.GeneLink.append(gene)
+        for link in self.data.drug_links[grouping].get(key, []):
+            drug = resolve(self.drug_index, link['drug_id'], self.report, 'unresolved_drug')
+            if drug is not None:
+                drug_links.append(drug)
+
+    def build_ratings(self, progress = True, ratings = None, total = None):
+        """
+        Builds ratings, an iterable of Rating rows (RATING_FIELDS), by default the ratings of data. The length of the progress bar is total, by default len(ratings).
+        """
+        if ratings is None:
+            ratings = self.data.ratings
+        if total is None:
+            total = len(ratings)
+        with self.report.phase('ratings', total, progress) as phase, self.namespace:
+            for i, rating in enumerate(ratings):
+                self.build_rating(rating)
+                phase.update()
+
+    def build_rating(self, rating):
+        ontology = self.ontology
+        rating_entity = ontology.Rating(rating_name(rating['topic__year'], rating['topic__topic_no'], rating['document_id']))
+
+        topic_iri = topic_name(rating['topic__year'], rating['topic__topic_no'])
+        document_iri = rating['document_id']
+        rating_entity.TopicConnection = [ontology[topic_iri]]
+        rating_entity.DocumentConnection = [ontology[document_iri]]
+
+        rating_entity.DiseaseScore = [rating['disease_score']]
+        rating_entity.GeneScore = [rating['gene_score']]
+        rating_entity.TreatmentScore = [rating['treatment_score']]
+        rating_entity.DemographyScore = [rating['demography_score']]
+
+        rating_entity.TRECGeneAnnotation = [rating['pm_gene1_annotation_desc'],rating['pm_gene2_annotation_desc'],rating['pm_gene3_annotation_desc']]
+        rating_entity.TRECDiseaseAnnotation = [rating['pm_disease_desc']]
+        rating_entity.TRECDemographyAnnotation = [rating['pm_demo_desc']]
+        rating_entity.TRECPMAnnotation = [rating['pm_rel_desc']]
+        return rating_entity
+
+    def index_existing(self):
+        """
+        Fills the IRI indexes from an ontology that already contains the shared part of the graph, e.g. one loaded from a previous build.
+        """
+        for entity in self.data.entities:
+            url = entity_name(entity['url'])
+            if self.ontology[url] is not None:
+                self.entity_index[url] = self.ontology[url]
+        for gene in self.data.genes:
+            if self.ontology[gene_name(gene['main_label'])] is not None:
+                self.gene_index[gene['main_label']] = self.ontology[gene_name(gene['main_label'])]
+        for drug in self.data.drugs:
+            if self.ontology[drug_name(self.data.drug_labels[drug])] is not None:
+                self.drug_index[drug] = self.ontology[drug_name(self.data.drug_labels[drug])]
+
+def create_world(world_path = None):
+    """
+    Returns the world the graph is built in: the default in-memory world, or a new persistent world stored in the SQLite file world_path
+    (an existing file is replaced).
+    """
+    if world_path is None:
+        return owl.default_world
+    if os.path.exists(world_path):
+        os.remove(world_path)
+    return owl.World(filename = world_path)
+
+def open_graph(world_path = 'clinicalTrialsForIR.sqlite3') -> owl.Ontology:
+    """
+    Opens a graph saved by create_graph(world_path = ...) in read-only mode. Nothing is parsed: owlready2 loads entities from the
+    SQLite quadstore on demand, so opening takes the same time for every graph size and several processes can share the file.
+    """
+    if not os.path.exists(world_path):
+        raise FileNotFoundError(world_path)
+    world = owl.World(filename = world_path, exclusive = False, read_only = True)
+    return create_empty_ontology(world)
 
-            rating_entity.DiseaseScore = [rating.disease_score]
-            rating_entity.GeneScore = [rating.gene_score]
-            rating_entity.TreatmentScore = [rating.treatment_score]
-            rating_entity.DemographyScore = [rating.demography_score]
+def create_graph(processes = None, shards = None, output = 'clinicalTrialsForIR.owl', output_format = 'rdfxml', world_path = None, report = None, source = None):
+    """
+    Builds the knowledge graph and saves it to output (skipped when output is None).
+    The time, queries and memory of every phase and the data anomalies are recorded in report (an instrumentation.BuildReport),
+    whose summary is printed at the end.
 
-            rating_entity.TRECGeneAnnotation = [rating.pm_gene1_annotation_desc,rating.pm_gene2_annotation_desc,rating.pm_gene3_annotation_desc]
-            rating_entity.TRECDiseaseAnnotation = [rating.pm_disease_desc]
-            rating_entity.TRECDemographyAnnotation = [rating.pm_demo_desc]
-            rating_entity.TRECPMAnnotation = [rating.pm_rel_desc]
+    With processes greater than one the trials are split into NCTID ranges (by default four per process) and the A-Box of every range
+    is built by a worker process in its own owlready2 world, see create_graph_parallel.
+    With world_path the graph is built in a persistent owlready2 world stored in that SQLite file, which is closed after the build
+    and reopened with open_graph without re-parsing.
+    The relational data is read from source, by default the database (graph_data.DjangoDataSource); a parquet_snapshot.ParquetDataSource
+    builds the graph from a snapshot without a database connection.
+    """
+    if source is None:
+        source = DjangoDataSource()
+    if report is None:
+        report = BuildReport(count_queries = isinstance(source, DjangoDataSource))
+    if processes is not None and processes > 1:
+        return create_graph_parallel(processes, shards or processes * 4, output, output_format, world_path, report, source)
+    world = create_world(world_path)
+    ontology = create_empty_ontology(world)
+    with report.phase('load'):
+        data = source.load_shared_data()
+    builder = GraphBuilder(ontology, data, report = report)
+    builder.build_shared()
+    #clinical trials, streamed page by page with the tables of the page
+    builder.build_trials(source.stream_trials(data), total = source.count_trials())
+    builder.build_ratings(ratings = source.stream_ratings(), total = source.count_ratings())
+    with report.phase('save'):
+        if output is not None:
+            ontology.save(output, format = output_format)
+        if world_path is not None:
+            world.save()
+            world.close()
+    print(report.summary())
+    return ontology
 
-            
-    ontology.save('clinicalTrialsForIR.owl')
+def build_shard(shard_no, first_nctid, last_nctid, directory, source):
+    """
+    Worker of the parallel build. Builds the trials and ratings of one NCTID range in a fresh world and writes them as N-Triples.
+    The shared part of the graph is built as well, because the A-Box links to it, but it is not written.
+    Returns the path of the N-Triples file and the report of the shard (as a dictionary).
+    """
+    world = owl.World()
+    ontology = create_empty_ontology(world)
+    shard = world.get_ontology(f'{ONTOLOGY_IRI}/shard{shard_no}')
+    report = BuildReport(progress = False, count_queries = isinstance(source, DjangoDataSource))
+    with report.phase('load'):
+        data = source.load_shared_data()
+    #the anomalies of the shared part are reported by the main process
+    builder = GraphBuilder(ontology, data, shard.get_namespace(BASE_IRI), BuildReport(progress = False, count_queries = False))
+    builder.build_shared(progress = False)
+    builder.report = report
+    builder.build_trials(source.stream_trials(data, first_nctid = first_nctid, last_nctid = last_nctid), progress = False, total = source.count_trials(first_nctid, last_nctid))
+    builder.build_ratings(progress = False, ratings = source.stream_ratings(first_nctid = first_nctid, last_nctid = last_nctid), total = source.count_ratings(first_nctid, last_nctid))
+    path = os.path.join(directory, f'shard{shard_no}.nt')
+    with report.phase('save'):
+        shard.save(path, format = 'ntriples')
+    return path, report.to_dict()
 
-    
\ No newline at end of file
+def create_graph_parallel(processes, shards, output = 'clinicalTrialsForIR.owl', output_format = 'rdfxml', world_path = None, report = None, source = None):
+    """
+    Parallel version of create_graph. Every NCTID range is built by build_shard in a process pool, the shared T-Box is built
+    in this process, and the N-Triples of all of them are concatenated into one graph. The result contains the same triples
+    as a serial build; with output_format 'rdfxml' or a world_path it is re-read by owlready2 and saved in the same way as by create_graph.
+    """
+    if source is None:
+        source = DjangoDataSource()
+    if report is None:
+        report = BuildReport(count_queries = isinstance(source, DjangoDataSource))
+    ranges = source.shard_ranges(shards)
+    with tempfile.TemporaryDirectory() as directory:
+        if isinstance(source, DjangoDataSource):
+            #forked workers must open their own database connections
+            from django.db import connections
+            connections.close_all()
+        with ProcessPoolExecutor(processes, mp_context = multiprocessing.get_context('fork')) as pool:
+            futures = [pool.submit(build_shard, shard_no, first, last, directory, source) for shard_no, (first, last) in enumerate(ranges)]
+            world = owl.World()
+            ontology = create_empty_ontology(world)
+            with report.phase('load'):
+                data = source.load_shared_data()
+            builder = GraphBuilder(ontology, data, report = report)
+            builder.build_shared()
+            merged = output if output_format == 'ntriples' and output is not None else os.path.join(directory, 'merged.nt')
+            ontology.save(merged, format = 'ntriples')
+            with report.phase('shards', len(futures)) as phase, open(merged, 'a', encoding = 'utf-8') as out:
+                for shard_no, future in enumerate(futures):
+                    path, shard_report = future.result()
+                    report.merge(shard_report, f'shard{shard_no}/')
+                    with open(path, encoding = 'utf-8') as shard:
+                        for line in shard:
+                            #the shard ontologies only exist to separate the A-Box from the shared part
+                            if not line.startswith(f'<{ONTOLOGY_IRI}/shard'):
+                                out.write(line)
+                    phase.update()
+        if output_format == 'ntriples' and world_path is None:
+            print(report.summary())
+            return output
+        world = create_world(world_path) if world_path is not None else owl.World()
+        with report.phase('reload'), open(merged, 'rb') as f:
+            ontology = create_empty_ontology(world).load(fileobj = f)
+        with report.phase('save'):
+            if output is not None and output_format != 'ntriples':
+                ontology.save(output, format = output_format)
+            if world_path is not None:
+                world.save()
+                world.close()
+        print(report.summary())
+        return output
@@ -0,0 +1,221 @@
+from collections import defaultdict
+from string_table import intern_columns
+from naming import choose_drug_name
+
+#loader stage of the graph build: every table is read with a single query and the rows are grouped
+#in memory by foreign key, so the number of queries does not depend on the size of the corpus. The models are imported by the functions
+#reading them, so that the other data sources (parquet_snapshot) can use the structures of this module without Django
+
+RATING_FIELDS = ('document_id', 'topic_id', 'topic__year', 'topic__topic_no', 'disease_score', 'gene_score', 'treatment_score', 'demography_score',
+                 'relevance_score', 'total_score',
+                 'pm_gene1_annotation_desc', 'pm_gene2_annotation_desc', 'pm_gene3_annotation_desc', 'pm_disease_desc', 'pm_demo_desc', 'pm_rel_desc')
+#text columns whose values repeat a lot, interned when they are loaded
+RATING_TEXT_FIELDS = ('pm_gene1_annotation_desc', 'pm_gene2_annotation_desc', 'pm_gene3_annotation_desc', 'pm_disease_desc', 'pm_demo_desc', 'pm_rel_desc')
+#columns of ClinicalTrial used by the graph
+TRIAL_FIELDS = ('nctid', 'brief_title', 'official_title', 'summary', 'description', 'criteria', 'min_age', 'max_age', 'gender', 'study_type')
+
+def group_by(rows, key):
+    """
+    Groups an iterable of value dictionaries by the value stored under key. Rows with an empty key are skipped.
+    """
+    groups = defaultdict(list)
+    for row in rows:
+        if row[key] is not None:
+            groups[row[key]].append(row)
+    return groups
+
+class GraphData:
+    """
+    Relational data needed by create_graph, grouped by foreign key.
+
+    Fields:
+    -----------
+        entities - list of Entity rows (url, label)
+
+        genes - list of Gene rows (main_label, family_id)
+
+        gene_labels - GeneLabel rows grouped by gene
+
+        drugs - list of Drug primary keys
+
+        drug_names - DrugName rows grouped by drug
+
+        drug_labels - display name of every drug, keyed by drug primary key
+
+        drug_targets - DrugGeneLinkDetails rows grouped by drug
+
+        topics - list of Topic rows, the url of the linked disease is stored under disease_fl__url
+
+        topic_genes - Topic.genes_mtm rows grouped by topic
+
+        interventions, conditions - rows grouped by trial
+
+        entity_links, gene_links, drug_links - dictionaries with two groupings of the link rows, by 'document' and by 'condition'
+
+        ratings - list of Rating rows with the topic year and number already joined
+    """
+    pass
+
+def trial_range(field, first_nctid, last_nctid):
+    """
+    Returns filter arguments restricting field (a path to ClinicalTrial.nctid) to an inclusive NCTID range; None leaves a side open.
+    """
+    filters = {}
+    if first_nctid is not None:
+        filters[field + '__gte'] = first_nctid
+    if last_nctid is not None:
+        filters[field + '__lte'] = last_nctid
+    return filters
+
+def link_queries(model, target, document_filter):
+    """
+    The queries load_links runs: one per foreign key, the links of the trials and the links of their conditions (without those already
+    matched by the trial), so that each is answered with the index on its key instead of scanning the link table for an OR across the join.
+    """
+    from model import Condition
+    rows = model.objects.values('pk', 'document_id', 'condition_id', target)
+    conditions = Condition.objects.filter(**document_filter).values('pk')
+    return [rows.filter(**document_filter), rows.filter(condition_id__in = conditions).exclude(**document_filter)]
+
+def load_links(model, target, document_filter):
+    if document_filter:
+        rows = sorted((row for query in link_queries(model, target, document_filter) for row in query), key = lambda row: row['pk'])
+    else:
+        rows = list(model.objects.values('pk', 'document_id', 'condition_id', target).order_by('pk'))
+    for row in rows:
+        del row['pk']
+    rows = intern_columns(rows, [target])
+    return {'document': group_by(rows, 'document_id'), 'condition': group_by(rows, 'condition_id')}
+
+def load_shared_data() -> GraphData:
+    """
+    Loads the tables that do not depend on the trials: entities, genes, drugs and topics. The trial tables are left empty.
+    """
+    from model import Entity, Gene, GeneLabel, Drug, DrugName, DrugGeneLinkDetails, Topic
+    data = GraphData()
+    data.entities = list(Entity.objects.values('url', 'label').order_by('pk'))
+    data.genes = list(Gene.objects.values('main_label', 'family_id').order_by('pk'))
+    data.gene_labels = group_by(GeneLabel.objects.values('gene_id', 'text').order_by('pk'), 'gene_id')
+    data.drugs = list(Drug.objects.order_by('pk').values_list('pk', flat=True))
+    data.drug_names = group_by(DrugName.objects.values('drug_id', 'type', 'name').order_by('pk'), 'drug_id')
+    data.drug_labels = {drug_id: choose_drug_name(drug_id, [(name['type'], name['name']) for name in data.drug_names.get(drug_id, [])]) for drug_id in data.drugs}
+    data.drug_targets = group_by(DrugGeneLinkDetails.objects.values('drug_id', 'gene_id', 'impact').order_by('pk'), 'drug_id')
+    data.topics = list(Topic.objects.values('pk', 'year', 'topic_no', 'demo', 'disease', 'disease_fl__url').order_by('pk'))
+    data.topic_genes = group_by(Topic.genes_mtm.through.objects.values('topic_id', 'gene_id').order_by('pk'), 'topic_id')
+    data.interventions, data.conditions, data.ratings = {}, {}, []
+    data.entity_links = data.gene_links = data.drug_links = {'document': {}, 'condition': {}}
+    return data
+
+def load_trial_data(data, document_filter, ratings = True):
+    """
+    Replaces the trial tables of data (interventions, conditions, links and, unless ratings is False, ratings) with the rows matching document_filter,
+    a dictionary of filter arguments on document_id, e.g. {'document_id__in': nctids}. An empty filter loads every trial.
+    """
+    from model import Intervention, Condition, EntityLink, GeneLink, DrugLink, Rating
+    data.interventions = group_by(intern_columns(Intervention.objects.filter(**document_filter).values('document_id', 'type', 'name').order_by('pk'), ('type', 'name')), 'document_id')
+    data.conditions = group_by(intern_columns(Condition.objects.filter(**document_filter).values('pk', 'document_id', 'text').order_by('pk'), ('text',)), 'document_id')
+    data.entity_links = load_links(EntityLink, 'entity__url', document_filter)
+    data.gene_links = load_links(GeneLink, 'gene_id', document_filter)
+    data.drug_links = load_links(DrugLink, 'drug_id', document_filter)
+    data.ratings = intern_columns(list(Rating.objects.filter(**document_filter).values(*RATING_FIELDS).order_by('pk')), RATING_TEXT_FIELDS) if ratings else []
+    return data
+
+def load_graph_data(first_nctid = None, last_nctid = None, trials = True) -> GraphData:
+    """
+    Loads the data needed by the graph builder. The tables describing trials (interventions, conditions, links and ratings) can be restricted
+    to an inclusive NCTID range, which is how the shards of a parallel build load their part of the corpus, or skipped altogether with trials set to False.
+    Large builds should load the shared data only and stream the trials with iter_trial_chunks.
+    """
+    data = load_shared_data()
+    if trials:
+        load_trial_data(data, trial_range('document_id', first_nctid, last_nctid))
+    return data
+
+###streaming access
+#the trial and rating tables are read in pages with keyset pagination, only with the columns the graph needs,
+#so the memory used on the database side of a build depends on the page size and not on the corpus
+
+def iter_trial_chunks(data, chunk_size = 1000, after_nctid = None, first_nctid = None, last_nctid = None, fields = TRIAL_FIELDS, ratings = True):
+    """
+    Generator over the trials of an inclusive NCTID range (all by default) in NCTID order, in pages of chunk_size, starting after after_nctid if given.
+    Only fields are fetched. Before a page is yielded the trial tables of data are replaced with the rows of that page only (see load_trial_data).
+    """
+    last_page_nctid = after_nctid
+    while True:
+        trials = iter_trials(first_nctid, last_nctid).only(*fields)
+        if last_page_nctid is not None:
+            trials = trials.filter(nctid__gt = last_page_nctid)
+        trials = list(trials[:chunk_size])
+        if not trials:
+            return
+        last_page_nctid = trials[-1].nctid
+        load_trial_data(data, {'document_id__in': [trial.nctid for trial in trials]}, ratings)
+        yield trials
+
+def stream_trials(data, chunk_size = 1000, first_nctid = None, last_nctid = None):
+    """
+    The trials of iter_trial_chunks one by one, without ratings; data holds the tables of the page of the current trial.
+    """
+    for trials in iter_trial_chunks(data, chunk_size, first_nctid = first_nctid, last_nctid = last_nctid, ratings = False):
+        yield from trials
+
+def iter_trials(first_nctid = None, last_nctid = None):
+    from model import ClinicalTrial
+    return ClinicalTrial.objects.filter(**trial_range('nctid', first_nctid, last_nctid)).order_by('nctid')
+
+def iter_rating_chunks(chunk_size = 1000, after_pk = None, first_nctid = None, last_nctid = None):
+    """
+    Generator over the Rating rows (RATING_FIELDS and pk) of the trials of an inclusive NCTID range in primary key order, in pages of chunk_size,
+    starting after the rating after_pk if given.
+    """
+    from model import Rating
+    last_pk = after_pk
+    while True:
+        ratings = Rating.objects.filter(**trial_range('document_id', first_nctid, last_nctid)).order_by('pk')
+        if last_pk is not None:
+            ratings = ratings.filter(pk__gt = last_pk)
+        ratings = intern_columns(list(ratings.values('pk', *RATING_FIELDS)[:chunk_size]), RATING_TEXT_FIELDS)
+        if not ratings:
+            return
+        last_pk = ratings[-1]['pk']
+        yield ratings
+
+def stream_ratings(chunk_size = 1000, first_nctid = None, last_nctid = None):
+    for ratings in iter_rating_chunks(chunk_size, first_nctid = first_nctid, last_nctid = last_nctid):
+        yield from ratings
+
+def count_trials(first_nctid = None, last_nctid = None):
+    return iter_trials(first_nctid, last_nctid).count()
+
+def count_ratings(first_nctid = None, last_nctid = None):
+    from model import Rating
+    return Rating.objects.filter(**trial_range('document_id', first_nctid, last_nctid)).count()
+
+def shard_ranges(shards):
+    """
+    Splits the trials into at most shards inclusive NCTID ranges of (nearly) equal size.
+    """
+    from model import ClinicalTrial
+    nctids = list(ClinicalTrial.objects.order_by('nctid').values_list('nctid', flat=True))
+    size = -(-len(nctids) // shards) if nctids else 1
+    return [(nctids[i], nctids[min(i + size, len(nctids)) - 1]) for i in range(0, len(nctids), size)]
+
+class DjangoDataSource:
+    """
+    Data source of the graph build reading the database through the ORM. Other sources (parquet_snapshot.ParquetDataSource)
+    provide the same functions, so create_graph and the exporters can read from any of them.
+    """
+    load_shared_data = staticmethod(load_shared_data)
+    load_trial_data = staticmethod(load_trial_data)
+    load_graph_data = staticmethod(load_graph_data)
+    iter_trial_chunks = staticmethod(iter_trial_chunks)
+    stream_trials = staticmethod(stream_trials)
+    iter_rating_chunks = staticmethod(iter_rating_chunks)
+    stream_ratings = staticmethod(stream_ratings)
+    count_trials = staticmethod(count_trials)
+    count_ratings = staticmethod(count_ratings)
+    shard_ranges = staticmethod(shard_ranges)
+
+    def trial_ids(self):
+        from model import ClinicalTrial
+        return list(ClinicalTrial.objects.order_by('nctid').values_list('nctid', flat=True))
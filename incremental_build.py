@@ -0,0 +1,131 @@
+from graph_creation import GraphBuilder, create_graph, create_empty_ontology
+from graph_data import TRIAL_FIELDS, load_shared_data, load_trial_data, iter_trial_chunks, iter_trials
+from naming import topic_name, rating_name
+import hashlib
+import json
+import os
+import owlready2 as owl
+from tqdm import tqdm
+
+#incremental rebuild of the knowledge graph: a manifest written next to the graph stores a content hash of every trial, topic and rating,
+#and update_graph only destroys and rebuilds the individuals whose hash changed. The schema has no modification timestamps,
+#so the rows are still read to compute the hashes, but the (much more expensive) graph work is proportional to the delta. The trial tables are
+#read in pages with graph_data.iter_trial_chunks for the hashes; the trials and ratings to rebuild are then loaded by NCTID.
+
+def content_hash(*values) -> str:
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+def manifest_path(output):
+    return output + '.manifest.json'
+
+def shared_hash(data):
+    """
+    Hash of the tables making up the shared part of the graph (entities, genes, drugs). A change there invalidates the whole graph.
+    """
+    return content_hash(data.entities, data.genes, sorted(data.gene_labels.items()), data.drugs,
+                        sorted(data.drug_names.items()), sorted(data.drug_targets.items()))
+
+def trial_hash(trial, data):
+    conditions = data.conditions.get(trial.nctid, [])
+    return content_hash([getattr(trial, field) for field in TRIAL_FIELDS],
+                        data.interventions.get(trial.nctid, []),
+                        [(condition, [data.entity_links['condition'].get(condition['pk'], []), data.gene_links['condition'].get(condition['pk'], []), data.drug_links['condition'].get(condition['pk'], [])]) for condition in conditions],
+                        [data.entity_links['document'].get(trial.nctid, []), data.gene_links['document'].get(trial.nctid, []), data.drug_links['document'].get(trial.nctid, [])])
+
+def topic_hash(topic, data):
+    return content_hash(topic, data.topic_genes.get(topic['pk'], []))
+
+def build_manifest(data, chunks):
+    """
+    Computes the manifest of the current database state from chunks, the pages of graph_data.iter_trial_chunks which load the trial tables
+    of every page into data. Returns the manifest and the topic name and NCTID of every rating, keyed by rating name.
+    """
+    manifest = {'shared': shared_hash(data), 'trials': {}, 'topics': {}, 'ratings': {}}
+    rating_keys = {}
+    for trials in chunks:
+        for trial in trials:
+            manifest['trials'][trial.nctid] = trial_hash(trial, data)
+        for rating in data.ratings:
+            name = rating_name(rating['topic__year'], rating['topic__topic_no'], rating['document_id'])
+            manifest['ratings'][name] = content_hash(rating)
+            rating_keys[name] = (topic_name(rating['topic__year'], rating['topic__topic_no']), rating['document_id'])
+    for topic in data.topics:
+        manifest['topics'][topic_name(topic['year'], topic['topic_no'])] = topic_hash(topic, data)
+    return manifest, rating_keys
+
+def write_manifest(manifest, output):
+    with open(manifest_path(output), 'w', encoding = 'utf-8') as f:
+        json.dump(manifest, f)
+
+def diff(old, new):
+    """
+    Returns the keys that were added or changed and the keys that were deleted between two {key: hash} dictionaries.
+    """
+    changed = [key for key, value in new.items() if old.get(key) != value]
+    deleted = [key for key in old if key not in new]
+    return changed, deleted
+
+def destroy(ontology, name):
+    entity = ontology[name]
+    if entity is None:
+        return
+    #trial parts are individuals of their own and have to go together with the document
+    for part in list(getattr(entity, 'hasPart', [])):
+        owl.destroy_entity(part)
+    owl.destroy_entity(entity)
+
+def update_graph(output = 'clinicalTrialsForIR.owl', chunk_size = 1000):
+    """
+    Brings the graph saved in output up to date with the database.
+
+    Without a manifest, or when entities, genes or drugs changed, the graph is rebuilt from scratch with create_graph. Otherwise the saved graph is loaded,
+    deleted and changed trials, topics and ratings are destroyed, changed and new ones are built again, and the graph and the manifest are saved.
+    Ratings pointing to a rebuilt trial or topic are rebuilt as well, because destroying an individual removes the relations pointing to it.
+    The trials are hashed in pages of chunk_size, then only the trials to rebuild and those of the ratings to rebuild are read again. Returns the numbers of
+    rebuilt and deleted individuals.
+    """
+    old = None
+    if os.path.exists(manifest_path(output)) and os.path.exists(output):
+        with open(manifest_path(output), encoding = 'utf-8') as f:
+            old = json.load(f)
+    data = load_shared_data()
+    manifest, rating_keys = build_manifest(data, iter_trial_chunks(data, chunk_size))
+    if old is None or old['shared'] != manifest['shared']:
+        create_graph(output = output)
+        write_manifest(manifest, output)
+        return {'rebuilt': len(manifest['trials']) + len(manifest['topics']) + len(manifest['ratings']), 'deleted': 0}
+
+    changed_trials, deleted_trials = diff(old['trials'], manifest['trials'])
+    changed_topics, deleted_topics = diff(old['topics'], manifest['topics'])
+    changed_ratings, deleted_ratings = diff(old['ratings'], manifest['ratings'])
+
+    #a new world, so that a graph with the same IRI loaded earlier in this process is not reused
+    with open(output, 'rb') as f:
+        ontology = create_empty_ontology(owl.World()).load(fileobj = f)
+    builder = GraphBuilder(ontology, data)
+    builder.index_existing()
+    for name in tqdm(changed_trials + deleted_trials + changed_topics + deleted_topics + changed_ratings + deleted_ratings):
+        destroy(ontology, name)
+
+    touched_trials = set(changed_trials)
+    touched_topics = set(changed_topics)
+    #building a rating again overwrites all of its properties, including the connections lost with a destroyed trial or topic
+    rebuilt_ratings = set(changed_ratings) | {name for name, (topic, nctid) in rating_keys.items() if nctid in touched_trials or topic in touched_topics}
+    #only the touched trials and the trials of the rebuilt ratings are read again, in pages of chunk_size
+    nctids = sorted(touched_trials | {rating_keys[name][1] for name in rebuilt_ratings})
+    with ontology:
+        for topic in data.topics:
+            if topic_name(topic['year'], topic['topic_no']) in touched_topics:
+                builder.build_topic(topic)
+        for start in tqdm(range(0, len(nctids), chunk_size)):
+            page = nctids[start:start + chunk_size]
+            load_trial_data(data, {'document_id__in': page})
+            for trial in iter_trials().filter(nctid__in = [nctid for nctid in page if nctid in touched_trials]).only(*TRIAL_FIELDS):
+                builder.build_trial(trial)
+            for rating in data.ratings:
+                if rating_name(rating['topic__year'], rating['topic__topic_no'], rating['document_id']) in rebuilt_ratings:
+                    builder.build_rating(rating)
+    print(builder.report.summary())
+    ontology.save(output)
+    write_manifest(manifest, output)
+    return {'rebuilt': len(changed_trials) + len(changed_topics) + len(rebuilt_ratings), 'deleted': len(deleted_trials) + len(deleted_topics) + len(deleted_ratings)}
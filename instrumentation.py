@@ -0,0 +1,136 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from tqdm import tqdm
+
+#instrumentation of the graph build: every phase records its wall time, the rows it processed, the SQL queries it ran and the memory of the process,
+#and data problems met on the way (unknown intervention types, links to unknown entities, genes or drugs, ...) are collected as anomalies
+#instead of being printed one by one.
+
+def peak_rss_mb():
+    #ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+class Phase:
+    """
+    Handle of a running phase: update() advances the progress bar and the row count.
+    """
+    def __init__(self, bar):
+        self.bar = bar
+        self.rows = 0
+
+    def update(self, rows = 1):
+        self.rows += rows
+        self.bar.update(rows)
+
+class BuildReport:
+    """
+    Measurements and anomalies of one build.
+
+    Fields:
+    -----------
+        phases - list of dictionaries: name, seconds, rows, rows_per_second, queries, query_seconds (None without count_queries), rss_mb,
+        peak_rss_mb and, with trace_memory, peak_traced_mb
+
+        anomalies - {kind: {'count': number of occurrences, 'examples': first distinct keys}}
+
+        progress - whether the phases show progress bars
+
+        trace_memory - whether the Python allocations are traced per phase; precise, but it slows the build down several times
+
+        count_queries - whether the SQL queries of the Django database connection are counted; off for builds reading another data source,
+        which then need no configured database
+    """
+    def __init__(self, progress = True, trace_memory = False, max_examples = 10, count_queries = True):
+        self.phases = []
+        self.anomalies = defaultdict(lambda: {'count': 0, 'examples': []})
+        self.progress = progress
+        self.trace_memory = trace_memory
+        self.max_examples = max_examples
+        self.count_queries = count_queries
+
+    @contextmanager
+    def phase(self, name, total = None, progress = True):
+        """
+        Context manager measuring one phase; yields a Phase whose progress bar has total (the number of rows) as its length.
+        Phases without a total show no progress bar.
+        """
+        queries = {'count': 0, 'seconds': 0.0} if self.count_queries else {'count': None, 'seconds': None}
+        def count_query(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries['count'] += 1
+                queries['seconds'] += time.perf_counter() - start
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        bar = tqdm(total = total, desc = name, disable = not (self.progress and progress) or total is None)
+        phase = Phase(bar)
+        start = time.perf_counter()
+        try:
+            if self.count_queries:
+                from django.db import connection
+                with connection.execute_wrapper(count_query):
+                    yield phase
+            else:
+                yield phase
+        finally:
+            seconds = time.perf_counter() - start
+            bar.close()
+            result = {'name': name, 'seconds': seconds, 'rows': phase.rows, 'rows_per_second': phase.rows / seconds if seconds > 0 else None,
+                      'queries': queries['count'], 'query_seconds': queries['seconds'], 'rss_mb': rss_mb(), 'peak_rss_mb': peak_rss_mb()}
+            if tracing:
+                result['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                tracemalloc.stop()
+            self.phases.append(result)
+
+    def anomaly(self, kind, key):
+        entry = self.anomalies[kind]
+        entry['count'] += 1
+        if len(entry['examples']) < self.max_examples and key not in entry['examples']:
+            entry['examples'].append(key)
+
+    def merge(self, other, prefix = ''):
+        """
+        Adds the phases (renamed with prefix) and the anomalies of another report, given as returned by to_dict, e.g. from a worker process.
+        """
+        self.phases.extend(dict(phase, name = prefix + phase['name']) for phase in other['phases'])
+        for kind, entry in other['anomalies'].items():
+            own = self.anomalies[kind]
+            own['count'] += entry['count']
+            for key in entry['examples']:
+                if len(own['examples']) < self.max_examples and key not in own['examples']:
+                    own['examples'].append(key)
+
+    def to_dict(self):
+        return {'phases': self.phases, 'anomalies': dict(self.anomalies)}
+
+    def save(self, path):
+        with open(path, 'w', encoding = 'utf-8') as f:
+            json.dump(self.to_dict(), f, indent = 2)
+
+    def summary(self):
+        lines = [f"{'phase':<20}{'seconds':>10}{'rows':>10}{'rows/s':>10}{'queries':>9}{'RSS MB':>9}"]
+        for phase in self.phases:
+            rate = f"{phase['rows_per_second']:.0f}" if phase['rows_per_second'] else '-'
+            rss = f"{phase['rss_mb']:.0f}" if phase['rss_mb'] is not None else '-'
+            queries = phase['queries'] if phase['queries'] is not None else '-'
+            lines.append(f"{phase['name']:<20}{phase['seconds']:>10.2f}{phase['rows']:>10}{rate:>10}{queries:>9}{rss:>9}")
+        for kind, entry in sorted(self.anomalies.items()):
+            lines.append(f"{entry['count']} x {kind}, e.g. {entry['examples']}")
+        return '\n'.join(lines)
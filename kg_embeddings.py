@@ -0,0 +1,372 @@
+from csr_export import CSRGraph
+from naming import BASE_IRI, topic_name
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import numpy as np
+from scipy import sparse
+from tqdm import tqdm
+
+#knowledge graph embeddings trained on the CPU: the trial - entity / gene / drug links, the drug targets and the gene families of the CSR export
+#are the training triples of a TransE or DistMult model. Minibatches with typed negative samples are computed with NumPy in a pool of forked
+#processes, which update the same memory mapped node vectors without locks (Hogwild). The trial vectors are then searched for the
+#genes and the disease of a topic, by brute force or through an inverted file (IVF) of k-means lists.
+
+NODE_TYPES = ('trial', 'entity', 'gene', 'drug')
+TRAIN_RELATIONS = ('trial_entity', 'trial_gene', 'trial_drug', 'drug_gene', 'gene_family')
+MODELS = ('transe', 'distmult')
+DEFAULT_LEARNING_RATES = {'transe': 0.01, 'distmult': 0.1}
+
+def node_offsets(graph):
+    """
+    Offsets of the node types in the embedding matrix: {node type: (first row, number of nodes)}.
+    """
+    offsets, first = {}, 0
+    for node_type in NODE_TYPES:
+        offsets[node_type] = (first, graph.meta['nodes'][node_type])
+        first += graph.meta['nodes'][node_type]
+    return offsets
+
+def graph_triples(graph, offsets):
+    """
+    Training triples as an (n, 3) int64 array of (head row, relation, tail row), with the node types of the head and tail of every relation.
+    """
+    triples, types = [], []
+    for relation_id, relation in enumerate(TRAIN_RELATIONS):
+        description = graph.meta['relations'][relation]
+        matrix = graph.relations[relation].tocoo()
+        heads = matrix.row.astype(np.int64) + offsets[description['source']][0]
+        tails = matrix.col.astype(np.int64) + offsets[description['target']][0]
+        triples.append(np.stack([heads, np.full(len(heads), relation_id), tails], axis = 1))
+        types.append((description['source'], description['target']))
+    return np.concatenate(triples) if triples else np.zeros((0, 3), dtype = np.int64), types
+
+###training
+#the triples and settings are inherited by the forked workers; every task opens the embedding files itself
+_training = None
+
+def corrupt(triples, negatives, rng):
+    """
+    Negative samples: every triple repeated negatives times with its head or its tail replaced by a random node of the same type.
+    """
+    offsets, relation_types = _training['offsets'], _training['relation_types']
+    corrupted = np.repeat(triples, negatives, axis = 0)
+    replace_tail = rng.random(len(corrupted)) < 0.5
+    for relation_id, (source, target) in enumerate(relation_types):
+        in_relation = corrupted[:, 1] == relation_id
+        for column, node_type, rows in ((0, source, in_relation & ~replace_tail), (2, target, in_relation & replace_tail)):
+            if rows.any():
+                first, count = offsets[node_type]
+                corrupted[rows, column] = first + rng.integers(0, count, rows.sum())
+    return corrupted
+
+def scatter_add(matrix, rows, values):
+    """
+    matrix[rows] += values with repeated rows summed; a sparse product, much faster than np.add.at for row updates.
+    """
+    unique, inverse = np.unique(rows, return_inverse = True)
+    summing = sparse.csr_matrix((np.ones(len(rows), dtype = values.dtype), (inverse.ravel(), np.arange(len(rows)))), shape = (len(unique), len(rows)))
+    #the sum is computed before the rows are read, so that the read-modify-write racing with other workers is as short as possible
+    update = summing @ values
+    matrix[unique] += update
+
+def transe_step(entities, relations, positive, negative, negatives, learning_rate, margin):
+    #margin ranking loss on the L2 distance ||h + r - t||
+    def difference(triples):
+        diff = entities[triples[:, 0]] + relations[triples[:, 1]] - entities[triples[:, 2]]
+        return diff, np.maximum(np.linalg.norm(diff, axis = 1), 1e-9)
+    positive = np.repeat(positive, negatives, axis = 0)
+    positive_diff, positive_distance = difference(positive)
+    negative_diff, negative_distance = difference(negative)
+    loss = np.maximum(0, margin + positive_distance - negative_distance)
+    active = (loss > 0)[:, None]
+    positive_grad = learning_rate * active * positive_diff / positive_distance[:, None]
+    negative_grad = learning_rate * active * negative_diff / negative_distance[:, None]
+    scatter_add(entities, positive[:, 0], -positive_grad)
+    scatter_add(entities, positive[:, 2], positive_grad)
+    scatter_add(relations, positive[:, 1], negative_grad - positive_grad)
+    scatter_add(entities, negative[:, 0], negative_grad)
+    scatter_add(entities, negative[:, 2], -negative_grad)
+    return float(loss.sum())
+
+def distmult_step(entities, relations, positive, negative, negatives, learning_rate, regularization):
+    #logistic loss on the score sum(h * r * t), positives labelled 1 and negatives -1
+    triples = np.concatenate((positive, negative))
+    labels = np.concatenate((np.ones(len(positive)), -np.ones(len(negative)))).astype(np.float32)
+    heads, rels, tails = entities[triples[:, 0]], relations[triples[:, 1]], entities[triples[:, 2]]
+    scores = np.sum(heads * rels * tails, axis = 1)
+    loss = np.logaddexp(0, -labels * scores)
+    #d loss / d score, negatives weighted so that both sides count the same
+    weights = np.where(labels > 0, 1.0, 1.0 / negatives).astype(np.float32)
+    slope = (learning_rate * weights * -labels / (1 + np.exp(np.clip(labels * scores, -30, 30))))[:, None]
+    scatter_add(entities, triples[:, 0], -(slope * rels * tails + learning_rate * regularization * heads))
+    scatter_add(entities, triples[:, 2], -(slope * heads * rels + learning_rate * regularization * tails))
+    scatter_add(relations, triples[:, 1], -(slope * heads * tails))
+    return float((loss * weights).sum())
+
+def train_part(directory, rows, epoch, part):
+    """
+    Runs the minibatches of one epoch over the triples rows (indices into the training triples). Node vectors are updated in place;
+    the few relation vectors, which every minibatch updates and would lose most updates to races, are trained on a private copy.
+    Returns the summed loss and the update of the relation vectors.
+    """
+    settings = _training['settings']
+    entities = np.load(os.path.join(directory, 'entities.npy'), mmap_mode = 'r+')
+    initial = np.load(os.path.join(directory, 'relations.npy'))
+    relations = initial.copy()
+    rng = np.random.default_rng((settings['seed'], epoch, part))
+    loss = 0.0
+    for start in range(0, len(rows), settings['batch_size']):
+        positive = _training['triples'][rows[start:start + settings['batch_size']]]
+        negative = corrupt(positive, settings['negatives'], rng)
+        if settings['model'] == 'transe':
+            loss += transe_step(entities, relations, positive, negative, settings['negatives'], settings['learning_rate'], settings['margin'])
+        else:
+            loss += distmult_step(entities, relations, positive, negative, settings['negatives'], settings['learning_rate'], settings['regularization'])
+    entities.flush()
+    return loss, relations - initial
+
+def normalize_rows(matrix, chunk_size = 100000):
+    for start in range(0, len(matrix), chunk_size):
+        block = matrix[start:start + chunk_size]
+        block /= np.maximum(np.linalg.norm(block, axis = 1, keepdims = True), 1e-9)
+
+def train_embeddings(directory = 'kg_embeddings', graph = None, model = 'transe', dim = 64, epochs = 20, batch_size = 1024, negatives = 4,
+                     learning_rate = None, margin = 1.0, regularization = 1e-4, processes = None, seed = 0, progress = True):
+    """
+    Trains node and relation embeddings on the triples of a csr_export.CSRGraph (by default the one in kg_csr) and writes them to directory:
+    entities.npy (one row per trial, entity, gene and drug, see node_offsets), relations.npy, trials.npy with the NCTIDs of the trial rows,
+    and meta.json with the settings and the loss of every epoch. The inverted file of previous vectors in directory is deleted (see build_ivf).
+
+    Every epoch the shuffled triples are split between processes forked workers (trained in this process when processes is 1),
+    and the relation vectors are moved by the mean of the updates of the workers. With TransE the node vectors are renormalized
+    to unit length after every epoch. Returns the trained KGEmbeddings.
+    """
+    global _training
+    if model not in MODELS:
+        raise ValueError(f'model must be one of {MODELS}')
+    if learning_rate is None:
+        learning_rate = DEFAULT_LEARNING_RATES[model]
+    if graph is None:
+        graph = CSRGraph()
+    offsets = node_offsets(graph)
+    triples, relation_types = graph_triples(graph, offsets)
+    settings = {'model': model, 'dim': dim, 'batch_size': batch_size, 'negatives': negatives, 'learning_rate': learning_rate, 'margin': margin,
+                'regularization': regularization, 'seed': seed}
+    _training = {'triples': triples, 'offsets': offsets, 'relation_types': relation_types, 'settings': settings}
+
+    os.makedirs(directory, exist_ok = True)
+    remove_ivf(directory)
+    rng = np.random.default_rng(seed)
+    nodes = sum(count for first, count in offsets.values())
+    entities = np.lib.format.open_memmap(os.path.join(directory, 'entities.npy'), mode = 'w+', dtype = np.float32, shape = (nodes, dim))
+    relations = np.lib.format.open_memmap(os.path.join(directory, 'relations.npy'), mode = 'w+', dtype = np.float32, shape = (len(TRAIN_RELATIONS), dim))
+    if model == 'transe':
+        bound = 6 / np.sqrt(dim)
+        entities[:] = rng.uniform(-bound, bound, (nodes, dim))
+        relations[:] = rng.uniform(-bound, bound, (len(TRAIN_RELATIONS), dim))
+        normalize_rows(entities)
+        normalize_rows(relations)
+    else:
+        entities[:] = rng.normal(0, 0.1, (nodes, dim))
+        relations[:] = rng.normal(0, 0.1, (len(TRAIN_RELATIONS), dim))
+    entities.flush()
+    relations.flush()
+    del entities, relations
+
+    processes = processes or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(processes, mp_context = multiprocessing.get_context('fork')) if processes > 1 and len(triples) else None
+    losses = []
+    try:
+        for epoch in tqdm(range(epochs), disable = not progress):
+            parts = np.array_split(rng.permutation(len(triples)), processes if pool is not None else 1)
+            if pool is not None:
+                results = list(pool.map(train_part, [directory] * len(parts), parts, [epoch] * len(parts), range(len(parts))))
+            else:
+                results = [train_part(directory, parts[0], epoch, 0)]
+            relations = np.load(os.path.join(directory, 'relations.npy'), mmap_mode = 'r+')
+            relations += sum(update for loss, update in results) / len(results)
+            relations.flush()
+            del relations
+            losses.append(sum(loss for loss, update in results) / max(1, len(triples) * negatives))
+            if model == 'transe':
+                entities = np.load(os.path.join(directory, 'entities.npy'), mmap_mode = 'r+')
+                normalize_rows(entities)
+                entities.flush()
+                del entities
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        _training = None
+
+    nctids = [str(iri)[len(BASE_IRI):] for iri in graph.iris['trial']]
+    np.save(os.path.join(directory, 'trials.npy'), np.array(nctids, dtype = str))
+    with open(os.path.join(directory, 'meta.json'), 'w', encoding = 'utf-8') as f:
+        json.dump(dict(settings, epochs = epochs, nodes = offsets, relations = list(TRAIN_RELATIONS), triples = len(triples), losses = losses), f, indent = 1)
+    return KGEmbeddings(directory, graph)
+
+###search
+IVF_PARTS = ('centroids', 'order', 'offsets')
+
+def remove_ivf(directory):
+    for part in IVF_PARTS:
+        path = os.path.join(directory, f'ivf.{part}.npy')
+        if os.path.exists(path):
+            os.remove(path)
+
+def kmeans(vectors, lists, iterations = 10, seed = 0, sample = 100000):
+    """
+    Centroids of lists k-means clusters of vectors, fitted on a sample of at most sample vectors.
+    """
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample:
+        vectors = vectors[np.sort(rng.choice(len(vectors), sample, replace = False))]
+    vectors = np.asarray(vectors, dtype = np.float32)
+    centroids = vectors[rng.choice(len(vectors), lists, replace = False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroids(vectors, centroids)
+        for i in range(lists):
+            members = vectors[assignment == i]
+            if len(members):
+                centroids[i] = members.mean(axis = 0)
+    return centroids
+
+def nearest_centroids(vectors, centroids, chunk_size = 100000):
+    assignment = np.empty(len(vectors), dtype = np.int64)
+    squared = (centroids ** 2).sum(axis = 1)
+    for start in range(0, len(vectors), chunk_size):
+        block = np.asarray(vectors[start:start + chunk_size], dtype = np.float32)
+        assignment[start:start + chunk_size] = np.argmin(squared[None, :] - 2 * block @ centroids.T, axis = 1)
+    return assignment
+
+def build_ivf(directory = 'kg_embeddings', lists = None, iterations = 10, seed = 0):
+    """
+    Clusters the trial vectors of directory with k-means into lists inverted lists (by default about the square root of the number of trials)
+    and writes ivf.centroids.npy, ivf.order.npy (trial rows sorted by list) and ivf.offsets.npy (start of every list in ivf.order).
+    """
+    embeddings = KGEmbeddings(directory, graph = False)
+    trials = embeddings.trial_vectors
+    if lists is None:
+        lists = max(1, int(np.sqrt(len(trials))))
+    lists = min(lists, len(trials))
+    centroids = kmeans(trials, lists, iterations, seed)
+    assignment = nearest_centroids(trials, centroids)
+    order = np.argsort(assignment, kind = 'stable')
+    offsets = np.zeros(lists + 1, dtype = np.int64)
+    np.cumsum(np.bincount(assignment, minlength = lists), out = offsets[1:])
+    np.save(os.path.join(directory, 'ivf.centroids.npy'), centroids)
+    np.save(os.path.join(directory, 'ivf.order.npy'), order.astype(np.int64))
+    np.save(os.path.join(directory, 'ivf.offsets.npy'), offsets)
+    return lists
+
+class KGEmbeddings:
+    """
+    Embeddings written by train_embeddings, memory mapped. Trials are ranked for the genes and the disease of a topic, read from the
+    topic_gene and topic_entity relations of graph (a csr_export.CSRGraph, kg_csr by default; graph = False for vector search only).
+
+    Fields:
+    -----------
+        entities - (nodes, dim) node vectors, rows located with offsets
+
+        relations - (relations, dim) relation vectors, in the order of TRAIN_RELATIONS
+
+        trial_vectors - the rows of entities of the trials, in the order of nctids
+
+        ivf - (centroids, order, offsets) written by build_ivf, or None
+    """
+    def __init__(self, directory = 'kg_embeddings', graph = None, mmap_mode = 'r'):
+        with open(os.path.join(directory, 'meta.json'), encoding = 'utf-8') as f:
+            self.meta = json.load(f)
+        self.model = self.meta['model']
+        self.offsets = {node_type: tuple(offset) for node_type, offset in self.meta['nodes'].items()}
+        self.entities = np.load(os.path.join(directory, 'entities.npy'), mmap_mode = mmap_mode)
+        self.relations = np.load(os.path.join(directory, 'relations.npy'))
+        first, count = self.offsets['trial']
+        self.trial_vectors = self.entities[first:first + count]
+        self.nctids = np.load(os.path.join(directory, 'trials.npy'))
+        self.graph = (graph if graph is not None else CSRGraph()) if graph is not False else None
+        if os.path.exists(os.path.join(directory, 'ivf.centroids.npy')):
+            self.ivf = tuple(np.load(os.path.join(directory, f'ivf.{part}.npy'), mmap_mode = mmap_mode) for part in IVF_PARTS)
+        else:
+            self.ivf = None
+
+    def query_vector(self, genes = (), entities = (), drugs = ()):
+        """
+        Query vector of trials linked to the given genes, entities and drugs (dense ids of the CSR export).
+        TransE: the mean of node - relation, the expected position of a linked trial. DistMult: the sum of relation * node.
+        """
+        parts = []
+        for node_type, ids in (('gene', genes), ('entity', entities), ('drug', drugs)):
+            ids = np.asarray(ids, dtype = np.int64)
+            if not len(ids):
+                continue
+            relation = self.relations[TRAIN_RELATIONS.index('trial_' + node_type)]
+            vectors = np.asarray(self.entities[self.offsets[node_type][0] + ids], dtype = np.float32)
+            parts.append(vectors - relation if self.model == 'transe' else vectors * relation)
+        if not parts:
+            return None
+        parts = np.concatenate(parts)
+        return parts.mean(axis = 0) if self.model == 'transe' else parts.sum(axis = 0)
+
+    def topic_vector(self, topic):
+        """
+        Query vector of the genes and the disease of a topic, given as a Topic, a (year, topic_no) pair or the dense id of the topic.
+        """
+        if self.graph is None:
+            raise ValueError('topic vectors are read from the CSR graph, which embeddings opened with graph = False do not have')
+        if isinstance(topic, (int, np.integer)):
+            topic_id = int(topic)
+        else:
+            year, topic_no = (topic.year, topic.topic_no) if hasattr(topic, 'year') else topic
+            topic_id = self.graph.node_id('topic', BASE_IRI + topic_name(year, topic_no))
+            if topic_id is None:
+                raise KeyError(f'topic {year} {topic_no} is not in the graph')
+        relations = self.graph.relations
+        return self.query_vector(genes = relations['topic_gene'][topic_id].indices, entities = relations['topic_entity'][topic_id].indices)
+
+    def scores(self, vector, rows = None):
+        """
+        Scores of the trial rows (all by default) for a query vector, higher is better: minus the distance for TransE, the dot product for DistMult.
+        """
+        trials = self.trial_vectors if rows is None else self.trial_vectors[rows]
+        trials = np.asarray(trials, dtype = np.float32)
+        if self.model == 'transe':
+            return -np.linalg.norm(trials - vector, axis = 1)
+        return trials @ vector
+
+    def candidates(self, vector, nprobe):
+        """
+        Trial rows of the nprobe inverted lists closest to vector.
+        """
+        centroids, order, offsets = self.ivf
+        if self.model == 'transe':
+            closest = np.argsort(((centroids - vector) ** 2).sum(axis = 1))[:nprobe]
+        else:
+            closest = np.argsort(-(centroids @ vector))[:nprobe]
+        return np.sort(np.concatenate([order[offsets[i]:offsets[i + 1]] for i in closest]))
+
+    def search(self, vector, k = 1000, nprobe = None, mask = None):
+        """
+        Returns the k best (nctid, score) pairs for a query vector, best first. With nprobe and an IVF (see build_ivf) only the trials
+        of the nprobe closest lists are scored, otherwise all trials are. Trials outside mask (a boolean array over nctids) are skipped.
+        """
+        if vector is None:
+            return []
+        rows = self.candidates(vector, nprobe) if nprobe is not None and self.ivf is not None else np.arange(len(self.nctids))
+        if mask is not None:
+            rows = rows[mask[rows]]
+        scores = self.scores(vector, rows)
+        if len(rows) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            rows, scores = rows[best], scores[best]
+        order = np.argsort(-scores, kind = 'stable')
+        return [(str(self.nctids[row]), float(score)) for row, score in zip(rows[order], scores[order])]
+
+    def rank_topic(self, topic, k = 1000, nprobe = None, eligibility = None):
+        """
+        Ranks the trials for a topic by the similarity of their vectors with the topic's genes and disease, as candidates for a reranker.
+        With an eligibility.EligibilityIndex, trials the patient is not eligible for are dropped.
+        """
+        mask = eligibility.mask_for(topic, self.nctids) if eligibility is not None else None
+        return self.search(self.topic_vector(topic), k, nprobe, mask)
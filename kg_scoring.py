@@ -0,0 +1,128 @@
+from csr_export import CSRGraph
+from gene_hierarchy import GeneHierarchy
+from naming import BASE_IRI, topic_name
+import numpy as np
+from scipy import sparse
+
+#vectorized knowledge graph scoring: the trial - gene / entity / drug incidence matrices of the CSR export are multiplied with
+#sparse topic vectors, so a batch of topics is scored against every trial with a few sparse matrix products.
+
+DEFAULT_WEIGHTS = {
+    'gene': 1.0,
+    'entity': 1.0,
+    'drug': 0.5,
+    'family': 0.5,
+}
+
+def binary(matrix):
+    matrix = sparse.csr_matrix(matrix, dtype = np.float32, copy = True)
+    matrix.data[:] = 1
+    return matrix
+
+def family_closure(gene_family):
+    """
+    Binary (gene x gene) matrix linking every gene to its ancestors and descendants in the gene_family relation, computed with
+    gene_hierarchy.GeneHierarchy (cycles are broken there).
+    """
+    gene_family = sparse.coo_matrix(gene_family)
+    genes = gene_family.shape[0]
+    parent = dict.fromkeys(range(genes))
+    parent.update(zip(gene_family.row.tolist(), gene_family.col.tolist()))
+    hierarchy = GeneHierarchy(parent)
+    rows, columns = [], []
+    for gene in hierarchy.order:
+        below = hierarchy.descendants(gene)
+        rows.extend([gene] * len(below))
+        columns.extend(below)
+    descendants = sparse.csr_matrix((np.ones(len(rows), dtype = np.float32), (rows, columns)), shape = (genes, genes))
+    return (descendants + descendants.T).tocsr()
+
+class KGScorer:
+    """
+    Scores trials by the overlap of their GeneLinks, EntityLinks and DrugLinks with the genes (and gene families) of a topic,
+    its disease and the drugs targeting its genes. The counterpart of Rating.gene_score, disease_score and treatment_score.
+
+    weights - weight of the gene, entity (disease) and drug overlap, and of the genes above or below a topic gene in the family hierarchy
+              (at any distance) relative to the topic genes
+    binary_links - count a linked gene, entity or drug once per trial instead of once per link
+    """
+    def __init__(self, graph = None, weights = DEFAULT_WEIGHTS, binary_links = True):
+        self.graph = graph if graph is not None else CSRGraph()
+        self.weights = weights
+        relations = self.graph.relations
+        prepare = binary if binary_links else (lambda matrix: sparse.csr_matrix(matrix, dtype = np.float32))
+        #transposed incidence matrices: feature x trial
+        self.trial_gene = prepare(relations['trial_gene']).T.tocsr()
+        self.trial_entity = prepare(relations['trial_entity']).T.tocsr()
+        self.trial_drug = prepare(relations['trial_drug']).T.tocsr()
+        self.gene_drug = sparse.csr_matrix(relations['drug_gene'], dtype = np.float32).T.tocsr()
+        #gene -> every gene above and below it in the family hierarchy
+        self.gene_related = family_closure(relations['gene_family'])
+        self.topic_gene = binary(relations['topic_gene'])
+        self.topic_entity = binary(relations['topic_entity'])
+        self.nctids = np.array([str(iri)[len(BASE_IRI):] for iri in self.graph.iris['trial']])
+
+    def topic_ids(self, topics):
+        """
+        Dense ids of topics given as Topic objects, (year, topic_no) pairs or ids.
+        """
+        ids = []
+        for topic in topics:
+            if isinstance(topic, (int, np.integer)):
+                ids.append(int(topic))
+                continue
+            year, topic_no = (topic.year, topic.topic_no) if hasattr(topic, 'year') else topic
+            topic_id = self.graph.node_id('topic', BASE_IRI + topic_name(year, topic_no))
+            if topic_id is None:
+                raise KeyError(f'topic {year} {topic_no} is not in the graph')
+            ids.append(topic_id)
+        return np.array(ids, dtype = np.int64)
+
+    def topic_vectors(self, topic_ids):
+        """
+        Returns the gene, entity and drug query matrices (topics x features) of a batch of topics.
+        """
+        genes = self.topic_gene[topic_ids]
+        genes = genes + self.weights['family'] * (genes @ self.gene_related)
+        entities = self.topic_entity[topic_ids]
+        drugs = self.topic_gene[topic_ids] @ self.gene_drug
+        return genes.tocsr(), entities.tocsr(), drugs.tocsr()
+
+    def scores(self, topics, mask = None):
+        """
+        Returns a dense (topics x trials) score matrix. Trials outside mask (a boolean array over trials, or one row per topic) score -inf.
+        """
+        topic_ids = self.topic_ids(topics)
+        genes, entities, drugs = self.topic_vectors(topic_ids)
+        scores = self.weights['gene'] * (genes @ self.trial_gene) + self.weights['entity'] * (entities @ self.trial_entity) \
+            + self.weights['drug'] * (drugs @ self.trial_drug)
+        scores = scores.toarray() if sparse.issparse(scores) else np.asarray(scores)
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+        return scores
+
+    def top_k(self, topics, k = 1000, mask = None, batch_size = 64):
+        """
+        Returns, for every topic, the k best (nctid, score) pairs with a positive score, best first. Topics are scored batch_size at a time.
+        """
+        results = []
+        topics = list(topics)
+        for start in range(0, len(topics), batch_size):
+            batch_mask = mask[start:start + batch_size] if mask is not None and np.ndim(mask) == 2 else mask
+            scores = self.scores(topics[start:start + batch_size], batch_mask)
+            for row in scores:
+                candidates = np.flatnonzero(row > 0)
+                if len(candidates) > k:
+                    candidates = candidates[np.argpartition(-row[candidates], k - 1)[:k]]
+                candidates = candidates[np.argsort(-row[candidates], kind = 'stable')]
+                results.append([(str(self.nctids[i]), float(row[i])) for i in candidates])
+        return results
+
+    def rank_topic(self, topic, k = 1000, eligibility = None):
+        """
+        Ranks the trials for one Topic. With an eligibility.EligibilityIndex, trials the patient is not eligible for are left out of the ranking:
+        every trial is scored and the mask is applied to the scores, because the sparse products only touch the trials sharing a feature with the topic
+        and restricting the incidence matrices to the eligible trials first would cost more than it saves.
+        """
+        mask = eligibility.mask_for(topic, self.nctids) if eligibility is not None else None
+        return self.top_k([topic], k, mask)[0]
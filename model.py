@@ -1,4 +1,7 @@
-from django.db import models
+from django.db import connection, models
+from django.db.models.functions import Cast
+from django.utils.functional import cached_property
+from naming import DRUG_NAME_PRECEDENCE, choose_drug_name
 
 
 class ClinicalTrial(models.Model):
@@ -162,23 +165,33 @@ class Drug(models.Model):
     diseases = models.ManyToManyField(Entity, blank=True)
     genes = models.ManyToManyField(Gene, blank=True)
     gene = models.ManyToManyField(Gene, blank=True, through=DrugGeneLinkDetails, related_name='gene_drug_with_details')
+    @cached_property
+    def display_name(self):
+        """
+        Name used to represent the drug, computed once per instance. Uses prefetched names (prefetch_related('drugname_set')) when available.
+        """
+        if 'drugname_set' in getattr(self, '_prefetched_objects_cache', {}):
+            names = [(name.type, name.name) for name in self.drugname_set.all()]
+        else:
+            names = list(DrugName.objects.filter(drug = self).order_by('pk').values_list('type', 'name'))
+        return choose_drug_name(self.pk, names)
+
     def __str__(self):
-        names = DrugName.objects.filter(drug = self)
-        tns = [name for name in names if name.type == 'T']
-        gns = [name for name in names if name.type == 'G']
-        sns = [name for name in names if name.type == 'S']
-        cns = [name for name in names if name.type == 'C']
-        if len(gns) != 0:
-            return gns[0].name
-        if len(tns) != 0:
-            return tns[0].name
-        if len(cns) != 0:
-            return cns[0].name
-        if len(sns) != 0:
-            return sns[0].name
-        
-        return str(self.pk)
-        
+        return self.display_name
+
+def drug_display_names(drug_ids = None):
+    """
+    Returns the display names of many drugs, keyed by primary key, computed from a single query. With drug_ids None every drug is included.
+    """
+    drugs = Drug.objects.all() if drug_ids is None else Drug.objects.filter(pk__in = drug_ids)
+    names = {pk: [] for pk in drugs.values_list('pk', flat = True)}
+    rows = DrugName.objects.order_by('pk').values_list('drug_id', 'type', 'name')
+    if drug_ids is not None:
+        rows = rows.filter(drug_id__in = drug_ids)
+    for drug_id, name_type, name in rows:
+        names[drug_id].append((name_type, name))
+    return {pk: choose_drug_name(pk, drug_names) for pk, drug_names in names.items()}
+
 class PMVocab(models.Model):
     word = models.CharField(max_length=400, default='')
     def __str__(self) -> str:
@@ -241,6 +254,11 @@ class EntityLink(models.Model):
     mesh_condition = models.ForeignKey(
         MeshCondition, on_delete=models.CASCADE, null=True, default=None)
     entity = models.ForeignKey(Entity, on_delete=models.CASCADE)
+    class Meta:
+        indexes = (
+            models.Index(fields=['document','entity']),
+            models.Index(fields=['condition','entity']),
+        )
 
 class DrugLink(models.Model):
     field = models.CharField(max_length=400, null=True, default=None)
@@ -263,6 +281,11 @@ class DrugLink(models.Model):
     mesh_condition = models.ForeignKey(
         MeshCondition, on_delete=models.CASCADE, null=True, default=None)
     drug = models.ForeignKey(Drug, on_delete=models.CASCADE)
+    class Meta:
+        indexes = (
+            models.Index(fields=['document','drug']),
+            models.Index(fields=['condition','drug']),
+        )
 
 class GeneLink(models.Model):
     field = models.CharField(max_length=400, null=True, default=None)
@@ -285,6 +308,11 @@ class GeneLink(models.Model):
     mesh_condition = models.ForeignKey(
         MeshCondition, on_delete=models.CASCADE, null=True, default=None)
     gene = models.ForeignKey(Gene, on_delete=models.CASCADE)
+    class Meta:
+        indexes = (
+            models.Index(fields=['document','gene']),
+            models.Index(fields=['condition','gene']),
+        )
 
 class GeneAnnotation(models.Model):
     rating = models.ForeignKey(Rating,  on_delete=models.CASCADE)
@@ -302,3 +330,56 @@ class ConditionAnnotation(models.Model):
     score = models.FloatField()
     correct = models.CharField(max_length=20)
     source = models.CharField(max_length=20)
+
+#parts of a clinical trial that links can point to, all of them have a foreign key to the trial
+LINK_PARTS = ('condition', 'intervention', 'arm_group', 'primary_outcome', 'seondary_outcome', 'keyword', 'mesh_intervention', 'mesh_condition')
+
+def link_rows(model, kind, target, nctids):
+    """
+    Links of the given trials as one query per foreign key of the link (the trial and each of its parts), so that every query is
+    answered with the index on its foreign key instead of scanning the link table. Links of a part that also point to the trial are left to the trial's query;
+    their NULL test is made on an expression, which SQLite does not answer with the index on document_id.
+    """
+    columns = dict(
+        kind=models.Value(kind, output_field=models.CharField()),
+        part_field=models.F('field'),
+        part_condition=models.F('condition_id'),
+        part_intervention=models.F('intervention_id'),
+        target=Cast(target, output_field=models.CharField()),
+    )
+    queries = [model.objects.filter(document_id__in=nctids).annotate(trial=models.F('document_id'), **columns)]
+    for part in LINK_PARTS:
+        parts = model._meta.get_field(part).related_model.objects.filter(document_id__in=nctids).values('pk')
+        queries.append(model.objects.filter(models.lookups.IsNull(Cast('document_id', output_field=models.CharField()), True), **{part + '_id__in': parts}).annotate(trial=models.F(part + '__document_id'), **columns))
+    return [query.values('trial', 'kind', 'part_field', 'part_condition', 'part_intervention', 'target') for query in queries]
+
+def trial_links_query(nctids):
+    """
+    The UNION ALL query of trial_links for one chunk of trials.
+    """
+    queries = link_rows(EntityLink, 'entity', 'entity__url', nctids) + link_rows(GeneLink, 'gene', 'gene_id', nctids) + link_rows(DrugLink, 'drug', 'drug_id', nctids)
+    return queries[0].union(*queries[1:], all=True)
+
+def trial_links(nctids):
+    """
+    Yields every EntityLink, GeneLink and DrugLink of the given trials, read with a single UNION ALL query per chunk of trials, including the links
+    of all parts of the documents (conditions, interventions, arm groups, outcomes, keywords and MeSH terms).
+
+    Every row is a dictionary with the keys:
+    -----------
+        trial - NCTID of the trial the link belongs to
+
+        kind - 'entity', 'gene' or 'drug'
+
+        part_field - the field of the link
+
+        part_condition, part_intervention - primary key of the condition or intervention the link points to, if any
+
+        target - Entity url, Gene main label or Drug primary key (as text)
+    """
+    nctids = list(nctids)
+    #every NCTID is bound once per branch of the union, the chunks keep the query below the parameter limit of the database (999 for SQLite)
+    max_params = connection.features.max_query_params
+    chunk_size = max(1, max_params // (3 * (1 + len(LINK_PARTS)))) if max_params else max(1, len(nctids))
+    for start in range(0, len(nctids), chunk_size):
+        yield from trial_links_query(nctids[start:start + chunk_size])
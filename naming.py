@@ -0,0 +1,33 @@
+#names of the individuals and classes of the knowledge graph; they are shared by the graph builder and the exporters,
+#so that all of them produce the same IRIs
+
+ONTOLOGY_IRI = 'http://temporary.org/IRclinicaltrials.owl'
+BASE_IRI = ONTOLOGY_IRI + '#'
+
+def entity_name(url):
+    return url.replace('#','')
+
+def gene_name(main_label):
+    return 'gene_' + main_label.replace(' ','')
+
+def drug_name(display_name):
+    return 'drug_' + display_name.replace(' ','')
+
+def topic_name(year, topic_no):
+    return str(year) + '_' + str(topic_no)
+
+def rating_name(year, topic_no, nctid):
+    return 'RAT_' + topic_name(year, topic_no) + '_' + nctid
+
+DRUG_NAME_PRECEDENCE = ('G', 'T', 'C', 'S')
+
+def choose_drug_name(pk, names):
+    """
+    Chooses the display name of a drug from (type, name) pairs of its DrugName rows: the first generic name, then trade, chemical
+    and scientific name. Drugs without names are represented by their primary key.
+    """
+    for name_type in DRUG_NAME_PRECEDENCE:
+        for candidate_type, name in names:
+            if candidate_type == name_type:
+                return name
+    return str(pk)
@@ -0,0 +1,205 @@
+from graph_creation import GraphBuilder, create_empty_ontology
+from graph_data import DjangoDataSource
+from instrumentation import BuildReport
+from naming import BASE_IRI, entity_name, rating_name, topic_name
+from string_table import StringTable, StringArray
+from triple_index import remove_triple_index
+from array import array
+from functools import lru_cache
+import gzip
+import io
+import os
+import numpy as np
+import owlready2 as owl
+
+#streaming export of the knowledge graph as N-Triples. Only the shared part of the graph (schema, entities, genes, drugs, topics),
+#whose size depends on the vocabularies and not on the corpus, is built with owlready2; trials and ratings are read in chunks
+#and written line by line with the same IRIs, classes and properties as create_graph, so peak memory stays bounded.
+
+RDF_TYPE = '<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>'
+RDFS_LABEL = '<http://www.w3.org/2000/01/rdf-schema#label>'
+OWL_NAMED_INDIVIDUAL = '<http://www.w3.org/2002/07/owl#NamedIndividual>'
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+
+TRIAL_PROPERTIES = (('BriefTitle', 'brief_title'), ('OfficialTitle', 'official_title'), ('Summary', 'summary'), ('Description', 'description'),
+                    ('Criteria', 'criteria'), ('minimumAge', 'min_age'), ('maximumAge', 'max_age'), ('gender', 'gender'))
+
+def iri(name):
+    return '<' + BASE_IRI + name + '>'
+
+def literal(value):
+    #same datatypes as owlready2: integers, decimals and strings
+    if isinstance(value, bool):
+        return f'"{str(value).lower()}"^^<{XSD}boolean>'
+    if isinstance(value, int):
+        return f'"{value}"^^<{XSD}integer>'
+    if isinstance(value, float):
+        return f'"{value}"^^<{XSD}decimal>'
+    value = str(value)
+    #short values repeat a lot (genders, ages, intervention names, annotations) and are escaped once, long texts are unique
+    return short_string_literal(value) if len(value) <= 200 else string_literal(value)
+
+def string_literal(value):
+    value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r')
+    return f'"{value}"^^<{XSD}string>'
+
+short_string_literal = lru_cache(maxsize = 65536)(string_literal)
+
+class NTriplesWriter:
+    def __init__(self, out):
+        self.out = out
+        self.count = 0
+
+    def triple(self, subject, predicate, obj):
+        self.out.write(f'{subject} {predicate} {obj} .\n')
+        self.count += 1
+
+    def line(self, line):
+        self.out.write(line + '\n')
+        self.count += 1
+
+    def individual(self, subject, cls, label):
+        self.triple(subject, RDF_TYPE, OWL_NAMED_INDIVIDUAL)
+        self.triple(subject, RDF_TYPE, iri(cls))
+        self.triple(subject, RDFS_LABEL, literal(label))
+
+def open_output(path, compress = None):
+    if compress is None:
+        compress = path.endswith('.gz')
+    if compress:
+        return gzip.open(path, 'wt', encoding = 'utf-8')
+    return open(path, 'w', encoding = 'utf-8')
+
+def write_links(writer, subject, builder, data, grouping, key, drug_property):
+    for link in data.entity_links[grouping].get(key, []):
+        entity = builder.entity_index.get(entity_name(link['entity__url']))
+        if entity is None:
+            builder.report.anomaly('unresolved_entity', entity_name(link['entity__url']))
+        else:
+            writer.triple(subject, iri('EntityLink'), f'<{entity.iri}>')
+    for link in data.gene_links[grouping].get(key, []):
+        gene = builder.gene_index.get(link['gene_id'])
+        if gene is None:
+            builder.report.anomaly('unresolved_gene', link['gene_id'])
+        else:
+            writer.triple(subject, iri('GeneLink'), f'<{gene.iri}>')
+    for link in data.drug_links[grouping].get(key, []):
+        drug = builder.drug_index.get(link['drug_id'])
+        if drug is None:
+            builder.report.anomaly('unresolved_drug', link['drug_id'])
+        else:
+            writer.triple(subject, iri(drug_property), f'<{drug.iri}>')
+
+def write_trial(writer, trial, builder, data):
+    document = iri(trial.nctid)
+    writer.individual(document, 'ClinicalTrialDocument', trial.nctid)
+    for property_name, field in TRIAL_PROPERTIES:
+        writer.triple(document, iri(property_name), literal(getattr(trial, field)))
+    study_type = builder.study_types.get(trial.study_type, builder.study_types['Informational'])
+    writer.triple(document, iri('hasStudyTypeAssignment'), f'<{study_type.iri}>')
+    for j, intervention in enumerate(data.interventions.get(trial.nctid, [])):
+        name = trial.nctid + 'INT' + str(j)
+        writer.individual(iri(name), 'InterventionTreatment', name)
+        if intervention['type'] in builder.intervention_types:
+            writer.triple(iri(name), iri('hasType'), f"<{builder.intervention_types[intervention['type']].iri}>")
+        else:
+            builder.report.anomaly('unknown_intervention_type', intervention['type'])
+        writer.triple(iri(name), iri('hasText'), literal(intervention['name']))
+        writer.triple(document, iri('hasPart'), iri(name))
+    for j, condition in enumerate(data.conditions.get(trial.nctid, [])):
+        name = trial.nctid + 'COND' + str(j)
+        writer.individual(iri(name), 'ConditionDisease', name)
+        writer.triple(iri(name), iri('hasText'), literal(condition['text']))
+        #as in create_graph, drug links of conditions are stored under GeneLink
+        write_links(writer, iri(name), builder, data, 'condition', condition['pk'], 'GeneLink')
+        writer.triple(document, iri('hasPart'), iri(name))
+    write_links(writer, document, builder, data, 'document', trial.nctid, 'DrugLink')
+
+def write_rating(writer, rating):
+    subject = iri(rating_name(rating['topic__year'], rating['topic__topic_no'], rating['document_id']))
+    writer.triple(subject, RDF_TYPE, OWL_NAMED_INDIVIDUAL)
+    writer.triple(subject, RDF_TYPE, iri('Rating'))
+    writer.triple(subject, iri('TopicConnection'), iri(topic_name(rating['topic__year'], rating['topic__topic_no'])))
+    writer.triple(subject, iri('DocumentConnection'), iri(rating['document_id']))
+    writer.triple(subject, iri('DiseaseScore'), literal(rating['disease_score']))
+    writer.triple(subject, iri('GeneScore'), literal(rating['gene_score']))
+    writer.triple(subject, iri('TreatmentScore'), literal(rating['treatment_score']))
+    writer.triple(subject, iri('DemographyScore'), literal(rating['demography_score']))
+    #a graph is a set of triples, repeated annotations are written once
+    for annotation in dict.fromkeys(rating[field] for field in ('pm_gene1_annotation_desc', 'pm_gene2_annotation_desc', 'pm_gene3_annotation_desc')):
+        writer.triple(subject, iri('TRECGeneAnnotation'), literal(annotation))
+    writer.triple(subject, iri('TRECDiseaseAnnotation'), literal(rating['pm_disease_desc']))
+    writer.triple(subject, iri('TRECDemographyAnnotation'), literal(rating['pm_demo_desc']))
+    writer.triple(subject, iri('TRECPMAnnotation'), literal(rating['pm_rel_desc']))
+
+def export_ntriples(path = 'clinicalTrialsForIR.nt.gz', compress = None, chunk_size = 1000, report = None, source = None):
+    """
+    Writes the knowledge graph to path as N-Triples, gzip compressed when compress is set or the path ends with .gz.
+    Trials are read chunk_size at a time from source (by default the database). Phases and anomalies are recorded in report.
+    Returns the number of triples written.
+    """
+    with open_output(path, compress) as out:
+        writer = NTriplesWriter(out)
+        write_graph(writer, chunk_size, report, source)
+    return writer.count
+
+def write_graph(writer, chunk_size = 1000, report = None, source = None):
+    if source is None:
+        source = DjangoDataSource()
+    if report is None:
+        report = BuildReport(count_queries = isinstance(source, DjangoDataSource))
+    data = source.load_shared_data()
+    builder = GraphBuilder(create_empty_ontology(owl.World()), data, report = report)
+    builder.build_shared(progress = False)
+    shared = io.BytesIO()
+    builder.ontology.save(shared, format = 'ntriples')
+    for line in shared.getvalue().decode('utf-8').splitlines():
+        if line:
+            writer.line(line)
+    with builder.report.phase('trials', source.count_trials()) as phase:
+        for trials in source.iter_trial_chunks(data, chunk_size):
+            for trial in trials:
+                write_trial(writer, trial, builder, data)
+            for rating in data.ratings:
+                write_rating(writer, rating)
+            phase.update(len(trials))
+    print(builder.report.summary())
+
+###compact export
+#every distinct N-Triples term (IRI or literal) is stored once in a string table and the triples are an (n, 3) array of term ids,
+#which makes the graph a fraction of the size of the N-Triples file and loads without parsing
+
+class CompactWriter(NTriplesWriter):
+    def __init__(self):
+        self.terms = StringTable()
+        self.ids = array('i')
+        self.count = 0
+
+    def triple(self, subject, predicate, obj):
+        intern = self.terms.intern
+        self.ids.extend((intern(subject), intern(predicate), intern(obj)))
+        self.count += 1
+
+    def line(self, line):
+        #subjects and predicates of N-Triples never contain spaces, objects (literals) may
+        subject, predicate, obj = line.rstrip()[:-1].rstrip().split(' ', 2)
+        self.triple(subject, predicate, obj)
+
+def export_compact(directory = 'clinicalTrialsForIR.compact', chunk_size = 1000, report = None, source = None):
+    """
+    Writes the knowledge graph to directory as triples.npy, an int32 array of (subject, predicate, object) term ids, and the string table
+    terms.{strings,offsets}.npy of the N-Triples terms, and deletes the triple index (see triple_index.py) of a previous export. Returns the number of triples written.
+    """
+    writer = CompactWriter()
+    write_graph(writer, chunk_size, report, source)
+    os.makedirs(directory, exist_ok = True)
+    remove_triple_index(directory)
+    np.save(os.path.join(directory, 'triples.npy'), np.frombuffer(writer.ids, dtype = np.int32).reshape(-1, 3))
+    writer.terms.save(directory, 'terms')
+    return writer.count
+
+def load_compact(directory = 'clinicalTrialsForIR.compact', mmap_mode = 'r'):
+    """
+    Returns the triples array and the string array of terms written by export_compact.
+    """
+    return np.load(os.path.join(directory, 'triples.npy'), mmap_mode = mmap_mode), StringArray(directory, 'terms', mmap_mode)
@@ -0,0 +1,308 @@
+from graph_data import GraphData, RATING_FIELDS, RATING_TEXT_FIELDS, TRIAL_FIELDS, group_by, trial_range
+from naming import choose_drug_name
+from string_table import intern_columns
+from types import SimpleNamespace
+import json
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+#columnar snapshot of the relational schema: every table is written to Parquet files (dictionary encoded, sorted by the trial they belong to
+#and split into parts), and ParquetDataSource reads them with the same functions as graph_data, so that the graph can be built
+#without a database connection. Only export_snapshot uses the Django models; reading a snapshot does not import Django.
+
+def snapshot_tables():
+    """
+    Tables of the snapshot: {name: (model, sort column)}. Tables belonging to trials are sorted by trial so that the row group statistics prune reads by NCTID.
+    """
+    from model import (ClinicalTrial, Condition, Intervention, ArmGroup, PrimaryOutcomes, SecondaryOutcomes, Keywords, MeshCondition, MeshIntervention,
+                       Entity, Gene, GeneLabel, Drug, DrugName, DrugGeneLinkDetails, Topic, Rating, PMVocab, EntityLink, GeneLink, DrugLink, PMVocabLink,
+                       GeneAnnotation, ConditionAnnotation)
+    return {
+        'clinicaltrial': (ClinicalTrial, 'nctid'),
+        'condition': (Condition, 'document_id'),
+        'intervention': (Intervention, 'document_id'),
+        'armgroup': (ArmGroup, 'document_id'),
+        'primaryoutcomes': (PrimaryOutcomes, 'document_id'),
+        'secondaryoutcomes': (SecondaryOutcomes, 'document_id'),
+        'keywords': (Keywords, 'document_id'),
+        'meshcondition': (MeshCondition, 'document_id'),
+        'meshintervention': (MeshIntervention, 'document_id'),
+        'entity': (Entity, 'id'),
+        'gene': (Gene, 'pk'),
+        'genelabel': (GeneLabel, 'id'),
+        'drug': (Drug, 'id'),
+        'drugname': (DrugName, 'id'),
+        'druggenelinkdetails': (DrugGeneLinkDetails, 'id'),
+        'topic': (Topic, 'id'),
+        'topic_genes_mtm': (Topic.genes_mtm.through, 'id'),
+        'rating': (Rating, 'document_id'),
+        'pmvocab': (PMVocab, 'id'),
+        'entitylink': (EntityLink, 'trial_id'),
+        'genelink': (GeneLink, 'trial_id'),
+        'druglink': (DrugLink, 'trial_id'),
+        'pmvocablink': (PMVocabLink, 'trial_id'),
+        'geneannotation': (GeneAnnotation, 'id'),
+        'conditionannotation': (ConditionAnnotation, 'id'),
+    }
+
+LINK_TABLES = ('entitylink', 'genelink', 'druglink', 'pmvocablink')
+RATING_COLUMNS = ['id'] + [field for field in RATING_FIELDS if '__' not in field]
+ARROW_TYPES = {
+    'CharField': pa.string(),
+    'TextField': pa.string(),
+    'AutoField': pa.int64(),
+    'BigAutoField': pa.int64(),
+    'IntegerField': pa.int64(),
+    'FloatField': pa.float64(),
+    'BooleanField': pa.bool_(),
+}
+
+def arrow_type(field):
+    if field.is_relation:
+        field = field.target_field
+    return ARROW_TYPES[field.get_internal_type()]
+
+def table_columns(model):
+    return [(field.attname, arrow_type(field)) for field in model._meta.concrete_fields]
+
+def export_table(directory, name, model, sort_column, rows_per_file = 1000000, batch_size = 50000):
+    """
+    Writes one model to directory/name/part-NNNNN.parquet, sorted by sort_column and then by primary key. Returns the numbers of rows and files.
+    """
+    from django.db.models.functions import Coalesce
+    from model import LINK_PARTS
+    columns = table_columns(model)
+    queryset = model.objects.all()
+    if name in LINK_TABLES:
+        #NCTID of the trial a link belongs to, whichever part of the trial it points to
+        queryset = queryset.annotate(trial_id = Coalesce('document_id', *[part + '__document_id' for part in LINK_PARTS]))
+        columns.append(('trial_id', pa.string()))
+    schema = pa.schema(columns)
+    names = [column for column, column_type in columns]
+    rows = queryset.order_by(sort_column, 'pk').values_list(*names).iterator(chunk_size = batch_size)
+    os.makedirs(os.path.join(directory, name), exist_ok = True)
+    writer = None
+    files = count = in_file = 0
+    batch = []
+    def flush():
+        arrays = [pa.array(values, type = column_type) for values, (column, column_type) in zip(zip(*batch), columns)] if batch else [pa.array([], type = column_type) for column, column_type in columns]
+        writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema = schema))
+        batch.clear()
+    for row in rows:
+        if writer is None:
+            writer = pq.ParquetWriter(os.path.join(directory, name, f'part-{files:05d}.parquet'), schema, use_dictionary = True, compression = 'zstd')
+            files += 1
+        batch.append(row)
+        count += 1
+        in_file += 1
+        if len(batch) >= batch_size:
+            flush()
+        if in_file >= rows_per_file:
+            flush()
+            writer.close()
+            writer, in_file = None, 0
+    if writer is None and files == 0:
+        #empty tables still get a file, so that their schema is known
+        writer = pq.ParquetWriter(os.path.join(directory, name, 'part-00000.parquet'), schema, use_dictionary = True, compression = 'zstd')
+        files = 1
+    if writer is not None:
+        flush()
+        writer.close()
+    return count, files
+
+def export_snapshot(directory = 'snapshot', rows_per_file = 1000000):
+    """
+    Writes every table of snapshot_tables() to directory as Parquet, plus meta.json with the number of rows and files of every table.
+    """
+    meta = {}
+    for name, (model, sort_column) in tqdm(snapshot_tables().items()):
+        rows, files = export_table(directory, name, model, sort_column, rows_per_file)
+        meta[name] = {'rows': rows, 'files': files}
+    with open(os.path.join(directory, 'meta.json'), 'w', encoding = 'utf-8') as f:
+        json.dump({'tables': meta}, f, indent = 1)
+    return directory
+
+def trial_filter(column, document_filter):
+    """
+    Arrow filter expression equivalent to a graph_data document filter ({'document_id__in': ...}, '__gte', '__lte'), applied to column.
+    """
+    expression = None
+    for key, value in document_filter.items():
+        lookup = key.rsplit('__', 1)[1]
+        if lookup == 'in':
+            condition = pc.field(column).isin(list(value))
+        elif lookup == 'gte':
+            condition = pc.field(column) >= value
+        elif lookup == 'lte':
+            condition = pc.field(column) <= value
+        elif lookup == 'gt':
+            condition = pc.field(column) > value
+        else:
+            raise ValueError(f'unsupported filter {key}')
+        expression = condition if expression is None else expression & condition
+    return expression
+
+class ParquetDataSource:
+    """
+    Data source reading a snapshot written by export_snapshot; provides the functions of graph_data.DjangoDataSource.
+    """
+    def __init__(self, directory = 'snapshot'):
+        self.directory = directory
+        self.entity_urls = None
+        self.topic_keys = None
+
+    def read(self, name, columns = None, filters = None):
+        return pq.read_table(os.path.join(self.directory, name), columns = columns, filters = filters)
+
+    def rows(self, name, columns = None, filters = None, sort = None):
+        table = self.read(name, columns, filters)
+        if sort is not None:
+            table = table.sort_by([(column, 'ascending') for column in sort])
+        return table.to_pylist()
+
+    def lookups(self):
+        #small tables joined in Python: entity urls of links and topics, year and number of the topics of ratings
+        if self.entity_urls is None:
+            self.entity_urls = {row['id']: row['url'] for row in self.rows('entity', ['id', 'url'])}
+            self.topic_keys = {row['id']: (row['year'], row['topic_no']) for row in self.rows('topic', ['id', 'year', 'topic_no'])}
+
+    def load_shared_data(self) -> GraphData:
+        self.lookups()
+        data = GraphData()
+        data.entities = self.rows('entity', ['url', 'label'])
+        data.genes = self.rows('gene', ['main_label', 'family_id'])
+        data.gene_labels = group_by(self.rows('genelabel', ['gene_id', 'text']), 'gene_id')
+        data.drugs = self.read('drug', ['id']).column('id').to_pylist()
+        data.drug_names = group_by(self.rows('drugname', ['drug_id', 'type', 'name']), 'drug_id')
+        data.drug_labels = {drug_id: choose_drug_name(drug_id, [(name['type'], name['name']) for name in data.drug_names.get(drug_id, [])]) for drug_id in data.drugs}
+        data.drug_targets = group_by(self.rows('druggenelinkdetails', ['drug_id', 'gene_id', 'impact']), 'drug_id')
+        data.topics = [{'pk': row['id'], 'year': row['year'], 'topic_no': row['topic_no'], 'demo': row['demo'], 'disease': row['disease'],
+                        'disease_fl__url': self.entity_urls.get(row['disease_fl_id'])}
+                       for row in self.rows('topic', ['id', 'year', 'topic_no', 'demo', 'disease', 'disease_fl_id'])]
+        data.topic_genes = group_by(self.rows('topic_genes_mtm', ['topic_id', 'gene_id']), 'topic_id')
+        data.interventions, data.conditions, data.ratings = {}, {}, []
+        data.entity_links = data.gene_links = data.drug_links = {'document': {}, 'condition': {}}
+        return data
+
+    def load_links(self, name, target, document_filter):
+        columns = ['id', 'document_id', 'condition_id', 'entity_id' if target == 'entity__url' else target]
+        rows = self.rows(name, columns, trial_filter('trial_id', document_filter) if document_filter else None, sort = ['id'])
+        if target == 'entity__url':
+            for row in rows:
+                row['entity__url'] = self.entity_urls.get(row.pop('entity_id'))
+        for row in rows:
+            del row['id']
+        rows = intern_columns(rows, [target])
+        return {'document': group_by(rows, 'document_id'), 'condition': group_by(rows, 'condition_id')}
+
+    def rating_columns(self, rows, with_pk = False):
+        #rows of the rating table with the columns of graph_data.RATING_FIELDS
+        for row in rows:
+            row['topic__year'], row['topic__topic_no'] = self.topic_keys[row['topic_id']]
+            row['pk'] = row.pop('id')
+            if not with_pk:
+                del row['pk']
+        return intern_columns(rows, RATING_TEXT_FIELDS)
+
+    def rating_rows(self, filters, with_pk = False):
+        self.lookups()
+        return self.rating_columns(self.rows('rating', RATING_COLUMNS, filters, sort = ['id']), with_pk)
+
+    def load_trial_data(self, data, document_filter, ratings = True):
+        self.lookups()
+        filters = trial_filter('document_id', document_filter) if document_filter else None
+        data.interventions = group_by(intern_columns([{'document_id': row['document_id'], 'type': row['type'], 'name': row['name']}
+                                                      for row in self.rows('intervention', ['id', 'document_id', 'type', 'name'], filters, sort = ['id'])], ('type', 'name')), 'document_id')
+        data.conditions = group_by(intern_columns([{'pk': row['id'], 'document_id': row['document_id'], 'text': row['text']}
+                                                   for row in self.rows('condition', ['id', 'document_id', 'text'], filters, sort = ['id'])], ('text',)), 'document_id')
+        data.entity_links = self.load_links('entitylink', 'entity__url', document_filter)
+        data.gene_links = self.load_links('genelink', 'gene_id', document_filter)
+        data.drug_links = self.load_links('druglink', 'drug_id', document_filter)
+        data.ratings = self.rating_rows(filters) if ratings else []
+        return data
+
+    def load_graph_data(self, first_nctid = None, last_nctid = None, trials = True) -> GraphData:
+        data = self.load_shared_data()
+        if trials:
+            self.load_trial_data(data, trial_range('document_id', first_nctid, last_nctid))
+        return data
+
+    def iter_trials(self, first_nctid = None, last_nctid = None, fields = TRIAL_FIELDS, after_nctid = None):
+        """
+        Generator over the trials of an inclusive NCTID range as objects with the attributes fields, reading one Parquet file at a time.
+        """
+        document_filter = trial_range('nctid', first_nctid, last_nctid)
+        if after_nctid is not None:
+            document_filter['nctid__gt'] = after_nctid
+        filters = trial_filter('nctid', document_filter) if document_filter else None
+        dataset = pq.ParquetDataset(os.path.join(self.directory, 'clinicaltrial'), filters = filters)
+        for fragment in sorted(dataset.fragments, key = lambda fragment: fragment.path):
+            table = fragment.to_table(columns = list(fields), filter = filters)
+            for row in table.to_pylist():
+                yield SimpleNamespace(**row)
+
+    def iter_trial_chunks(self, data, chunk_size = 1000, after_nctid = None, first_nctid = None, last_nctid = None, fields = TRIAL_FIELDS, ratings = True):
+        chunk = []
+        for trial in self.iter_trials(first_nctid, last_nctid, fields, after_nctid):
+            chunk.append(trial)
+            if len(chunk) == chunk_size:
+                #pages are contiguous NCTID ranges, which the sorted files answer with range filters
+                self.load_trial_data(data, trial_range('document_id', chunk[0].nctid, chunk[-1].nctid), ratings)
+                yield chunk
+                chunk = []
+        if chunk:
+            self.load_trial_data(data, trial_range('document_id', chunk[0].nctid, chunk[-1].nctid), ratings)
+            yield chunk
+
+    def stream_trials(self, data, chunk_size = 1000, first_nctid = None, last_nctid = None):
+        for trials in self.iter_trial_chunks(data, chunk_size, first_nctid = first_nctid, last_nctid = last_nctid, ratings = False):
+            yield from trials
+
+    def iter_rating_chunks(self, chunk_size = 1000, after_pk = None, first_nctid = None, last_nctid = None):
+        """
+        Generator over the ratings of an inclusive NCTID range in pages of chunk_size, read one record batch at a time. The pages follow the order
+        of the snapshot, by trial and then by primary key (so ratings of the same trial and topic keep their order), and after_pk resumes after
+        that rating in this order.
+        """
+        self.lookups()
+        document_filter = trial_range('document_id', first_nctid, last_nctid)
+        filters = trial_filter('document_id', document_filter) if document_filter else None
+        if after_pk is not None:
+            after = self.read('rating', ['document_id'], pc.field('id') == after_pk).column('document_id').to_pylist()
+            if not after:
+                raise ValueError(f'rating {after_pk} is not in the snapshot')
+            later = (pc.field('document_id') > after[0]) | ((pc.field('document_id') == after[0]) & (pc.field('id') > after_pk))
+            filters = later if filters is None else filters & later
+        dataset = pq.ParquetDataset(os.path.join(self.directory, 'rating'), filters = filters)
+        chunk = []
+        for fragment in sorted(dataset.fragments, key = lambda fragment: fragment.path):
+            for batch in fragment.to_batches(columns = RATING_COLUMNS, filter = filters, batch_size = chunk_size):
+                chunk.extend(self.rating_columns(batch.to_pylist(), with_pk = True))
+                while len(chunk) >= chunk_size:
+                    yield chunk[:chunk_size]
+                    chunk = chunk[chunk_size:]
+        if chunk:
+            yield chunk
+
+    def stream_ratings(self, chunk_size = 1000, first_nctid = None, last_nctid = None):
+        for ratings in self.iter_rating_chunks(chunk_size, first_nctid = first_nctid, last_nctid = last_nctid):
+            yield from ratings
+
+    def count_trials(self, first_nctid = None, last_nctid = None):
+        document_filter = trial_range('nctid', first_nctid, last_nctid)
+        return self.read('clinicaltrial', ['nctid'], trial_filter('nctid', document_filter) if document_filter else None).num_rows
+
+    def count_ratings(self, first_nctid = None, last_nctid = None):
+        document_filter = trial_range('document_id', first_nctid, last_nctid)
+        return self.read('rating', ['document_id'], trial_filter('document_id', document_filter) if document_filter else None).num_rows
+
+    def trial_ids(self):
+        return self.read('clinicaltrial', ['nctid']).column('nctid').to_pylist()
+
+    def shard_ranges(self, shards):
+        nctids = self.trial_ids()
+        size = -(-len(nctids) // shards) if nctids else 1
+        return [(nctids[i], nctids[min(i + size, len(nctids)) - 1]) for i in range(0, len(nctids), size)]
@@ -0,0 +1,109 @@
+from graph_data import load_shared_data
+from bm25 import tokenize
+from collections import defaultdict
+from model import Topic
+
+#knowledge graph based query expansion. All the relations used (gene families, gene synonyms, drug targets and drug names)
+#are turned into adjacency dictionaries once, so expanding a topic is a walk over dictionaries without any ORM or SPARQL calls.
+
+DEFAULT_WEIGHTS = {
+    'gene': 1.0,
+    'synonym': 0.8,
+    'family': 0.5,
+    'homolog': 0.4,
+    'drug': 0.6,
+    'disease': 1.0,
+}
+
+class QueryExpander:
+    """
+    Turns a Topic into a weighted expanded query. Expansions are memoized per topic.
+
+    An expanded query is a dictionary with the keys:
+    -----------
+        genes - {gene main label: weight}, the topic genes, their families and homologs
+
+        drugs - {drug primary key: weight}, drugs targeting any of the genes, weighted by DrugGeneLinkDetails.impact
+
+        entities - {entity url: weight}, the disease of the topic
+
+        terms - {text: weight}, gene labels and synonyms, drug names and the disease, for text retrieval
+    """
+    def __init__(self, data = None, weights = DEFAULT_WEIGHTS):
+        if data is None:
+            data = load_shared_data()
+        self.weights = weights
+        self.family = {gene['main_label']: gene['family_id'] for gene in data.genes}
+        self.homologs = defaultdict(list)
+        for gene, family in self.family.items():
+            if family is not None:
+                self.homologs[family].append(gene)
+        self.synonyms = {gene: [row['text'] for row in rows] for gene, rows in data.gene_labels.items()}
+        self.targeting_drugs = defaultdict(list)
+        for drug, rows in data.drug_targets.items():
+            for row in rows:
+                self.targeting_drugs[row['gene_id']].append((drug, row['impact']))
+        self.drug_names = {drug: [row['name'] for row in rows if row['name']] for drug, rows in data.drug_names.items()}
+        self.entity_labels = {entity['url']: entity['label'] for entity in data.entities}
+        self.topics = {topic['pk']: topic for topic in data.topics}
+        self.topic_genes = {topic: [row['gene_id'] for row in rows] for topic, rows in data.topic_genes.items()}
+        self.cache = {}
+
+    def related_genes(self, gene):
+        """
+        Returns {gene: weight} for a gene, its family and its homologs (the other members of its family and its own subfamily).
+        """
+        weights = self.weights
+        related = {gene: weights['gene']}
+        family = self.family.get(gene)
+        if family is not None:
+            related.setdefault(family, weights['family'])
+            for sibling in self.homologs.get(family, []):
+                related.setdefault(sibling, weights['homolog'])
+        for homolog in self.homologs.get(gene, []):
+            related.setdefault(homolog, weights['homolog'])
+        return related
+
+    def expand(self, topic):
+        """
+        Returns the expanded query of a topic, given as a Topic or its primary key.
+        """
+        pk = topic.pk if isinstance(topic, Topic) else topic
+        if pk in self.cache:
+            return self.cache[pk]
+        weights = self.weights
+        genes, drugs, entities, terms = {}, {}, {}, {}
+        for topic_gene in self.topic_genes.get(pk, []):
+            for gene, weight in self.related_genes(topic_gene).items():
+                genes[gene] = max(genes.get(gene, 0), weight)
+        for gene, gene_weight in genes.items():
+            terms[gene] = max(terms.get(gene, 0), gene_weight)
+            for synonym in self.synonyms.get(gene, []):
+                terms[synonym] = max(terms.get(synonym, 0), gene_weight * weights['synonym'])
+            for drug, impact in self.targeting_drugs.get(gene, []):
+                drugs[drug] = max(drugs.get(drug, 0), gene_weight * weights['drug'] * impact)
+        for drug, drug_weight in drugs.items():
+            for name in self.drug_names.get(drug, []):
+                terms[name] = max(terms.get(name, 0), drug_weight)
+        topic_row = self.topics.get(pk)
+        if topic_row is not None:
+            if topic_row['disease_fl__url'] is not None:
+                entities[topic_row['disease_fl__url']] = weights['disease']
+                label = self.entity_labels.get(topic_row['disease_fl__url'])
+                if label:
+                    terms[label] = max(terms.get(label, 0), weights['disease'])
+            if topic_row['disease']:
+                terms[topic_row['disease']] = max(terms.get(topic_row['disease'], 0), weights['disease'])
+        expanded = {'genes': genes, 'drugs': drugs, 'entities': entities, 'terms': terms}
+        self.cache[pk] = expanded
+        return expanded
+
+def bm25_query(expanded):
+    """
+    Converts the terms of an expanded query into {token: weight} accepted by bm25.BM25Index.scores; a token keeps its highest weight.
+    """
+    query = {}
+    for text, weight in expanded['terms'].items():
+        for token in tokenize(text):
+            query[token] = max(query.get(token, 0), weight)
+    return query
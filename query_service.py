@@ -0,0 +1,393 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qsl
+import numpy as np
+
+#long running local query service: the BM25 index, the CSR graph with its scorer, the eligibility columns and the query expander are
+#loaded once and shared by every client over HTTP on localhost. Concurrent requests are collected into small batches (topics ranked
+#with the knowledge graph scorer are scored with one sparse product per batch), results are kept in an LRU cache, and the cache is
+#dropped and the indexes reloaded when their files are rebuilt.
+
+METHODS = ('bm25', 'kg')
+MAX_K = 1000
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+def directory_version(directories):
+    """
+    Last modification time of the files of directories (missing directories count as 0); changes when any index is rebuilt.
+    """
+    version = 0.0
+    for directory in directories:
+        if directory is None or not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            version = max(version, entry.stat().st_mtime)
+    return version
+
+def parse_flag(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if str(value).lower() in ('0', 'false', 'no', 'off', ''):
+        return False
+    raise ValueError(f'invalid flag {value!r}')
+
+def normalize(params):
+    """
+    Validates the parameters of a request and returns it with its cache key. Free text queries ('q', optionally 'demo', the patient
+    demographics used for eligibility) are keyed by their sorted tokens, so that case, punctuation and word order do not split the cache;
+    topic queries ('year' and 'topic_no') by the topic, the method ('bm25' or 'kg'), expansion ('expand') and eligibility ('eligible').
+    """
+    from bm25 import tokenize
+    k = int(params.get('k', 100))
+    if not 0 < k <= MAX_K:
+        raise ValueError(f'k must be between 1 and {MAX_K}')
+    if 'q' in params:
+        tokens = tuple(sorted(set(tokenize(params['q']))))
+        if not tokens:
+            raise ValueError('empty query')
+        demo = ' '.join(str(params.get('demo', '')).lower().split())
+        request = {'kind': 'text', 'tokens': tokens, 'demo': demo or None, 'k': k}
+        request['key'] = ('text', tokens, demo, k)
+    elif 'year' in params and 'topic_no' in params:
+        method = params.get('method', 'bm25')
+        if method not in METHODS:
+            raise ValueError(f'method must be one of {METHODS}')
+        topic = (int(params['year']), int(params['topic_no']))
+        expand, eligible = parse_flag(params.get('expand', False)), parse_flag(params.get('eligible', False))
+        if method == 'kg':
+            #the scorer already uses the related genes and drugs of the topic
+            expand = False
+        request = {'kind': 'topic', 'topic': topic, 'method': method, 'expand': expand, 'eligible': eligible, 'k': k}
+        request['key'] = ('topic', topic, method, expand, eligible, k)
+    else:
+        raise ValueError("a query needs either 'q' or 'year' and 'topic_no'")
+    return request
+
+class LRUCache:
+    """
+    Results keyed by normalized request, at most max_entries of them; the least recently used result is dropped first.
+    """
+    def __init__(self, max_entries = 10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+
+    def clear(self):
+        self.entries.clear()
+
+class ServiceMetrics:
+    """
+    Counters of the service and latencies of the last window requests, in milliseconds.
+    """
+    def __init__(self, window = 10000):
+        self.started = time.time()
+        self.requests = self.errors = self.hits = self.misses = self.coalesced = 0
+        self.batches = self.batched_requests = self.reloads = 0
+        self.latencies = deque(maxlen = window)
+
+    def request(self, seconds, outcome):
+        self.requests += 1
+        self.latencies.append(seconds * 1000)
+        if outcome == 'hit':
+            self.hits += 1
+        elif outcome == 'miss':
+            self.misses += 1
+        elif outcome == 'coalesced':
+            self.coalesced += 1
+        else:
+            self.errors += 1
+
+    def to_dict(self, cache):
+        latencies = np.array(self.latencies) if self.latencies else None
+        percentiles = {f'p{p}': float(np.percentile(latencies, p)) for p in (50, 95, 99)} if latencies is not None else {}
+        lookups = self.hits + self.misses + self.coalesced
+        return {'uptime_seconds': time.time() - self.started, 'requests': self.requests, 'errors': self.errors,
+                'cache': {'entries': len(cache), 'max_entries': cache.max_entries, 'hits': self.hits, 'misses': self.misses,
+                          'coalesced': self.coalesced, 'hit_rate': self.hits / lookups if lookups else None},
+                'batches': self.batches, 'mean_batch_size': self.batched_requests / self.batches if self.batches else None,
+                'latency_ms': dict(percentiles, mean = float(latencies.mean()) if latencies is not None else None), 'reloads': self.reloads}
+
+class QueryEngine:
+    """
+    Indexes answering the queries: bm25.BM25Index, kg_scoring.KGScorer over a csr_export.CSRGraph, eligibility.EligibilityIndex
+    (optional, without it eligibility is not filtered) and query_expansion.QueryExpander, plus the topics keyed by (year, topic_no).
+    Runs batches of normalized requests; it is not thread safe and is only used by one thread at a time.
+    """
+    def __init__(self, bm25_directory = 'bm25_index', csr_directory = 'kg_csr', eligibility_directory = 'eligibility'):
+        from bm25 import BM25Index
+        from csr_export import CSRGraph
+        from eligibility import EligibilityIndex
+        from kg_scoring import KGScorer
+        from model import Topic
+        from query_expansion import QueryExpander
+        self.directories = (bm25_directory, csr_directory, eligibility_directory)
+        self.version = directory_version(self.directories)
+        self.bm25 = BM25Index(bm25_directory)
+        self.scorer = KGScorer(CSRGraph(csr_directory))
+        self.eligibility = EligibilityIndex(eligibility_directory) if eligibility_directory is not None and os.path.isdir(eligibility_directory) else None
+        self.expander = QueryExpander()
+        self.topics = {(topic.year, topic.topic_no): topic for topic in Topic.objects.all()}
+
+    def topic(self, key):
+        topic = self.topics.get(key)
+        if topic is None:
+            raise KeyError(f'topic {key[0]} {key[1]} does not exist')
+        return topic
+
+    def mask(self, demo, nctids):
+        if demo is None or self.eligibility is None:
+            return None
+        return self.eligibility.mask_for(demo, nctids)
+
+    def run_bm25(self, request):
+        from bm25 import topic_query
+        from query_expansion import bm25_query
+        if request['kind'] == 'text':
+            return self.bm25.search(' '.join(request['tokens']), request['k'], self.mask(request['demo'], self.bm25.nctids))
+        topic = self.topic(request['topic'])
+        query = bm25_query(self.expander.expand(topic)) if request['expand'] else topic_query(topic)
+        return self.bm25.search(query, request['k'], self.mask(topic.demo if request['eligible'] else None, self.bm25.nctids))
+
+    def run(self, requests):
+        """
+        Returns the result of every request (a list of (nctid, score) pairs, or the exception it raised), in order.
+        Topics ranked with the scorer are grouped by k and scored together.
+        """
+        results = [None] * len(requests)
+        groups = {}
+        for i, request in enumerate(requests):
+            try:
+                if request['kind'] == 'topic' and request['method'] == 'kg':
+                    self.topic(request['topic'])
+                    groups.setdefault(request['k'], []).append(i)
+                else:
+                    results[i] = self.run_bm25(request)
+            except Exception as error:
+                results[i] = error
+        for k, indices in groups.items():
+            topics = [self.topic(requests[i]['topic']) for i in indices]
+            masks = [self.mask(topic.demo if requests[i]['eligible'] else None, self.scorer.nctids) for topic, i in zip(topics, indices)]
+            mask = np.stack([m if m is not None else np.ones(len(self.scorer.nctids), dtype = bool) for m in masks]) if any(m is not None for m in masks) else None
+            try:
+                for i, ranking in zip(indices, self.scorer.top_k(topics, k, mask)):
+                    results[i] = ranking
+            except Exception as error:
+                for i in indices:
+                    results[i] = error
+        return results
+
+class QueryService:
+    """
+    HTTP front end of a QueryEngine. Endpoints:
+        GET /search?q=...&demo=...&k=... - free text search of the trials
+        GET /topic?year=...&topic_no=...&method=bm25|kg&expand=0|1&eligible=0|1&k=... - ranking of a TREC topic
+        POST /search and /topic take the same parameters as a JSON object
+        GET /metrics - request, cache, batch and latency metrics
+        GET /health
+
+    Requests arriving within batch_window seconds of each other (at most max_batch) are run as one batch in a single worker thread;
+    identical requests in flight share one computation. Every check_interval seconds the modification times of the index directories
+    are compared with the loaded ones, and when they changed the indexes are reloaded and the cache is cleared.
+    """
+    def __init__(self, engine_factory, cache_size = 10000, batch_window = 0.002, max_batch = 64, check_interval = 5.0):
+        self.engine_factory = engine_factory
+        self.engine = None
+        self.cache = LRUCache(cache_size)
+        self.metrics = ServiceMetrics()
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.check_interval = check_interval
+        self.last_check = time.monotonic()
+        self.executor = ThreadPoolExecutor(1)
+        self.queue = []
+        self.pending = {}
+        self.flush_handle = None
+        self.reload_lock = asyncio.Lock()
+
+    async def start(self):
+        #the engine reads the topics through the ORM, which Django only allows outside of the event loop
+        self.engine = await asyncio.get_running_loop().run_in_executor(self.executor, self.engine_factory)
+
+    ###batching
+    async def query(self, params):
+        start = time.perf_counter()
+        try:
+            request = normalize(params)
+            result = self.cache.get(request['key'])
+            if result is not None:
+                outcome = 'hit'
+            else:
+                future = self.pending.get(request['key'])
+                outcome = 'coalesced' if future is not None else 'miss'
+                if future is None:
+                    future = self.enqueue(request)
+                result = await asyncio.shield(future)
+        except Exception:
+            self.metrics.request(time.perf_counter() - start, 'error')
+            raise
+        self.metrics.request(time.perf_counter() - start, outcome)
+        return result
+
+    def enqueue(self, request):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending[request['key']] = future
+        self.queue.append(request)
+        if len(self.queue) >= self.max_batch:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.batch_window, self.flush)
+        return future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.queue = self.queue, []
+        if batch:
+            asyncio.get_running_loop().create_task(self.execute(batch))
+
+    async def execute(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            await self.check_reload()
+            engine = self.engine
+            results = await loop.run_in_executor(self.executor, engine.run, batch)
+        except Exception as error:
+            results = [error] * len(batch)
+            engine = None
+        self.metrics.batches += 1
+        self.metrics.batched_requests += len(batch)
+        for request, result in zip(batch, results):
+            future = self.pending.pop(request['key'])
+            if isinstance(result, Exception):
+                future.set_exception(result)
+                continue
+            #results of an engine replaced during the batch are not cached
+            if engine is self.engine:
+                self.cache.put(request['key'], result)
+            future.set_result(result)
+
+    ###invalidation
+    async def check_reload(self, force = False):
+        if not force and time.monotonic() - self.last_check < self.check_interval:
+            return False
+        async with self.reload_lock:
+            loop = asyncio.get_running_loop()
+            self.last_check = time.monotonic()
+            version = await loop.run_in_executor(self.executor, directory_version, self.engine.directories)
+            if not force and version == self.engine.version:
+                return False
+            self.engine = await loop.run_in_executor(self.executor, self.engine_factory)
+            self.cache.clear()
+            self.metrics.reloads += 1
+            return True
+
+    ###HTTP
+    async def dispatch(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == '/health':
+            return 200, {'status': 'ok'}
+        if url.path == '/metrics':
+            return 200, self.metrics.to_dict(self.cache)
+        if url.path == '/reload' and method == 'POST':
+            await self.check_reload(force = True)
+            return 200, {'reloads': self.metrics.reloads}
+        if url.path not in ('/search', '/topic'):
+            return 404, {'error': f'unknown path {url.path}'}
+        if method == 'GET':
+            params = dict(parse_qsl(url.query))
+        elif method == 'POST':
+            params = json.loads(body or b'{}')
+            if not isinstance(params, dict):
+                raise ValueError('the body must be a JSON object')
+        else:
+            return 405, {'error': f'method {method} is not allowed'}
+        results = await self.query(params)
+        return 200, {'results': [{'nctid': nctid, 'score': score} for nctid, score in results]}
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, target, version = request_line.decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode('latin-1').split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            try:
+                status, payload = await self.dispatch(method, target, body)
+            except (ValueError, TypeError) as error:
+                status, payload = 400, {'error': str(error)}
+            except KeyError as error:
+                status, payload = 404, {'error': str(error.args[0]) if error.args else 'not found'}
+            except Exception as error:
+                status, payload = 500, {'error': repr(error)}
+            data = json.dumps(payload).encode('utf-8')
+            writer.write(f'HTTP/1.1 {status} {STATUS[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + data)
+            await writer.drain()
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host = '127.0.0.1', port = 8765):
+        await self.start()
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Serves BM25 and knowledge graph rankings of the clinical trials over HTTP.')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--database', default = None, help = 'SQLite database to read the topics from; by default DJANGO_SETTINGS_MODULE is used')
+    parser.add_argument('--bm25', default = 'bm25_index', help = 'directory of the BM25 index')
+    parser.add_argument('--csr', default = 'kg_csr', help = 'directory of the CSR export of the graph')
+    parser.add_argument('--eligibility', default = 'eligibility', help = 'directory of the eligibility columns')
+    parser.add_argument('--cache-size', type = int, default = 10000, help = 'maximum number of cached results')
+    parser.add_argument('--batch-window-ms', type = float, default = 2.0, help = 'time concurrent requests are collected into a batch')
+    parser.add_argument('--max-batch', type = int, default = 64)
+    parser.add_argument('--check-interval', type = float, default = 5.0, help = 'seconds between checks for rebuilt indexes')
+    args = parser.parse_args(argv)
+    if args.database is not None:
+        from benchmark import configure_sqlite
+        configure_sqlite(args.database)
+    else:
+        import django
+        django.setup()
+    engine_factory = lambda: QueryEngine(args.bm25, args.csr, args.eligibility)
+    async def serve():
+        service = QueryService(engine_factory, args.cache_size, args.batch_window_ms / 1000, args.max_batch, args.check_interval)
+        print(f'serving on http://{args.host}:{args.port}')
+        await service.serve(args.host, args.port)
+    asyncio.run(serve())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+from graph_creation import GraphBuilder, create_empty_ontology
+from graph_data import load_shared_data, iter_trial_chunks, iter_rating_chunks
+from instrumentation import BuildReport
+from model import ClinicalTrial, Rating
+from naming import BASE_IRI, rating_name
+import json
+import os
+import owlready2 as owl
+
+#resumable build of the knowledge graph in a persistent owlready2 world. The world is saved after the shared part and after every batch
+#of trials and ratings, and a checkpoint file next to it records the completed phases and the last trial and rating built.
+#Rows whose build raises are rolled back and quarantined in the checkpoint, so one bad row does not abort a long build.
+
+def checkpoint_path(world_path):
+    return world_path + '.checkpoint.json'
+
+def new_checkpoint():
+    return {'completed': [], 'last_nctid': None, 'last_rating': None, 'quarantine': []}
+
+def read_checkpoint(world_path):
+    with open(checkpoint_path(world_path), encoding = 'utf-8') as f:
+        return json.load(f)
+
+def write_checkpoint(checkpoint, world_path):
+    #written next to the checkpoint and renamed, so that a crash leaves either the old or the new checkpoint
+    temporary = checkpoint_path(world_path) + '.tmp'
+    with open(temporary, 'w', encoding = 'utf-8') as f:
+        json.dump(checkpoint, f, indent = 2)
+    os.replace(temporary, checkpoint_path(world_path))
+
+def discard_trial(ontology, nctid):
+    """
+    Destroys a trial and its parts (interventions and conditions), including the parts of a trial whose build failed half way.
+    """
+    for suffix in ('INT*', 'COND*'):
+        for part in ontology.search(iri = BASE_IRI + nctid + suffix):
+            owl.destroy_entity(part)
+    if ontology[nctid] is not None:
+        owl.destroy_entity(ontology[nctid])
+
+def quarantine(checkpoint, report, kind, key, error):
+    checkpoint['quarantine'].append({'kind': kind, 'key': key, 'error': repr(error)})
+    report.anomaly('quarantined_' + kind, key)
+
+def create_graph_resumable(world_path = 'clinicalTrialsForIR.sqlite3', batch_size = 1000, output = None, output_format = 'rdfxml', restart = False, report = None):
+    """
+    Builds the knowledge graph in the persistent world world_path, or continues the build recorded in its checkpoint.
+
+    The world is saved and the checkpoint written after the shared part and after every batch_size trials or ratings, so a build
+    that is killed loses at most one batch. With restart, or without a checkpoint, the build starts from scratch.
+    Trials and ratings whose build raises are destroyed and listed in the 'quarantine' of the checkpoint. When all phases are done the
+    graph is also saved to output (if given); it can be opened with graph_creation.open_graph. The world is closed even when the build raises,
+    so that it can be resumed in the same process.
+    Returns the checkpoint.
+    """
+    if report is None:
+        report = BuildReport()
+    resuming = not restart and os.path.exists(world_path) and os.path.exists(checkpoint_path(world_path))
+    if resuming:
+        checkpoint = read_checkpoint(world_path)
+    else:
+        checkpoint = new_checkpoint()
+        if os.path.exists(world_path):
+            os.remove(world_path)
+    world = owl.World(filename = world_path)
+    try:
+        ontology = create_empty_ontology(world)
+        with report.phase('load'):
+            data = load_shared_data()
+        builder = GraphBuilder(ontology, data, report = report)
+
+        if 'shared' in checkpoint['completed']:
+            builder.index_existing()
+        else:
+            builder.build_shared()
+            checkpoint['completed'].append('shared')
+            world.save()
+            write_checkpoint(checkpoint, world_path)
+
+        if 'trials' not in checkpoint['completed']:
+            remaining = ClinicalTrial.objects.filter(nctid__gt = checkpoint['last_nctid']) if checkpoint['last_nctid'] is not None else ClinicalTrial.objects.all()
+            #on resume, trials after the checkpoint may have been built by the run that crashed, but not saved with a checkpoint
+            first_batch = resuming
+            with report.phase('trials', remaining.count()) as phase:
+                for trials in iter_trial_chunks(data, batch_size, checkpoint['last_nctid'], ratings = False):
+                    with ontology:
+                        for trial in trials:
+                            if first_batch:
+                                discard_trial(ontology, trial.nctid)
+                            try:
+                                builder.build_trial(trial)
+                            except Exception as error:
+                                discard_trial(ontology, trial.nctid)
+                                quarantine(checkpoint, report, 'trial', trial.nctid, error)
+                    first_batch = False
+                    world.save()
+                    checkpoint['last_nctid'] = trials[-1].nctid
+                    write_checkpoint(checkpoint, world_path)
+                    phase.update(len(trials))
+            checkpoint['completed'].append('trials')
+            write_checkpoint(checkpoint, world_path)
+
+        if 'ratings' not in checkpoint['completed']:
+            remaining = Rating.objects.filter(pk__gt = checkpoint['last_rating']) if checkpoint['last_rating'] is not None else Rating.objects.all()
+            with report.phase('ratings', remaining.count()) as phase:
+                for ratings in iter_rating_chunks(batch_size, checkpoint['last_rating']):
+                    with ontology:
+                        for rating in ratings:
+                            #building a rating again overwrites all of its properties, so ratings need no clean up on resume
+                            try:
+                                builder.build_rating(rating)
+                            except Exception as error:
+                                name = rating_name(rating['topic__year'], rating['topic__topic_no'], rating['document_id'])
+                                if ontology[name] is not None:
+                                    owl.destroy_entity(ontology[name])
+                                quarantine(checkpoint, report, 'rating', rating['pk'], error)
+                    world.save()
+                    checkpoint['last_rating'] = ratings[-1]['pk']
+                    write_checkpoint(checkpoint, world_path)
+                    phase.update(len(ratings))
+            checkpoint['completed'].append('ratings')
+            write_checkpoint(checkpoint, world_path)
+
+        with report.phase('save'):
+            if output is not None:
+                ontology.save(output, format = output_format)
+            world.save()
+    finally:
+        #changes after the last checkpoint are not saved; the world must be closed so that the build can be resumed in this process
+        world.close()
+    print(report.summary())
+    return checkpoint
@@ -0,0 +1,72 @@
+import os
+import sys
+import numpy as np
+
+#string tables: every distinct string is stored once and referred to by an integer id. On disk a table is a UTF-8 blob
+#with an offsets array (<name>.strings.npy, <name>.offsets.npy), which can be memory mapped and decoded string by string.
+
+class StringTable:
+    """
+    Assigns consecutive ids to distinct strings, in order of first appearance.
+    """
+    def __init__(self, strings = ()):
+        self.ids = {}
+        self.strings = []
+        for string in strings:
+            self.intern(string)
+
+    def intern(self, string):
+        string_id = self.ids.get(string)
+        if string_id is None:
+            string_id = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return string_id
+
+    def __len__(self):
+        return len(self.strings)
+
+    def save(self, directory, name):
+        encoded = [string.encode('utf-8') for string in self.strings]
+        offsets = np.zeros(len(encoded) + 1, dtype = np.int64)
+        np.cumsum([len(string) for string in encoded], out = offsets[1:])
+        os.makedirs(directory, exist_ok = True)
+        np.save(os.path.join(directory, f'{name}.strings.npy'), np.frombuffer(b''.join(encoded), dtype = np.uint8))
+        np.save(os.path.join(directory, f'{name}.offsets.npy'), offsets)
+
+class StringArray:
+    """
+    Read-only string table saved by StringTable.save. Strings are decoded on access; index() builds the reverse mapping on first use.
+    """
+    def __init__(self, directory, name, mmap_mode = 'r'):
+        self.blob = np.load(os.path.join(directory, f'{name}.strings.npy'), mmap_mode = mmap_mode)
+        self.offsets = np.load(os.path.join(directory, f'{name}.offsets.npy'))
+        self.ids = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, string_id):
+        return self.blob[self.offsets[string_id]:self.offsets[string_id + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def index(self, string):
+        """
+        Id of string, or None if it is not in the table.
+        """
+        if self.ids is None:
+            self.ids = {value: i for i, value in enumerate(self)}
+        return self.ids.get(string)
+
+def intern_columns(rows, columns):
+    """
+    Replaces the values of columns in every row (value dictionaries) with interned strings, so that repeated values
+    such as intervention names, condition texts and annotations are stored once in memory. Returns the rows as a list.
+    """
+    rows = list(rows)
+    for row in rows:
+        for column in columns:
+            if isinstance(row[column], str):
+                row[column] = sys.intern(row[column])
+    return rows
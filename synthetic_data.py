@@ -0,0 +1,115 @@
+from model import (ClinicalTrial, Condition, Intervention, Keywords, Entity, Gene, GeneLabel, Drug, DrugName, DrugGeneLinkDetails,
+                   EntityLink, GeneLink, DrugLink, Topic, Rating)
+from django.db import transaction
+import random
+from tqdm import tqdm
+
+#synthetic corpus with the schema of model.py, used to benchmark the build and the lookups at sizes the real corpus does not have.
+#The number of rows per trial follows the fan-out below; every count is drawn uniformly between 0 and twice the mean.
+
+FAN_OUT = {
+    'conditions': 2,
+    'interventions': 2,
+    'keywords': 3,
+    'entity_links': 3,
+    'gene_links': 1,
+    'drug_links': 1,
+    'condition_entity_links': 1,
+    'condition_drug_links': 0.5,
+}
+WORDS = ('cancer', 'carcinoma', 'melanoma', 'lung', 'breast', 'colorectal', 'metastatic', 'advanced', 'inhibitor', 'therapy', 'mutation',
+         'kinase', 'patients', 'study', 'phase', 'trial', 'tumor', 'solid', 'combination', 'dose', 'safety', 'efficacy', 'response', 'survival')
+AGES = ('N/A', '18 Years', '12 Years', '6 Months', '65 Years', '75 Years', '2 Years')
+GENDERS = ('All', 'All', 'All', 'Female', 'Male')
+STUDY_TYPES = ('Interventional', 'Interventional', 'Observational', 'Expanded Access', '')
+BATCH_SIZE = 10000
+
+def default_sizes(trials):
+    """
+    Vocabulary sizes for a corpus of trials: they grow with the corpus like the real cross reference tables, but much slower.
+    """
+    return {'trials': trials, 'entities': max(1000, trials // 10), 'genes': max(500, trials // 100), 'drugs': max(300, trials // 200),
+            'topics': 30, 'years': (2017, 2018, 2019), 'ratings_per_topic': max(1, min(500, trials // 20))}
+
+def count(rng, mean):
+    return rng.randint(0, int(round(2 * mean))) if mean >= 1 else int(rng.random() < mean)
+
+def text(rng, words):
+    return ' '.join(rng.choice(WORDS) for i in range(words))
+
+def bulk(model, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        model.objects.bulk_create(rows[start:start + BATCH_SIZE])
+
+def generate_corpus(trials = 10000, seed = 0, fan_out = FAN_OUT, sizes = None, progress = True):
+    """
+    Fills the (empty) database with a synthetic corpus of trials and returns the number of rows created per model (by model name).
+    sizes overrides the vocabulary sizes of default_sizes. Primary keys are assigned here so that the rows can be bulk inserted.
+    """
+    rng = random.Random(seed)
+    sizes = dict(default_sizes(trials), **(sizes or {}))
+    counts = {}
+    with transaction.atomic():
+        bulk(Entity, [Entity(pk = i + 1, url = f'http://purl.obolibrary.org/obo/DOID_{i}', label = text(rng, 2)) for i in range(sizes['entities'])])
+        genes = [f'GENE{i}' for i in range(sizes['genes'])]
+        #every tenth gene is a family, the others are its members
+        bulk(Gene, [Gene(main_label = gene, family_id = genes[i - i % 10] if i % 10 else None) for i, gene in enumerate(genes)])
+        bulk(GeneLabel, [GeneLabel(gene_id = gene, text = gene.lower()) for gene in genes])
+        bulk(Drug, [Drug(pk = i + 1) for i in range(sizes['drugs'])])
+        bulk(DrugName, [DrugName(drug_id = i + 1, type = name_type, name = f'drug{i}{name_type}') for i in range(sizes['drugs']) for name_type in ('G', 'T')])
+        bulk(DrugGeneLinkDetails, [DrugGeneLinkDetails(drug_id = i + 1, gene_id = rng.choice(genes), impact = rng.random()) for i in range(sizes['drugs'])])
+        topics = []
+        for year in sizes['years']:
+            for topic_no in range(1, sizes['topics'] + 1):
+                topics.append(Topic(pk = len(topics) + 1, year = year, topic_no = topic_no, disease = text(rng, 2), genes = rng.choice(genes),
+                                    demo = f'{rng.randint(1, 90)}-year-old {rng.choice(("female", "male"))}', disease_fl_id = rng.randint(1, sizes['entities'])))
+        bulk(Topic, topics)
+        bulk(Topic.genes_mtm.through, [Topic.genes_mtm.through(topic_id = topic.pk, gene_id = rng.choice(genes)) for topic in topics])
+        counts.update({'entity': sizes['entities'], 'gene': len(genes), 'drug': sizes['drugs'], 'topic': len(topics)})
+
+        nctids = [f'NCT{i:08d}' for i in range(trials)]
+        rows = {model: [] for model in (ClinicalTrial, Condition, Intervention, Keywords, EntityLink, GeneLink, DrugLink)}
+        condition_pk = intervention_pk = 0
+        for nctid in tqdm(nctids, disable = not progress):
+            rows[ClinicalTrial].append(ClinicalTrial(nctid = nctid, brief_title = text(rng, 6), official_title = text(rng, 12), description = text(rng, 80),
+                                                     summary = text(rng, 30), criteria = text(rng, 40), min_age = rng.choice(AGES), max_age = rng.choice(AGES),
+                                                     gender = rng.choice(GENDERS), study_type = rng.choice(STUDY_TYPES)))
+            for j in range(count(rng, fan_out['conditions'])):
+                condition_pk += 1
+                rows[Condition].append(Condition(pk = condition_pk, document_id = nctid, text = text(rng, 2)))
+                for k in range(count(rng, fan_out['condition_entity_links'])):
+                    rows[EntityLink].append(EntityLink(condition_id = condition_pk, entity_id = rng.randint(1, sizes['entities'])))
+                for k in range(count(rng, fan_out['condition_drug_links'])):
+                    rows[DrugLink].append(DrugLink(condition_id = condition_pk, drug_id = rng.randint(1, sizes['drugs'])))
+            for j in range(count(rng, fan_out['interventions'])):
+                intervention_pk += 1
+                rows[Intervention].append(Intervention(pk = intervention_pk, document_id = nctid, type = rng.choice(Intervention.TYPES), name = text(rng, 2), description = ''))
+            for j in range(count(rng, fan_out['keywords'])):
+                rows[Keywords].append(Keywords(document_id = nctid, text = rng.choice(WORDS)))
+            for j in range(count(rng, fan_out['entity_links'])):
+                rows[EntityLink].append(EntityLink(document_id = nctid, field = 'brief_title', entity_id = rng.randint(1, sizes['entities'])))
+            for j in range(count(rng, fan_out['gene_links'])):
+                rows[GeneLink].append(GeneLink(document_id = nctid, field = 'summary', gene_id = rng.choice(genes)))
+            for j in range(count(rng, fan_out['drug_links'])):
+                rows[DrugLink].append(DrugLink(document_id = nctid, field = 'summary', drug_id = rng.randint(1, sizes['drugs'])))
+            #flushed in batches so that the generator itself does not need memory proportional to the corpus
+            if len(rows[ClinicalTrial]) >= BATCH_SIZE:
+                for model, model_rows in rows.items():
+                    bulk(model, model_rows)
+                    counts[model._meta.model_name] = counts.get(model._meta.model_name, 0) + len(model_rows)
+                    model_rows.clear()
+        for model, model_rows in rows.items():
+            bulk(model, model_rows)
+            counts[model._meta.model_name] = counts.get(model._meta.model_name, 0) + len(model_rows)
+
+        ratings = []
+        for topic in topics:
+            for nctid in rng.sample(nctids, sizes['ratings_per_topic']):
+                ratings.append(Rating(document_id = nctid, topic_id = topic.pk, relevance_score = rng.choice((0, 0, 1, 2)), total_score = rng.randint(0, 10),
+                                      disease_score = rng.random(), gene_score = rng.random(), treatment_score = rng.random(), demography_score = rng.randint(0, 1),
+                                      pm_rel_desc = '', pm_disease_desc = '', pm_gene1_desc = '', pm_gene1_annotation_desc = '', pm_gene2_desc = '',
+                                      pm_gene2_annotation_desc = '', pm_gene3_desc = '', pm_gene3_annotation_desc = '', pm_other_desc = '', pm_demo_desc = '',
+                                      correct_condition_disease = ''))
+        bulk(Rating, ratings)
+        counts['rating'] = len(ratings)
+    return counts
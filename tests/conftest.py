@@ -0,0 +1,20 @@
+import os
+import sys
+import pytest
+
+#the modules are top level scripts of the repository root; model.py is registered as the 'model' app of an in-memory SQLite database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import configure_sqlite
+
+configure_sqlite(':memory:')
+
+@pytest.fixture(scope = 'session')
+def corpus():
+    """
+    Small synthetic corpus (see synthetic_data.py) in the test database, created once per session.
+    """
+    from benchmark import create_tables
+    from synthetic_data import generate_corpus
+    create_tables()
+    return generate_corpus(trials = 60, progress = False)
@@ -0,0 +1,24 @@
+import numpy as np
+from django.db import transaction
+
+from eligibility import EligibilityIndex, build_eligibility
+from model import ClinicalTrial
+
+def check_limits(index):
+    assert index.mask('1-month-old boy').all()
+    assert index.mask('6-month-old girl').all()
+    assert not index.mask('7-month-old boy').any()
+    assert not index.mask('3-week-old boy').any()
+
+def test_age_limits_are_inclusive(corpus, tmp_path):
+    directory = str(tmp_path)
+    with transaction.atomic():
+        ClinicalTrial.objects.update(min_age = '1 Month', max_age = '6 Months', gender = 'All')
+        index = build_eligibility(directory)
+        transaction.set_rollback(True)
+    assert index.min_age.dtype == np.float64 and index.min_age[0] == 1 / 12
+    check_limits(index)
+    #indexes written before the limits were stored as float64
+    for column in ('min_age', 'max_age'):
+        np.save(f'{directory}/{column}.npy', np.load(f'{directory}/{column}.npy').astype(np.float32))
+    check_limits(EligibilityIndex(directory))
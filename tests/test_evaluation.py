@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from evaluation import dcg, gains, ndcg, topic_measures
+
+JUDGMENTS = {'NCT01': 2, 'NCT02': 1, 'NCT03': 1, 'NCT04': 0}
+
+def test_ndcg_perfect_ranking():
+    assert ndcg(gains(['NCT01', 'NCT02', 'NCT03', 'NCT04'], JUDGMENTS), JUDGMENTS) == pytest.approx(1.0)
+
+def test_ndcg_short_run_is_normalized_by_all_relevant_documents():
+    #one relevant hit out of three judged relevant documents
+    score = ndcg(gains(['NCT02'], JUDGMENTS), JUDGMENTS)
+    assert score == pytest.approx(1 / dcg(np.array([2.0, 1.0, 1.0])))
+    assert score < 1
+
+def test_ndcg_cutoff():
+    ranking = gains(['NCT01', 'NCT04', 'NCT02'], JUDGMENTS)
+    assert ndcg(ranking, JUDGMENTS, cutoff = 1) == pytest.approx(1.0)
+    assert ndcg(ranking, JUDGMENTS, cutoff = 2) == pytest.approx(2 / dcg(np.array([2.0, 1.0])))
+
+def test_infndcg_short_run():
+    #unjudged documents are removed before scoring, the ideal ranking still has every judged relevant document
+    measures = topic_measures(['NCT99', 'NCT98', 'NCT02'], JUDGMENTS)
+    assert measures['infNDCG'] == pytest.approx(1 / dcg(np.array([2.0, 1.0, 1.0])))
+    assert measures['nDCG'] == pytest.approx((1 / np.log2(4)) / dcg(np.array([2.0, 1.0, 1.0])))
+    assert measures['nDCG'] <= measures['infNDCG'] < 1
@@ -0,0 +1,47 @@
+from gene_hierarchy import GeneHierarchy
+
+def forest():
+    #A -> B -> D, A -> C, E alone; F's family is not a gene
+    return GeneHierarchy({'A': None, 'B': 'A', 'C': 'A', 'D': 'B', 'E': None, 'F': 'missing'})
+
+def test_descendants_ancestors_subtree():
+    hierarchy = forest()
+    assert hierarchy.descendants('A') == ['B', 'D', 'C']
+    assert hierarchy.descendants('D') == []
+    assert hierarchy.subtree('B') == ['B', 'D']
+    assert hierarchy.ancestors('D') == ['B', 'A']
+    assert hierarchy.ancestors('A') == []
+    assert hierarchy.is_descendant('D', 'A') and hierarchy.is_ancestor('A', 'D')
+    assert not hierarchy.is_descendant('A', 'A') and not hierarchy.is_descendant('C', 'B')
+    assert not hierarchy.is_descendant('D', 'unknown')
+
+def test_missing_parent_becomes_root():
+    hierarchy = forest()
+    assert hierarchy.parent['F'] is None and hierarchy.ancestors('F') == []
+    assert hierarchy.subtree('F') == ['F']
+    assert hierarchy.cycles == []
+
+def test_self_loop():
+    hierarchy = GeneHierarchy({'A': 'A', 'B': 'A'})
+    assert hierarchy.cycles == [('A', 'A')]
+    assert hierarchy.parent == {'A': None, 'B': 'A'}
+    assert hierarchy.subtree('A') == ['A', 'B']
+
+def test_cycle_is_broken_once():
+    hierarchy = GeneHierarchy({'A': 'C', 'B': 'A', 'C': 'B', 'D': 'C'})
+    assert len(hierarchy.cycles) == 1
+    gene, family = hierarchy.cycles[0]
+    assert hierarchy.parent[gene] is None
+    assert sorted(hierarchy.order) == ['A', 'B', 'C', 'D']
+    assert hierarchy.subtree(gene) == hierarchy.order
+    for other in 'ABCD':
+        assert hierarchy.ancestors(other)[-1:] in ([gene], []) and other not in hierarchy.ancestors(other)
+
+def test_save_load(tmp_path):
+    hierarchy = GeneHierarchy({'A': 'B', 'B': 'A', 'C': 'A'})
+    path = str(tmp_path / 'gene_hierarchy.json')
+    hierarchy.save(path)
+    loaded = GeneHierarchy.load(path)
+    assert loaded.order == hierarchy.order and loaded.cycles == hierarchy.cycles
+    assert loaded.descendants(hierarchy.order[0]) == hierarchy.descendants(hierarchy.order[0])
+    assert loaded.ancestors('C') == hierarchy.ancestors('C')
@@ -0,0 +1,27 @@
+from django.db import connection
+from graph_data import link_queries, load_links
+from model import ClinicalTrial, Condition, EntityLink, GeneLink, DrugLink
+
+LINKS = ((EntityLink, 'entity__url'), (GeneLink, 'gene_id'), (DrugLink, 'drug_id'))
+
+def test_load_links(corpus):
+    nctids = list(ClinicalTrial.objects.order_by('nctid').values_list('nctid', flat = True)[5:15])
+    conditions = set(Condition.objects.filter(document_id__in = nctids).values_list('pk', flat = True))
+    for model, target in LINKS:
+        every = load_links(model, target, {})
+        links = load_links(model, target, {'document_id__in': nctids})
+        assert links['document'] == {nctid: rows for nctid, rows in every['document'].items() if nctid in nctids}
+        assert links['condition'] == {condition: rows for condition, rows in every['condition'].items() if condition in conditions}
+    assert any(load_links(EntityLink, 'entity__url', {'document_id__in': nctids})['condition'].values())
+
+def test_load_links_query_plan(corpus):
+    #every query reads the link table through the index on its foreign key
+    for document_filter in ({'document_id__in': ['NCT00000000']}, {'document_id__gte': 'NCT00000000', 'document_id__lte': 'NCT00000001'}):
+        for model, target in LINKS:
+            for query in link_queries(model, target, document_filter):
+                sql, params = query.query.sql_with_params()
+                with connection.cursor() as cursor:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                    plan = [row[-1] for row in cursor.fetchall()]
+                links = [step for step in plan if 'link' in step]
+                assert len(links) == 1 and links[0].startswith('SEARCH') and 'USING INDEX' in links[0], plan
@@ -0,0 +1,34 @@
+from django.db import transaction
+import owlready2 as owl
+
+from graph_creation import create_empty_ontology
+from incremental_build import destroy, update_graph
+from model import ClinicalTrial
+
+def test_update_graph_rebuilds_changed_trials(corpus, tmp_path):
+    output = str(tmp_path / 'graph.owl')
+    assert update_graph(output, chunk_size = 16)['rebuilt'] > 0
+    assert update_graph(output, chunk_size = 16) == {'rebuilt': 0, 'deleted': 0}
+    with transaction.atomic():
+        trial = ClinicalTrial.objects.order_by('pk').first()
+        trial.brief_title = 'changed title'
+        trial.save()
+        result = update_graph(output, chunk_size = 16)
+        transaction.set_rollback(True)
+    ratings = trial.rating_set.count()
+    assert result == {'rebuilt': 1 + ratings, 'deleted': 0}
+
+def test_update_graph_ignores_graph_loaded_in_process(corpus, tmp_path):
+    output = str(tmp_path / 'graph.owl')
+    update_graph(output, chunk_size = 16)
+    #a graph with the same IRI in the default world that differs from the saved one
+    first, second = ClinicalTrial.objects.order_by('pk')[:2]
+    destroy(create_empty_ontology(), first.nctid)
+    with transaction.atomic():
+        second.brief_title = 'changed title'
+        second.save()
+        update_graph(output, chunk_size = 16)
+        transaction.set_rollback(True)
+    with open(output, 'rb') as f:
+        ontology = create_empty_ontology(owl.World()).load(fileobj = f)
+    assert ontology[first.nctid] is not None and ontology[second.nctid] is not None
@@ -0,0 +1,18 @@
+from instrumentation import BuildReport
+from model import ClinicalTrial
+
+def test_phase_counts_queries(corpus):
+    report = BuildReport(progress = False)
+    with report.phase('load'):
+        list(ClinicalTrial.objects.all())
+        ClinicalTrial.objects.count()
+    assert report.phases[0]['queries'] == 2
+
+def test_phase_without_query_counting(corpus):
+    report = BuildReport(progress = False, count_queries = False)
+    with report.phase('load') as phase:
+        list(ClinicalTrial.objects.all())
+        phase.update(3)
+    assert report.phases[0]['queries'] is None and report.phases[0]['query_seconds'] is None
+    assert report.phases[0]['rows'] == 3
+    assert report.summary().splitlines()[1].split()[4] == '-'
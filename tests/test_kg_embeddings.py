@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from csr_export import CSRGraph, export_csr
+from kg_embeddings import KGEmbeddings, build_ivf, train_embeddings
+
+@pytest.fixture(scope = 'module')
+def graph(corpus, tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp('csr'))
+    export_csr(directory)
+    return CSRGraph(directory)
+
+@pytest.mark.parametrize('model', ['transe', 'distmult'])
+def test_training_lowers_the_loss(graph, tmp_path, model):
+    embeddings = train_embeddings(str(tmp_path), graph, model = model, dim = 16, epochs = 10, batch_size = 256, processes = 1, progress = False)
+    losses = embeddings.meta['losses']
+    assert len(losses) == 10 and losses[-1] < losses[0]
+
+def test_ivf_search_with_every_list_matches_brute_force(graph, tmp_path):
+    directory = str(tmp_path)
+    embeddings = train_embeddings(directory, graph, dim = 16, epochs = 2, processes = 1, progress = False)
+    lists = build_ivf(directory, lists = 4)
+    embeddings = KGEmbeddings(directory, graph)
+    trials = len(embeddings.nctids)
+    for topic in range(graph.meta['nodes']['topic']):
+        vector = embeddings.topic_vector(topic)
+        assert embeddings.search(vector, k = trials, nprobe = lists) == embeddings.search(vector, k = trials)
+
+def test_retraining_removes_the_ivf(graph, tmp_path):
+    directory = str(tmp_path)
+    train_embeddings(directory, graph, dim = 8, epochs = 1, processes = 1, progress = False)
+    build_ivf(directory, lists = 4)
+    embeddings = train_embeddings(directory, graph, dim = 8, epochs = 1, processes = 1, progress = False)
+    assert embeddings.ivf is None and not os.path.exists(os.path.join(directory, 'ivf.order.npy'))
+
+def test_topic_vector_without_graph(graph, tmp_path):
+    train_embeddings(str(tmp_path), graph, dim = 8, epochs = 1, processes = 1, progress = False)
+    embeddings = KGEmbeddings(str(tmp_path), graph = False)
+    for topic in (0, (2017, 1)):
+        with pytest.raises(ValueError):
+            embeddings.topic_vector(topic)
@@ -0,0 +1,16 @@
+import numpy as np
+from scipy import sparse
+
+from kg_scoring import family_closure
+
+def test_family_closure():
+    #1 and 3 are in family 0, 2 in family 1; 4 has no family; 5 and 6 are each other's family
+    families = {1: 0, 2: 1, 3: 0, 5: 6, 6: 5}
+    gene_family = sparse.csr_matrix((np.ones(len(families)), (list(families), list(families.values()))), shape = (7, 7))
+    related = family_closure(gene_family)
+    assert (related != related.T).nnz == 0
+    assert sorted(related[0].indices) == [1, 2, 3]
+    assert sorted(related[2].indices) == [0, 1]
+    assert sorted(related[3].indices) == [0]
+    assert related[4].nnz == 0
+    assert sorted(related[5].indices) == [6]
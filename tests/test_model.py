@@ -0,0 +1,44 @@
+from django.db import connection, transaction
+
+from model import LINK_PARTS, ClinicalTrial, DrugLink, EntityLink, GeneLink, Intervention, Keywords, trial_links, trial_links_query
+
+def expected_links(nctids):
+    rows = []
+    for model, kind, target in ((EntityLink, 'entity', lambda link: link.entity.url), (GeneLink, 'gene', lambda link: link.gene_id),
+                                (DrugLink, 'drug', lambda link: str(link.drug_id))):
+        for link in model.objects.all():
+            part = next((getattr(link, part) for part in LINK_PARTS if getattr(link, part + '_id') is not None), None)
+            trial = link.document_id if link.document_id is not None else part.document_id
+            if trial in nctids:
+                rows.append((trial, kind, link.field, link.condition_id, link.intervention_id, target(link)))
+    return sorted(rows, key = repr)
+
+def test_trial_links(corpus):
+    with transaction.atomic():
+        #links of parts other than conditions, which the synthetic corpus does not have, and a link of a part that also names the trial
+        intervention, keyword = Intervention.objects.order_by('pk').first(), Keywords.objects.order_by('pk').first()
+        GeneLink.objects.create(intervention = intervention, field = 'name', gene_id = 'GENE1')
+        EntityLink.objects.create(keyword = keyword, entity_id = 1)
+        DrugLink.objects.create(document_id = intervention.document_id, intervention = intervention, field = 'name', drug_id = 1)
+        nctids = {intervention.document_id, keyword.document_id} | set(ClinicalTrial.objects.order_by('pk').values_list('pk', flat = True)[:10])
+        rows = [(row['trial'], row['kind'], row['part_field'], row['part_condition'], row['part_intervention'], row['target']) for row in trial_links(nctids)]
+        assert sorted(rows, key = repr) == expected_links(nctids)
+        assert {row[1] for row in rows} == {'entity', 'gene', 'drug'}
+        assert list(trial_links(['NCT_NOT_IN_DB'])) == []
+        transaction.set_rollback(True)
+
+def test_trial_links_in_chunks(corpus):
+    #more trials than fit in the parameters of one query
+    nctids = list(ClinicalTrial.objects.values_list('pk', flat = True)) + [f'NCT_NOT_IN_DB{i}' for i in range(2000)]
+    rows = [(row['trial'], row['kind'], row['part_field'], row['part_condition'], row['part_intervention'], row['target']) for row in trial_links(nctids)]
+    assert sorted(rows, key = repr) == expected_links(set(nctids))
+
+def test_trial_links_query_plan(corpus):
+    #every branch of the union reads its link table through an index
+    sql, params = trial_links_query(['NCT00000000']).query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = [row[-1] for row in cursor.fetchall()]
+    links = [step for step in plan if 'link' in step]
+    assert len(links) == 3 * (1 + len(LINK_PARTS))
+    assert all(step.startswith('SEARCH') and 'USING INDEX' in step for step in links), plan
@@ -0,0 +1,16 @@
+from django.db import transaction
+
+from graph_creation import create_graph
+from instrumentation import BuildReport
+from model import ClinicalTrial, Intervention
+from ntriples_export import export_ntriples
+
+def test_anomalies_match_graph_build(corpus, tmp_path):
+    with transaction.atomic():
+        Intervention.objects.create(document = ClinicalTrial.objects.order_by('pk').first(), type = 'Unknown type', name = 'placebo', description = '')
+        built, exported = BuildReport(progress = False), BuildReport(progress = False)
+        create_graph(output = None, report = built)
+        export_ntriples(str(tmp_path / 'graph.nt'), report = exported)
+        transaction.set_rollback(True)
+    assert built.anomalies['unknown_intervention_type'] == {'count': 1, 'examples': ['Unknown type']}
+    assert dict(exported.anomalies) == dict(built.anomalies)
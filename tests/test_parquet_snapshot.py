@@ -0,0 +1,44 @@
+import filecmp
+import os
+import subprocess
+import sys
+
+import pytest
+
+import graph_data
+from csr_export import export_csr
+from graph_data import DjangoDataSource
+from parquet_snapshot import ParquetDataSource, export_snapshot
+
+@pytest.fixture(scope = 'module')
+def snapshot(corpus, tmp_path_factory):
+    return export_snapshot(str(tmp_path_factory.mktemp('snapshot')), rows_per_file = 500)
+
+def test_csr_export_matches_database(snapshot, tmp_path):
+    #the dense ids of every node type follow the primary keys whichever source the graph is read from
+    export_csr(str(tmp_path / 'django'), source = DjangoDataSource())
+    export_csr(str(tmp_path / 'parquet'), source = ParquetDataSource(snapshot))
+    files = sorted(os.listdir(tmp_path / 'django'))
+    assert files == sorted(os.listdir(tmp_path / 'parquet'))
+    assert [name for name in files if not filecmp.cmp(tmp_path / 'django' / name, tmp_path / 'parquet' / name, shallow = False)] == []
+
+def test_rating_chunks(snapshot):
+    chunks = list(ParquetDataSource(snapshot).iter_rating_chunks(chunk_size = 100))
+    ratings = [rating for chunk in chunks for rating in chunk]
+    assert all(len(chunk) == 100 for chunk in chunks[:-1]) and 0 < len(chunks[-1]) <= 100
+    assert ratings == sorted(ratings, key = lambda rating: (rating['document_id'], rating['pk']))
+    expected = [rating for chunk in graph_data.iter_rating_chunks(chunk_size = 100) for rating in chunk]
+    assert sorted(ratings, key = lambda rating: rating['pk']) == expected
+    #resuming after a rating continues in the order of the snapshot
+    resumed = [rating for chunk in ParquetDataSource(snapshot).iter_rating_chunks(chunk_size = 100, after_pk = ratings[250]['pk']) for rating in chunk]
+    assert resumed == ratings[251:]
+
+def test_snapshot_build_without_django(snapshot, tmp_path):
+    #a fresh interpreter without Django settings builds the graph from the snapshot
+    script = (f'import sys; sys.path.insert(0, {os.path.dirname(os.path.dirname(os.path.abspath(__file__)))!r})\n'
+              'from graph_creation import create_graph\n'
+              'from parquet_snapshot import ParquetDataSource\n'
+              f'create_graph(output = {str(tmp_path / "graph.nt")!r}, output_format = "ntriples", source = ParquetDataSource({snapshot!r}))\n'
+              'assert "django" not in sys.modules\n')
+    subprocess.run([sys.executable, '-c', script], check = True, capture_output = True)
+    assert os.path.getsize(tmp_path / 'graph.nt') > 0
@@ -0,0 +1,20 @@
+import pytest
+
+import resumable_build
+
+def test_resume_in_process_after_failure(corpus, tmp_path, monkeypatch):
+    world_path = str(tmp_path / 'graph.sqlite3')
+    iter_rating_chunks = resumable_build.iter_rating_chunks
+    def failing(*args, **kwargs):
+        for i, ratings in enumerate(iter_rating_chunks(*args, **kwargs)):
+            if i == 1:
+                raise RuntimeError('killed')
+            yield ratings
+    monkeypatch.setattr(resumable_build, 'iter_rating_chunks', failing)
+    with pytest.raises(RuntimeError):
+        resumable_build.create_graph_resumable(world_path, batch_size = 50)
+    assert resumable_build.read_checkpoint(world_path)['completed'] == ['shared', 'trials']
+    monkeypatch.setattr(resumable_build, 'iter_rating_chunks', iter_rating_chunks)
+    checkpoint = resumable_build.create_graph_resumable(world_path, batch_size = 50)
+    assert checkpoint['completed'] == ['shared', 'trials', 'ratings']
+    assert checkpoint['quarantine'] == []
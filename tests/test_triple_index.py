@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from naming import BASE_IRI
+from string_table import StringTable
+from triple_index import TripleIndex
+from model import ClinicalTrial
+
+TRIPLES = [('NCT01', 'GeneLink', 'gene_BRAF'), ('NCT02', 'GeneLink', 'gene_BRAF'), ('NCT02', 'GeneLink', 'gene_KRAS'),
+           ('NCT03', 'hasPart', 'condition_1'), ('condition_1', 'EntityLink', 'melanoma')]
+
+@pytest.fixture(scope = 'module')
+def index(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp('compact'))
+    terms = StringTable()
+    ids = [[terms.intern(f'<{BASE_IRI}{term}>') for term in triple] for triple in TRIPLES]
+    np.save(f'{directory}/triples.npy', np.array(ids, dtype = np.int32))
+    terms.save(directory, 'terms')
+    return TripleIndex(directory)
+
+def names(rows, variable):
+    return sorted(row[variable].rsplit('#', 1)[-1] for row in rows)
+
+def test_ground_pattern_alone(index):
+    assert index.query([('NCT01', 'GeneLink', 'gene_BRAF')]) == [{}]
+    assert index.query([('NCT01', 'GeneLink', 'gene_KRAS')]) == []
+    assert index.query([('NCT01', 'GeneLink', 'gene_NOT_IN_GRAPH')]) == []
+
+@pytest.mark.parametrize('ground_first', [True, False])
+def test_ground_pattern_is_an_existence_check(index, ground_first):
+    variable, ground = ('?t', 'GeneLink', 'gene_BRAF'), ('NCT01', 'GeneLink', 'gene_BRAF')
+    patterns = [ground, variable] if ground_first else [variable, ground]
+    assert names(index.query(patterns), 't') == ['NCT01', 'NCT02']
+    missing = ('NCT01', 'GeneLink', 'gene_KRAS')
+    patterns = [missing, variable] if ground_first else [variable, missing]
+    assert index.query(patterns) == []
+
+def test_ground_pattern_after_join(index):
+    patterns = [('?t', 'hasPart', '?c'), ('?c', 'EntityLink', '?e'), ('NCT02', 'GeneLink', 'gene_KRAS')]
+    assert names(index.query(patterns, ['?t']), 't') == ['NCT03']
+    assert index.ask(patterns)
+    assert not index.ask(patterns[:2] + [('NCT03', 'GeneLink', 'gene_KRAS')])
+
+def test_reexport_rebuilds_the_index(corpus, tmp_path):
+    from ntriples_export import export_compact, load_compact
+    directory = str(tmp_path)
+    terms = StringTable()
+    np.save(f'{directory}/triples.npy', np.array([[terms.intern(f'<{BASE_IRI}{term}>') for term in triple] for triple in TRIPLES], dtype = np.int32))
+    terms.save(directory, 'terms')
+    assert len(TripleIndex(directory)) == len(TRIPLES)
+    export_compact(directory)
+    triples = np.unique(load_compact(directory)[0], axis = 0)
+    index = TripleIndex(directory)
+    assert len(index) == len(triples)
+    trial = ClinicalTrial.objects.order_by('nctid').first().nctid
+    assert len(index.query([(trial, '?p', '?o')])) == np.sum(triples[:, 0] == index.term_id(trial))
+    #triples.npy replaced without export_compact
+    np.save(f'{directory}/triples.npy', triples[:10])
+    assert len(TripleIndex(directory)) == 10
@@ -0,0 +1,309 @@
+from naming import BASE_IRI
+from string_table import StringArray
+import os
+import re
+import numpy as np
+
+#read-only triple index of the knowledge graph written by ntriples_export.export_compact. The integer encoded triples are sorted
+#in three orders (SPO, POS, OSP), each stored as three contiguous columns, so that every triple pattern is answered by binary
+#searches on a prefix of one of them. Basic graph patterns (lists of triple patterns with ?variables) are joined in order of selectivity.
+#The index only needs NumPy and the exported files, no database.
+
+#name: positions of (subject, predicate, object) in the order of the index
+PERMUTATIONS = {'spo': (0, 1, 2), 'pos': (1, 2, 0), 'osp': (2, 0, 1)}
+RDF_TYPE = '<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>'
+RDFS_LABEL = '<http://www.w3.org/2000/01/rdf-schema#label>'
+RDFS_SUBCLASS_OF = '<http://www.w3.org/2000/01/rdf-schema#subClassOf>'
+OWL_ON_PROPERTY = '<http://www.w3.org/2002/07/owl#onProperty>'
+OWL_SOME_VALUES_FROM = '<http://www.w3.org/2002/07/owl#someValuesFrom>'
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+ESCAPES = {'n': '\n', 'r': '\r', 't': '\t'}
+
+def build_triple_index(directory = 'clinicalTrialsForIR.compact'):
+    """
+    Writes the sorted permutations of the distinct triples of a compact export to directory, as <name>.npy arrays of shape (3, number of triples).
+    """
+    spo = np.unique(np.load(os.path.join(directory, 'triples.npy')), axis = 0)
+    for name, order in PERMUTATIONS.items():
+        keys = spo[:, order]
+        keys = keys[np.lexsort((keys[:, 2], keys[:, 1], keys[:, 0]))]
+        np.save(os.path.join(directory, f'{name}.npy'), np.ascontiguousarray(keys.T))
+    return len(spo)
+
+def remove_triple_index(directory):
+    """
+    Deletes the permutations of a compact export, which export_compact does before writing new triples.
+    """
+    for name in PERMUTATIONS:
+        path = os.path.join(directory, f'{name}.npy')
+        if os.path.exists(path):
+            os.remove(path)
+
+def triple_index_is_current(directory):
+    #permutations older than triples.npy were built from a previous export
+    triples = os.stat(os.path.join(directory, 'triples.npy')).st_mtime_ns
+    paths = [os.path.join(directory, f'{name}.npy') for name in PERMUTATIONS]
+    return all(os.path.exists(path) and os.stat(path).st_mtime_ns >= triples for path in paths)
+
+def ranges_to_indices(starts, lengths):
+    """
+    Concatenation of the index ranges [start, start + length).
+    """
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) else 0)
+
+def join_keys(left, right):
+    """
+    Single integer join keys for the shared variables of two tables, given as lists of columns.
+    """
+    if len(left) == 1:
+        return left[0], right[0]
+    keys = np.stack([np.concatenate((left_column, right_column)) for left_column, right_column in zip(left, right)], axis = 1)
+    inverse = np.unique(keys, axis = 0, return_inverse = True)[1].ravel()
+    return inverse[:len(left[0])], inverse[len(left[0]):]
+
+def join(table, bindings):
+    """
+    Natural join of two tables of bindings ({variable: array of term ids}) on their shared variables, a sort-merge join on the right side.
+    """
+    if table is None:
+        return bindings
+    shared = [variable for variable in bindings if variable in table]
+    rows, matches = len(next(iter(table.values()))), len(next(iter(bindings.values())))
+    if shared:
+        left_key, right_key = join_keys([table[variable] for variable in shared], [bindings[variable] for variable in shared])
+        order = np.argsort(right_key, kind = 'stable')
+        sorted_keys = right_key[order]
+        starts = np.searchsorted(sorted_keys, left_key, 'left')
+        lengths = np.searchsorted(sorted_keys, left_key, 'right') - starts
+        left = np.repeat(np.arange(rows), lengths)
+        right = order[ranges_to_indices(starts, lengths)]
+    else:
+        left = np.repeat(np.arange(rows), matches)
+        right = np.tile(np.arange(matches), rows)
+    result = {variable: column[left] for variable, column in table.items()}
+    result.update((variable, column[right]) for variable, column in bindings.items() if variable not in result)
+    return result
+
+def is_variable(term):
+    return isinstance(term, str) and term.startswith('?')
+
+class TripleIndex:
+    """
+    Triple index over a compact export, built on first use and rebuilt when the export is newer. Terms of patterns are ?variables, term ids, N-Triples terms (<iri>, "literal"^^<type>),
+    absolute IRIs, names in the graph namespace (e.g. 'NCT00001', 'gene_BRAF', 'GeneLink') or, for literals, Python values other than strings;
+    string literals are given as N-Triples terms, see ntriples_export.literal.
+
+    Fields:
+    -----------
+        terms - string_table.StringArray of the N-Triples terms, indexed by term id
+
+        indexes - {permutation name: (3, number of triples) array of term ids, sorted}
+    """
+    def __init__(self, directory = 'clinicalTrialsForIR.compact', mmap_mode = 'r'):
+        if not triple_index_is_current(directory):
+            build_triple_index(directory)
+        self.terms = StringArray(directory, 'terms', mmap_mode)
+        self.indexes = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode = mmap_mode) for name in PERMUTATIONS}
+
+    def __len__(self):
+        return self.indexes['spo'].shape[1]
+
+    def term_id(self, term):
+        """
+        Id of a term given in any of the forms accepted in patterns, None if the graph does not contain it.
+        """
+        if isinstance(term, (int, np.integer)) and not isinstance(term, bool):
+            return int(term)
+        if not isinstance(term, str):
+            from ntriples_export import literal
+            term = literal(term)
+        elif term.startswith('http://') or term.startswith('https://'):
+            term = '<' + term + '>'
+        elif not term.startswith(('<', '"', '_:')):
+            term = '<' + BASE_IRI + term + '>'
+        return self.terms.index(term)
+
+    def value(self, term_id):
+        """
+        Python value of a term: the IRI of resources, int, float, bool or str for literals, the label of blank nodes.
+        """
+        term = self.terms[term_id]
+        if term.startswith('<'):
+            return term[1:-1]
+        if not term.startswith('"'):
+            return term
+        end = term.rindex('"')
+        text = re.sub(r'\\(.)', lambda match: ESCAPES.get(match[1], match[1]), term[1:end])
+        datatype = term[end + 4:-1] if term[end + 1:end + 3] == '^^' else None
+        if datatype == XSD + 'integer' or datatype == XSD + 'int':
+            return int(text)
+        if datatype in (XSD + 'decimal', XSD + 'double', XSD + 'float'):
+            return float(text)
+        if datatype == XSD + 'boolean':
+            return text == 'true'
+        return text
+
+    ###triple patterns
+    def permutation(self, bound, last = None):
+        """
+        Index in which the bound positions form a prefix, followed by position last if given; None if there is none.
+        """
+        for name, order in PERMUTATIONS.items():
+            if set(order[:len(bound)]) == set(bound) and (last is None or order[len(bound)] == last):
+                return name
+        return None
+
+    def prefix_range(self, name, constants):
+        """
+        Range of the rows of index name starting with the term ids constants (in the order of the index).
+        """
+        columns = self.indexes[name]
+        lo, hi = 0, columns.shape[1]
+        for column, term_id in zip(columns, constants):
+            segment = column[lo:hi]
+            #a key of another dtype would make searchsorted convert the whole segment
+            term_id = segment.dtype.type(term_id)
+            lo, hi = lo + int(np.searchsorted(segment, term_id, 'left')), lo + int(np.searchsorted(segment, term_id, 'right'))
+        return lo, hi
+
+    def columns(self, name, rows):
+        columns = self.indexes[name]
+        result = [None, None, None]
+        for i, position in enumerate(PERMUTATIONS[name]):
+            result[position] = np.asarray(columns[i][rows])
+        return result
+
+    def match(self, subject = None, predicate = None, obj = None):
+        """
+        Subjects, predicates and objects (arrays of term ids) of the triples matching the given term ids; None matches anything.
+        """
+        bound = {position: term_id for position, term_id in enumerate((subject, predicate, obj)) if term_id is not None}
+        name = self.permutation(bound)
+        lo, hi = self.prefix_range(name, [bound[position] for position in PERMUTATIONS[name][:len(bound)]])
+        return self.columns(name, slice(lo, hi))
+
+    def count(self, subject = None, predicate = None, obj = None):
+        bound = {position: term_id for position, term_id in enumerate((subject, predicate, obj)) if term_id is not None}
+        name = self.permutation(bound)
+        lo, hi = self.prefix_range(name, [bound[position] for position in PERMUTATIONS[name][:len(bound)]])
+        return hi - lo
+
+    def match_values(self, bound, position, values):
+        """
+        Like match, with position restricted to the sorted term ids values, answered with one vectorized binary search
+        in an index where position follows the bound positions. Without such an index (e.g. a bound predicate followed by
+        the subject) the triples of values are read from the index starting with position and filtered.
+        """
+        name = self.permutation(bound, position)
+        prefix = bound if name is not None else {}
+        if name is None:
+            name = self.permutation({}, position)
+        lo, hi = self.prefix_range(name, [prefix[bound_position] for bound_position in PERMUTATIONS[name][:len(prefix)]])
+        segment = self.indexes[name][len(prefix)][lo:hi]
+        values = np.asarray(values, dtype = segment.dtype)
+        starts = np.searchsorted(segment, values, 'left')
+        lengths = np.searchsorted(segment, values, 'right') - starts
+        columns = self.columns(name, lo + ranges_to_indices(starts, lengths))
+        if prefix is not bound:
+            keep = np.ones(len(columns[0]), dtype = bool)
+            for bound_position, term_id in bound.items():
+                keep &= columns[bound_position] == term_id
+            columns = [column[keep] for column in columns]
+        return columns
+
+    ###basic graph patterns
+    def encode(self, pattern):
+        """
+        Pattern with its constants replaced by term ids; the second value is False when a constant is not in the graph.
+        """
+        encoded = tuple(term if is_variable(term) else self.term_id(term) for term in pattern)
+        return encoded, all(term is not None for term in encoded)
+
+    def plan(self, patterns):
+        """
+        Order in which the patterns are joined, as (pattern, number of triples matching its constants): the most selective pattern first,
+        then always the most selective pattern sharing a variable with the patterns before it, so that no step is a cartesian product
+        unless the query is disconnected.
+        """
+        remaining = []
+        for pattern in patterns:
+            encoded, known = self.encode(pattern)
+            constants = [None if is_variable(term) else term for term in encoded]
+            remaining.append((encoded, self.count(*constants) if known else 0))
+        ordered, bound = [], set()
+        while remaining:
+            step = min(remaining, key = lambda item: (bool(bound) and not bound & {term for term in item[0] if is_variable(term)}, item[1]))
+            remaining.remove(step)
+            ordered.append(step)
+            bound.update(term for term in step[0] if is_variable(term))
+        return ordered
+
+    def bindings(self, pattern, table, estimate):
+        constants = {position: term for position, term in enumerate(pattern) if not is_variable(term)}
+        variables = {}
+        for position, term in enumerate(pattern):
+            if is_variable(term):
+                variables.setdefault(term, []).append(position)
+        columns = None
+        shared = [variable for variable in variables if table is not None and variable in table]
+        if len(shared) == 1:
+            #index nested loop join: look the pattern up for the distinct values bound so far instead of reading all its matches
+            values = np.unique(table[shared[0]])
+            if len(values) < estimate:
+                columns = self.match_values(constants, variables[shared[0]][0], values)
+        if columns is None:
+            columns = self.match(*[constants.get(position) for position in range(3)])
+        keep = np.ones(len(columns[0]), dtype = bool)
+        for positions in variables.values():
+            #a variable repeated in a pattern, e.g. (?x, p, ?x)
+            for position in positions[1:]:
+                keep &= columns[position] == columns[positions[0]]
+        return {variable: columns[positions[0]][keep] if not keep.all() else columns[positions[0]] for variable, positions in variables.items()}
+
+    def solutions(self, patterns):
+        """
+        Solutions of a basic graph pattern (a list of (subject, predicate, object) patterns) as {variable: array of term ids}, one row per solution.
+        Patterns without variables are existence checks: they leave the solutions unchanged if their triple is in the graph, and remove them all otherwise.
+        """
+        table = None
+        for pattern, estimate in self.plan(patterns):
+            if estimate == 0:
+                variables = {term for pattern in patterns for term in pattern if is_variable(term)}
+                return {variable: np.zeros(0, dtype = np.int32) for variable in variables}
+            if not any(is_variable(term) for term in pattern):
+                #a pattern without variables only checks that its triple is in the graph, which its count already did
+                continue
+            table = join(table, self.bindings(pattern, table, estimate))
+            if len(next(iter(table.values()))) == 0:
+                break
+        variables = {term for pattern in patterns for term in pattern if is_variable(term)}
+        return {variable: table[variable] if table is not None and variable in table else np.zeros(0, dtype = np.int32) for variable in variables}
+
+    def ask(self, patterns):
+        """
+        True if the basic graph pattern has a solution; for a pattern without variables, if all its triples are in the graph.
+        """
+        table = self.solutions(patterns)
+        if table:
+            return len(next(iter(table.values()))) > 0
+        return all(known and self.count(*encoded) > 0 for encoded, known in map(self.encode, patterns))
+
+    def query(self, patterns, select = None, limit = None):
+        """
+        Distinct solutions of a basic graph pattern projected on the variables select (all by default), as dictionaries of Python values
+        (see value) keyed by variable name without the '?'.
+
+        e.g. trials linked to a gene targeted by a drug:
+            index.query([('?trial', 'GeneLink', '?gene'), ('drug_imatinib', RDFS_SUBCLASS_OF, '?target'), ('?target', OWL_SOME_VALUES_FROM, '?gene')], ['?trial'])
+        """
+        table = self.solutions(patterns)
+        if select is None:
+            select = sorted(table)
+        if not select:
+            #a single empty solution if the pattern matches
+            return [{}] if self.ask(patterns) else []
+        rows = np.unique(np.stack([table[variable] for variable in select], axis = 1), axis = 0)
+        if limit is not None:
+            rows = rows[:limit]
+        return [{variable[1:]: self.value(term_id) for variable, term_id in zip(select, row)} for row in rows]